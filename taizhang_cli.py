@@ -0,0 +1,182 @@
+"""
+命令行批量统计：不开页面，读五份工作簿，按统计基准日期算四类指标和报表公式，写 JSON 和 xlsx。
+
+    python taizhang_cli.py --filter 筛选条件.xlsx --trad 传统.xlsx --batch 批量.xlsx \\
+        --baohan 保函.xlsx --daichang 代偿.xlsx --as-of 2025-06-30 --out 输出目录
+
+读取结果照常写进 .taizhang_cache/ 的 sidecar，报表结果存进历史结果库（--no-history 不存）；
+页面上打开同样的文件就直接读 sidecar，报表页也能带出这次的结果。
+
+多主体合并：--manifest 给一张主体清单（.csv 或 .xlsx），每行一个主体的一套工作簿，
+各主体并行统计后再出合并口径（户数、单户类指标在主体之间去重），不读写历史结果库。
+
+    python taizhang_cli.py --manifest 主体清单.csv --as-of 2025-06-30 --out 输出目录
+"""
+import argparse
+import json
+import logging
+import re
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+from taizhang_pipeline import (
+    HISTORY_PREFILL, OVERDUE_SHEETS, RESULT_SHEETS, STAT_FILE_KEYS,
+    ResultHistory, _cell, consolidation_frame, directory_templates, results_workbook, run_consolidation,
+    run_pipeline, write_workbook,
+)
+
+FILE_ARGS = {"filter_file": "filter", "trad_file": "trad", "batch_file": "batch",
+             "baohan_file": "baohan", "daichang_file": "daichang"}
+# 主体清单的列 -> 文件槽位
+MANIFEST_FILES = {"筛选条件": "filter_file", "传统": "trad_file", "批量": "batch_file",
+                  "保函": "baohan_file", "代偿": "daichang_file"}
+
+
+def _manual_value(text: str) -> tuple:
+    name, sep, value = text.partition("=")
+    if not sep or name not in HISTORY_PREFILL:
+        raise argparse.ArgumentTypeError(f"格式为 名称=数值，名称是 {'、'.join(HISTORY_PREFILL)} 之一")
+    try:
+        return name, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{name} 的值不是数字：{value}") from None
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="担保业务统计（命令行）")
+    parser.add_argument("--filter", help="筛选条件工作簿（业务分类、国企名单）")
+    parser.add_argument("--trad", help="传统台账")
+    parser.add_argument("--batch", help="批量台账")
+    parser.add_argument("--baohan", help="保函台账")
+    parser.add_argument("--daichang", help="代偿台账（需要同时给批量台账）")
+    parser.add_argument("--manifest", type=Path,
+                        help="多主体合并：主体清单（.csv / .xlsx），列为 主体、筛选条件、传统、批量、保函、代偿，"
+                             "可再加手填值列；给了就不用上面五个参数")
+    parser.add_argument("--as-of", required=True, type=pd.Timestamp, help="统计基准日期，如 2025-06-30")
+    parser.add_argument("--out", default=".", type=Path, help="输出目录（默认当前目录）")
+    parser.add_argument("--set", dest="manual", action="append", type=_manual_value, default=[],
+                        metavar="名称=数值",
+                        help="报表的手填值，可多次给；不给的从历史结果库带出，没有按 0（合并时给的是合并口径的值）")
+    parser.add_argument("--templates", action="store_true", help="同时填报 templates/ 目录里的监管报表模板")
+    parser.add_argument("--entity", default="",
+                        help="历史结果库里的主体（同页面上的“主体”）：只带出、保存这个主体的结果，默认不区分")
+    parser.add_argument("--no-history", action="store_true", help="不把报表结果存进历史结果库")
+    parser.add_argument("-q", "--quiet", action="store_true", help="只输出警告")
+    return parser
+
+
+def read_manifest(path: Path) -> dict:
+    """
+    主体清单 → {主体: (STAT_FILE_KEYS -> 路径, 手填值)}。每行一个主体，空着的台账不参与统计；
+    相对路径相对清单所在目录；HISTORY_PREFILL 里的列是该主体的手填值。
+    """
+    if path.suffix.lower() in (".xlsx", ".xlsm"):
+        df = pd.read_excel(path, dtype=object)
+    else:
+        df = pd.read_csv(path, dtype=object, encoding="utf-8-sig")   # Excel 另存的 CSV 带 BOM
+    df.columns = df.columns.astype(str).str.strip()
+    missing = [c for c in ["主体", "筛选条件"] if c not in df.columns]
+    if missing:
+        raise ValueError(f"主体清单缺少列：{'、'.join(missing)}")
+    entities = {}
+    for i, row in enumerate(df.to_dict("records"), start=2):
+        name = str(row["主体"]).strip() if pd.notna(row["主体"]) else ""
+        if not name:
+            continue
+        if name in entities:
+            raise ValueError(f"主体清单第 {i} 行：主体“{name}”重复")
+        paths = {}
+        for col, key in MANIFEST_FILES.items():
+            v = row.get(col)
+            if pd.notna(v) and str(v).strip():
+                p = Path(str(v).strip())
+                paths[key] = str(p if p.is_absolute() else path.parent / p)
+        manual = {}
+        for k in HISTORY_PREFILL:
+            v = pd.to_numeric(row.get(k), errors="coerce")
+            if pd.notna(v):
+                manual[k] = float(v)
+        entities[name] = (paths, manual)
+    if not entities:
+        raise ValueError("主体清单是空的")
+    return entities
+
+
+def result_json(run) -> dict:
+    """一个主体的 JSON 输出：各类统计结果、手填值、报表全部结果、到期未清零笔数。"""
+    return {
+        "inputs": run.signature,
+        "results": {key: {k: _cell(v) for k, v in run.results[key].items()}
+                    for key in RESULT_SHEETS if key in run.results},
+        "manual": run.manual,
+        "report": {k: _cell(v) for k, v in run.report.items()},
+        "overdue": {key: len(run.results[key]) for key in OVERDUE_SHEETS if key in run.results},
+    }
+
+
+def write_run(out: Path, prefix: str, as_of: pd.Timestamp, run, templates: bool) -> list:
+    """一个主体的明细工作簿 + （可选）填好的模板；返回写出的文件名。"""
+    name = f"{prefix}统计结果_{as_of:%Y%m%d}.xlsx"
+    (out / name).write_bytes(results_workbook(run.results, run.manual))
+    written = [name]
+    if templates and run.report:
+        for tpl in directory_templates():
+            if tpl.problems:
+                logging.warning("%s：%s", tpl.name, "；".join(tpl.problems))
+            if tpl.mapping:
+                name = f"{Path(tpl.name).stem}_{prefix}{as_of:%Y%m%d}.xlsx"
+                (out / name).write_bytes(tpl.fill(run.report))
+                written.append(name)
+    return written
+
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.manifest is None and not args.filter:
+        parser.error("需要 --filter（单个主体）或 --manifest（多主体合并）")
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO, format="%(message)s")
+
+    if args.manifest is not None:
+        try:
+            entities = read_manifest(args.manifest)
+        except (OSError, ValueError) as e:
+            logging.error("主体清单读不了：%s", e)
+            return 2
+        paths = [p for files, _ in entities.values() for p in files.values()]
+    else:
+        entities = None
+        paths = [p for p in (getattr(args, arg) for arg in FILE_ARGS.values()) if p]
+    missing = [p for p in paths if not Path(p).is_file()]
+    if missing:
+        logging.error("找不到文件：%s", "、".join(missing))
+        return 2
+
+    args.out.mkdir(parents=True, exist_ok=True)
+    date = f"{args.as_of:%Y%m%d}"
+    if entities is None:
+        history = None if args.no_history else ResultHistory()
+        run = run_pipeline({k: getattr(args, FILE_ARGS[k]) for k in STAT_FILE_KEYS}, args.as_of,
+                           manual=dict(args.manual), history=history, entity=args.entity.strip())
+        (args.out / f"统计结果_{date}.json").write_text(
+            json.dumps({"as_of": args.as_of.date().isoformat(), **result_json(run)}, ensure_ascii=False, indent=2),
+            encoding="utf-8")
+        written = [f"统计结果_{date}.json", *write_run(args.out, "", args.as_of, run, args.templates)]
+    else:
+        runs = run_consolidation(entities, args.as_of, manual=dict(args.manual))
+        (args.out / f"合并统计_{date}.json").write_text(json.dumps(
+            {"as_of": args.as_of.date().isoformat(), "entities": {name: result_json(run) for name, run in runs.items()}},
+            ensure_ascii=False, indent=2), encoding="utf-8")
+        (args.out / f"合并统计_{date}.xlsx").write_bytes(write_workbook({"全部结果": consolidation_frame(runs)}))
+        written = [f"合并统计_{date}.json", f"合并统计_{date}.xlsx"]
+        for name, run in runs.items():
+            prefix = re.sub(r'[\\/:*?"<>|]', "_", name) + "_"      # 主体名用在文件名里
+            written += write_run(args.out, prefix, args.as_of, run, args.templates)
+    logging.info("已写入 %s：%s", args.out, "、".join(written))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+台账 Excel 解析（不依赖 streamlit）。
+
+taizhang_pipeline.py 直接用这里的函数读表；并行读取时，进程池的子进程也 import 这个模块，
+所以这里只放纯函数：输入文件内容 / 路径和表名，输出 DataFrame。
+"""
+import re
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.cell.cell import ERROR_CODES
+from pandas.io.parsers import TextParser
+
+# 按需读列：台账上百列，规则/口径只用到其中几十列。openpyxl 逐行读取时只把要用的列
+# 转换后交给 pandas，其余列不进 DataFrame。要哪些列见 ledger_columns。
+LEDGER_KEEP_RE = re.compile(r"编号|名称|日期|时间|银行|机构|经办|备注")   # 明细表展示用的列，始终保留
+_XL_ERRORS = frozenset(ERROR_CODES)
+
+
+def _clean_names(names) -> pd.Index:
+    return (
+        pd.Index(names)
+        .str.replace(r"\s+", "", regex=True)
+        .str.replace(r"[（(]\s*(?:万元|%|元)\s*[）)]", "", regex=True)
+        .str.replace("（", "(", regex=False)
+        .str.replace("）", ")", regex=False)
+    )
+
+
+def _flatten_cols(multi_cols):
+    """多行表头拼成一行：去掉空白 / Unnamed 部分，用 _ 连接。"""
+    new_cols = []
+    for idx, col in enumerate(multi_cols):
+        parts = []
+        for piece in (col if isinstance(col, tuple) else (col,)):
+            s = str(piece).strip()
+            if (not s) or s.lower() == "nan" or s.startswith("Unnamed"):
+                continue
+            parts.append(s.replace("\u3000",""))  # 去全角空格
+        new_cols.append("_".join(parts) if parts else f"col_{idx}")
+    return new_cols
+
+
+def _xl_value(v):
+    """与 pandas 读 xlsx 一致：空单元格 → ""，#N/A 等错误值 → NaN，整数值的浮点 → int。"""
+    if v is None:
+        return ""
+    if type(v) is float:
+        return int(v) if v.is_integer() else v
+    if type(v) is str and v in _XL_ERRORS:
+        return np.nan
+    return v
+
+
+def _fill_header(rows: list) -> None:
+    """多行表头的向前填充（同 pandas 的 fill_mi_header：只在同一个上级表头范围内填）。"""
+    control = [True] * len(rows[0])
+    for row in rows:
+        last = row[0] if row else ""
+        for i in range(1, len(row)):
+            if not control[i]:
+                last = row[i]
+            if row[i] == "":
+                row[i] = last
+            else:
+                control[i] = False
+                last = row[i]
+
+
+def stream_sheet(stream, name: str, header, columns: frozenset):
+    """
+    openpyxl read_only 逐行读，只保留清洗后列名在 columns 里或匹配 LEDGER_KEEP_RE 的列。
+    结果与 xl.parse 后再取这些列相同；表头不够行、一列都没匹配上时返回 None，由调用方整表读取。
+    """
+    levels = [header] if isinstance(header, int) else list(header)
+    wb = load_workbook(stream, read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb[name]
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+
+        head = []
+        for row in rows:
+            head.append([_xl_value(v) for v in row])
+            if len(head) > max(levels):
+                break
+        if len(head) <= max(levels):
+            return None
+        width = max(len(r) for r in head)
+        head = [r + [""] * (width - len(r)) for r in head]
+        last = max((i for i, r in enumerate(head) if any(v != "" for v in r)), default=-1)
+        if isinstance(header, int):
+            names = [str(v) for v in head[header]]
+        else:
+            _fill_header([head[h] for h in levels])
+            names = _flatten_cols(list(zip(*(head[h] for h in levels))))
+        keep = [i for i, n in enumerate(_clean_names(names)) if n in columns or LEDGER_KEEP_RE.search(n)]
+        if not keep:
+            return None
+
+        data = [[r[i] for i in keep] for r in head]
+        for row in rows:
+            n = len(row)
+            vals = [_xl_value(row[i]) if i < n else "" for i in keep]
+            data.append(vals)
+            # 和 pandas 一样只裁掉末尾的空行；判断空行要看整行，不只看保留的列
+            if any(v != "" for v in vals) or any(v is not None and v != "" for v in row):
+                last = len(data) - 1
+        del data[last + 1:]
+        if len(data) <= max(levels):
+            return None
+    finally:
+        wb.close()
+    return TextParser(data, header=header, skip_blank_lines=False).read()
+
+
+def parse_sheet(open_stream, name: str, header, columns=None) -> pd.DataFrame:
+    """
+    读一张表。open_stream() 每次返回一个从头读的文件对象；给了 columns 先走 stream_sheet，
+    读不出来（返回 None）再整表 xl.parse。
+    """
+    df = None
+    if columns is not None:
+        df = stream_sheet(open_stream(), name, header, columns)
+    if df is None:
+        df = pd.ExcelFile(open_stream()).parse(sheet_name=name, header=header)
+    return df
+
+
+def parse_job(source, name: str, header, columns=None) -> pd.DataFrame:
+    """
+    进程池里跑的任务：source 是文件内容（bytes）或落盘文件的路径（str）。
+    返回的 DataFrame 由 concurrent.futures 序列化（pickle）传回主进程。
+    """
+    if isinstance(source, str):
+        return parse_sheet(lambda: open(source, "rb"), name, header, columns)
+    return parse_sheet(lambda: BytesIO(source), name, header, columns)
@@ -0,0 +1,2630 @@
+"""
+台账统计的计算部分（不依赖 streamlit）：读取清洗、指标引擎、规则与指标、多日期统计、报表公式、导出。
+
+zxy0730streamlit.py 的各页面从这里 import；命令行批量统计见 taizhang_cli.py。
+这里的缓存（解析缓存、筛选条件、进程池、报表公式）都是进程内的模块级对象，
+在 Streamlit 里跨 rerun、跨会话共用，作用同 st.cache_resource。
+"""
+import copy
+import functools
+import hashlib
+import inspect
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing, contextmanager
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.cell.cell import MergedCell
+
+from taizhang_io import LEDGER_KEEP_RE, _clean_names, _flatten_cols, parse_job, parse_sheet
+
+try:                      # 可选：有 pyarrow 才写 Parquet sidecar
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+try:                      # 可选：导出 Excel 用 xlsxwriter 逐行写，没有就用 openpyxl
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+logger = logging.getLogger("taizhang")
+
+
+# ===================== 提示 =====================
+# 读取、统计过程中的提示（loader 里的说明、警告、明细表）都走 notify：
+# 在 notify_to(sink) 里的调用交给 sink（后台统计线程记进当前步骤的日志），
+# 否则交给 set_notify_display 设置的显示函数（页面上直接显示），都没有时写 logging。
+_run_local = threading.local()
+_display = None
+
+
+def set_notify_display(fn) -> None:
+    """notify 没有 sink 时的显示函数，参数是 (级别, 文字, 明细表)。"""
+    global _display
+    _display = fn
+
+
+@contextmanager
+def notify_to(sink):
+    """这段代码（当前线程）里的 notify 都交给 sink。"""
+    prev = getattr(_run_local, "sink", None)
+    _run_local.sink = sink
+    try:
+        yield
+    finally:
+        _run_local.sink = prev
+
+
+def notify(msg: str, *, level: str = "info", frame: pd.DataFrame | None = None):
+    sink = getattr(_run_local, "sink", None)
+    if sink is not None:
+        sink((level, msg, frame))
+    elif _display is not None:
+        _display((level, msg, frame))
+    else:
+        logger.log(logging.WARNING if level == "warning" else logging.INFO, msg)
+
+
+# ===================== 进程内缓存 =====================
+def shared(max_entries: int | None = None):
+    """
+    进程内共用的对象，作用同 st.cache_resource：按参数缓存、线程安全，超过 max_entries 按 LRU 淘汰；
+    名字以 _ 开头的参数不进缓存键。被装饰的函数多一个 clear()。
+    """
+    def wrap(fn):
+        names = list(inspect.signature(fn).parameters)
+        items, lock = OrderedDict(), threading.Lock()
+
+        @functools.wraps(fn)
+        def get(*args):
+            key = tuple(a for n, a in zip(names, args) if not n.startswith("_"))
+            with lock:
+                if key in items:
+                    items.move_to_end(key)
+                    return items[key]
+                value = items[key] = fn(*args)
+                if max_entries is not None and len(items) > max_entries:
+                    items.popitem(last=False)
+                return value
+
+        def clear():
+            with lock:
+                items.clear()
+
+        get.clear = clear
+        return get
+    return wrap
+
+
+# ===================== 表选择、到期日 =====================
+# 到期日写成文字的情形，视为无穷远的日期（Timestamp.max）；遇到新的写法加到这里
+EXPIRY_TEXT_SENTINELS = ["无固定到期日", "保全解除之日"]
+
+def parse_expiry(s: pd.Series, sentinels=EXPIRY_TEXT_SENTINELS) -> tuple[pd.Series, list]:
+    """
+    到期日列整列转日期：能解析的照常解析，空值为 NaT，解析不了的（文字、超出范围的日期）视为 Timestamp.max。
+    返回 (日期列, 解析不了且不在 sentinels 里的原始文字)，后者供页面提示。
+    """
+    parsed = pd.to_datetime(s, errors="coerce", format="mixed")
+    failed = parsed.isna() & s.notna()
+    if not failed.any():
+        return parsed, []
+    parsed[failed] = pd.Timestamp.max
+    raw = s[failed]
+    text = raw[~raw.map(lambda v: isinstance(v, datetime))].astype(str).str.strip()
+    unknown = text[(text != "") & ~text.isin(list(sentinels))].unique().tolist()
+    return parsed, unknown
+
+def expiry_dates(s: pd.Series) -> pd.Series:
+    """规则里用：已在读取时转好的列直接返回，否则现场转换。"""
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s
+    return parse_expiry(s)[0]
+def extractsheet_taizhang(xl: pd.ExcelFile) -> str:
+    for name in xl.sheet_names:
+        if ("台账" in name) or ("总台账" in name):
+            return name
+    return xl.sheet_names[0]
+def extractsheet(xl: pd.ExcelFile) -> str:
+    """直接返回第一张表名"""
+    return xl.sheet_names[0]
+def extractsheet_baohan(xl: pd.ExcelFile) -> str:
+    for name in xl.sheet_names:
+        if ("保函" in name) or ("非融" in name):
+            return name
+    return xl.sheet_names[0]
+def extractsheet_daichang(xl: pd.ExcelFile) -> str:
+    for name in xl.sheet_names:
+        if ("代偿" in name):
+            return name
+    return xl.sheet_names[0]
+def _clean_columns(df: pd.DataFrame) -> pd.DataFrame:
+    df.columns = _clean_names(df.columns)
+    return df
+
+
+# ===================== 指标引擎 =====================
+
+def _as_mask(x, n: int) -> np.ndarray:
+    """规则返回值 → 长度为 n 的布尔数组；NaN 视为 False（与原先 & 链的结果一致）。"""
+    if isinstance(x, pd.Series):
+        if x.dtype == bool:
+            return x.to_numpy()
+        return x.fillna(False).astype(bool).to_numpy()
+    arr = np.asarray(x)
+    if arr.ndim == 0:
+        return np.full(n, bool(arr))
+    return arr.astype(bool)
+
+
+class MetricEngine:
+    """
+    指标引擎：同一张表上每条 RULES 只求值一次，缓存成 NumPy 布尔数组；
+    规则组合按前缀记忆化（如 批量∧当年 只算一次），所有指标共用。
+    用法:
+        res = MetricEngine(df, RULES, AGG_MAP_BATCH).run(metrics)
+    指标名仍是 "规则_规则_…_聚合"，结果与逐个 reduce(&) 计算完全一致。
+    """
+
+    def __init__(self, df: pd.DataFrame, rules: dict, agg_map: dict):
+        self.df = df
+        self.rules = rules
+        self.agg_map = agg_map
+        self.n = len(df)
+        self._rule_masks: dict[str, np.ndarray] = {}
+        self._prefix_masks: dict[tuple, np.ndarray] = {}
+        self._rank: dict[str, int] = {}
+        self._groups: dict[str, tuple] = {}
+        self._distinct: dict[str, int] = {}
+
+    @staticmethod
+    def parse(name: str):
+        *keys, agg = name.split("_")
+        return keys, agg
+
+    def plan(self, names) -> None:
+        """按规则在指标列表中的出现频次排序：高频规则放前面，前缀能被更多指标共用。"""
+        freq: dict[str, int] = {}
+        for name in names:
+            for k in dict.fromkeys(self.parse(name)[0]):
+                freq[k] = freq.get(k, 0) + 1
+        ordered = sorted(freq, key=lambda k: -freq[k])   # sorted 稳定：同频按首次出现
+        self._rank = {k: i for i, k in enumerate(ordered)}
+
+    def rebind(self, rules: dict, changed) -> "MetricEngine":
+        """换一套规则（如统计基准日期变了）：changed 里的规则及包含它们的组合作废，其余缓存保留。"""
+        changed = set(changed)
+        self.rules = rules
+        for k in changed:
+            self._rule_masks.pop(k, None)
+        self._prefix_masks = {ks: m for ks, m in self._prefix_masks.items() if changed.isdisjoint(ks)}
+        self._distinct = {}
+        return self
+
+    def copy(self) -> "MetricEngine":
+        """
+        另一个线程用的副本：已算好的掩码、客户编码照用（数组只读），缓存 dict 各自一份，
+        之后两边各自 rebind、各自往缓存里写，互不影响。
+        """
+        other = copy.copy(self)
+        for attr in ("_rule_masks", "_prefix_masks", "_rank", "_groups", "_distinct"):
+            setattr(other, attr, dict(getattr(self, attr)))
+        return other
+
+    def rule_mask(self, key: str) -> np.ndarray:
+        m = self._rule_masks.get(key)
+        if m is None:
+            m = _as_mask(self.rules[key](self.df), self.n)
+            self._rule_masks[key] = m
+        return m
+
+    def mask(self, keys) -> np.ndarray:
+        """规则交集；AND 与顺序无关，先规整顺序再按前缀查缓存。"""
+        keys = tuple(sorted(dict.fromkeys(keys), key=lambda k: self._rank.get(k, len(self._rank))))
+        if not keys:
+            return np.ones(self.n, dtype=bool)
+        return self._prefix(keys)
+
+    def _prefix(self, keys: tuple) -> np.ndarray:
+        m = self._prefix_masks.get(keys)
+        if m is None:
+            if len(keys) == 1:
+                m = self.rule_mask(keys[0])
+            else:
+                m = self._prefix(keys[:-1]) & self.rule_mask(keys[-1])
+            self._prefix_masks[keys] = m
+        return m
+
+    def _code_groups(self, col: str) -> tuple:
+        """col factorize 一次；返回 (按编码排好序的行号, 每个编码的起始位置)。NaN 行不参与。"""
+        g = self._groups.get(col)
+        if g is None:
+            codes, _ = pd.factorize(self.df[col])
+            order = np.flatnonzero(codes >= 0)
+            order = order[np.argsort(codes[order], kind="stable")]
+            sorted_codes = codes[order]
+            starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]) if len(order) else order
+            g = self._groups[col] = (order, starts)
+        return g
+
+    def distinct_counts(self, col: str, masks) -> np.ndarray:
+        """
+        多个掩码下 col 的去重个数（= nunique）。每 64 个掩码打包成行级 uint64 位集，
+        按编码分组做一次 bitwise_or.reduceat，得到每个客户出现在哪些掩码里，再按位计数。
+        """
+        order, starts = self._code_groups(col)
+        out = np.zeros(len(masks), dtype=np.int64)
+        if len(order) == 0:
+            return out
+        for i in range(0, len(masks), 64):
+            block = masks[i:i + 64]
+            packed = np.packbits(np.stack(block), axis=0, bitorder="little")   # ceil(k/8) × 行
+            word = np.zeros((self.n, 8), dtype=np.uint8)
+            word[:, :len(packed)] = packed.T
+            seen = np.bitwise_or.reduceat(word.view(np.uint64).ravel()[order], starts)
+            bits = np.unpackbits(seen.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+            out[i:i + len(block)] = bits.sum(axis=0)[:len(block)]
+        return out
+
+    def value(self, name: str):
+        keys, agg = self.parse(name)
+        hit = self._distinct.get(name)
+        return hit if hit is not None else self.aggregate(self.agg_map[agg], self.mask(keys))
+
+    def aggregate(self, mapper, mask: np.ndarray):
+        """按 AGG_MAP 里的口径聚合掩码选中的行。"""
+        if callable(mapper):
+            return mapper(self.df[mask])
+        col, how = mapper
+        if how == "sum":
+            return self.df[col][mask].sum()
+        if how == "count":
+            return int(mask.sum())
+        if how == "nunique":
+            return int(self.distinct_counts(col, [mask])[0])
+
+    def run(self, names) -> dict:
+        self.plan(names)
+        # 户数类指标按去重列归组，一次批量算完
+        pending: dict[str, list] = {}
+        for name in names:
+            mapper = self.agg_map[self.parse(name)[1]]
+            if not callable(mapper) and mapper[1] == "nunique":
+                pending.setdefault(mapper[0], []).append(name)
+        for col, group in pending.items():
+            group = list(dict.fromkeys(group))
+            counts = self.distinct_counts(col, [self.mask(self.parse(n)[0]) for n in group])
+            self._distinct.update(zip(group, map(int, counts)))
+        return {name: self.value(name) for name in names}
+
+
+class BitmaskCube(MetricEngine):
+    """
+    单次分组归约模式：把指标用到的每条规则打包成行级整数位掩码，
+    按不同的位掩码值分组一次，求出各组的 sum / count / 去重客户；
+    笔数、户数类指标只是在“组”上做一次位运算筛选，不再扫描整张台账。
+    金额类指标由选中的组还原出行掩码，照 MetricEngine 对原列求和，结果逐位相同。
+    """
+    MAX_RULES = 63
+
+    def run(self, names) -> dict:
+        keys = list(dict.fromkeys(k for name in names for k in self.parse(name)[0]))
+        if len(keys) > self.MAX_RULES:
+            return super().run(names)
+        bits = np.zeros(self.n, dtype=np.uint64)
+        self._bit = {}
+        for i, k in enumerate(keys):
+            self._bit[k] = np.uint64(1) << np.uint64(i)
+            bits |= self.rule_mask(k).astype(np.uint64) << np.uint64(i)
+        self._cells, self._inv = np.unique(bits, return_inverse=True)
+        self._inv = self._inv.ravel()
+        self._counts = np.bincount(self._inv, minlength=len(self._cells))
+        self._pairs: dict[str, tuple] = {}
+        return {name: self.cube_value(name) for name in names}
+
+    def _cell_codes(self, col: str):
+        """(组号, 去重值编码) 的去重对；NaN 不计入户数（同 nunique）。"""
+        p = self._pairs.get(col)
+        if p is None:
+            codes, uniques = pd.factorize(self.df[col])
+            keep = codes >= 0
+            width = max(len(uniques), 1)
+            pair = np.unique(self._inv[keep].astype(np.int64) * width + codes[keep])
+            p = (pair // width, pair % width)
+            self._pairs[col] = p
+        return p
+
+    def cube_value(self, name: str):
+        keys, agg = self.parse(name)
+        mapper = self.agg_map[agg]
+        if callable(mapper):
+            return self.value(name)    # 自定义聚合需要明细行，回退到掩码模式
+        need = np.uint64(0)
+        for k in keys:
+            need |= self._bit[k]
+        sel = (self._cells & need) == need
+        col, how = mapper
+        if how == "sum":
+            # 组内和再相加会带来浮点舍入差异；按行掩码对原列求和，与 MetricEngine 一致
+            return self.aggregate(mapper, sel[self._inv])
+        if how == "count":
+            return int(self._counts[sel].sum())
+        if how == "nunique":
+            cell, code = self._cell_codes(col)
+            return len(np.unique(code[sel[cell]]))
+
+
+# calc_*_metrics(engine=...) 可选的求值方式
+METRIC_ENGINES = {"mask": MetricEngine, "cube": BitmaskCube}
+LEDGER_ENGINE = os.environ.get("TAIZHANG_ENGINE", "mask")   # 执行统计用哪种；换别的先跑 tests/bench_engines.py 比一比
+
+# ===================== 数据读取 =====================
+
+# 解析缓存：按上传内容的 SHA-256 + 表选择 + 表头行 + 读取版本号 缓存 xl.parse 结果，
+# 同一份文件重复“执行统计”（例如只改了统计基准日期）时不再重新跑 openpyxl。
+LOADER_VERSION = 7                  # 读取/清洗逻辑有变化时 +1，旧缓存自动失效
+PARSE_CACHE_MAX_BYTES = 512 << 20   # 进程内解析缓存上限（约 512MB），超出按 LRU 淘汰
+
+
+def file_sha256(file_obj) -> str:
+    """上传文件内容的 SHA-256（结果记在对象上，同一个 BytesIO 只算一次）。"""
+    sha = getattr(file_obj, "_sha256", None)
+    if sha is None:
+        with file_obj.getbuffer() as buf:
+            sha = hashlib.sha256(buf).hexdigest()
+        try:
+            file_obj._sha256 = sha
+        except AttributeError:
+            pass
+    return sha
+
+
+def upload_stream(file_obj):
+    """从头读的文件对象：UploadHandle 不复制内容；其他（BytesIO、UploadedFile）照旧复制一份。"""
+    if hasattr(file_obj, "open"):
+        return file_obj.open()
+    return BytesIO(file_obj.getvalue())
+
+
+def _frame_nbytes(df: pd.DataFrame) -> int:
+    """估算 DataFrame 占用；object 列按前 1000 个值的平均大小外推，避免 deep=True 逐个计算。"""
+    total = int(df.memory_usage(index=True, deep=False).sum())
+    for col in df.columns[df.dtypes == object]:
+        sample = df[col].iloc[:1000]
+        if len(sample):
+            total += int(sum(sys.getsizeof(v) for v in sample) / len(sample) * len(df))
+    return total
+
+
+class ParseCache:
+    """线程安全的 LRU 缓存，按字节数上限淘汰；存进去的 DataFrame 不会被外部改动。"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict = OrderedDict()   # key -> (df, nbytes)
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is None:
+                return None
+            self._items.move_to_end(key)
+            return hit[0]
+
+    def put(self, key, df: pd.DataFrame) -> None:
+        nbytes = _frame_nbytes(df)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._used -= old[1]
+            self._items[key] = (df, nbytes)
+            self._used += nbytes
+            while self._used > self.max_bytes and self._items:
+                _, (_, n) = self._items.popitem(last=False)
+                self._used -= n
+
+
+@shared()
+def _parse_cache() -> ParseCache:
+    # 跨 rerun、跨会话共用同一个缓存对象
+    return ParseCache(PARSE_CACHE_MAX_BYTES)
+
+
+def workbook_sheets(file_obj) -> list:
+    """工作簿里的表名。只读 workbook 目录，不解析单元格；结果记在对象上。"""
+    names = getattr(file_obj, "_sheet_names", None)
+    if names is None:
+        wb = load_workbook(upload_stream(file_obj), read_only=True, keep_links=False)
+        names = [ws.title for ws in wb.worksheets]
+        wb.close()
+        try:
+            file_obj._sheet_names = names
+        except AttributeError:
+            pass
+    return names
+
+
+def sheet_name(file_obj, sheet) -> str:
+    """表名或选择函数 → 实际表名。"""
+    if isinstance(sheet, str):
+        return sheet
+    return sheet(SimpleNamespace(sheet_names=workbook_sheets(file_obj)))
+
+
+def _parse_key(file_obj, sheet, header, wanted) -> tuple:
+    selector = sheet if isinstance(sheet, str) else sheet.__name__
+    return (file_sha256(file_obj), selector, str(header),
+            None if wanted is None else tuple(sorted(wanted)), LOADER_VERSION)
+
+
+def read_sheet(file_obj, sheet, *, header=0, columns=None) -> pd.DataFrame:
+    """
+    带缓存的 xl.parse。sheet 可以是表名，也可以是 extractsheet_xxx 这类选择函数。
+    columns：只读这些列（清洗后的列名），给了就走 openpyxl 流式读取（见 taizhang_io.stream_sheet）。
+    返回副本，调用方可以随意改列。
+    """
+    wanted = None if columns is None else frozenset(columns)
+    key = _parse_key(file_obj, sheet, header, wanted)
+    cache = _parse_cache()
+    df = cache.get(key)
+    if df is None:
+        df = parse_sheet(lambda: upload_stream(file_obj), sheet_name(file_obj, sheet), header, wanted)
+        cache.put(key, df)
+    return df.copy()
+
+
+# 列式副本（sidecar）：清洗、补充业务分类之后的台账写一份 Parquet 到本地，
+# 之后的运行、其他用户只要源文件哈希没变就直接读 Parquet（毫秒级），不再走 openpyxl。
+# 文件名里带源文件哈希 + LOADER_VERSION，源文件一变自然换新文件；没装 pyarrow 时自动跳过。
+# 读取时 notify 的提示（到期日无法识别、业务分类重复…）另存一份 .notices.pkl，读 sidecar 时照样提示。
+SIDECAR_DIR = Path(os.environ.get("TAIZHANG_CACHE_DIR", Path(__file__).resolve().parent / ".taizhang_cache"))
+SIDECAR_MAX_FILES = 200             # 超过后按修改时间删最旧的
+
+
+def _sidecar_path(kind: str, sources, extra: str = "") -> Path:
+    parts = [kind, str(LOADER_VERSION), extra] + [file_sha256(f) for f in sources]
+    key = hashlib.sha256("|".join(parts).encode()).hexdigest()[:32]
+    return SIDECAR_DIR / f"{kind}-{key}.parquet"
+
+
+def _arrow_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """Excel 里常见数字、文字混填的 object 列，Arrow 写不进去：这些列里的非文本值转成文本。"""
+    out = df
+    for col in df.columns[df.dtypes == object]:
+        try:
+            pa.array(df[col], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            if out is df:
+                out = df.copy(deep=False)
+            out[col] = df[col].map(lambda v: v if isinstance(v, str) or pd.isna(v) else str(v))
+    return out
+
+
+def _read_sidecar(path: Path) -> pd.DataFrame:
+    df = pd.read_parquet(path)
+    # Parquet 读回来的 object 列空值是 None，换回 NaN，和 read_excel 的结果保持一致
+    for col in df.columns[df.dtypes == object]:
+        s = df[col]
+        if s.isna().any():
+            df[col] = s.where(s.notna(), np.nan)
+    return df
+
+
+def _notices_path(path: Path) -> Path:
+    return path.with_suffix(".notices.pkl")
+
+
+def _read_notices(path: Path) -> list:
+    """sidecar 对应的读取提示 [(级别, 文字, 明细表)]；文件没有（旧版本写的 sidecar）时报错，按没有 sidecar 处理。"""
+    with open(_notices_path(path), "rb") as f:
+        return pickle.load(f)
+
+
+def _write_sidecar(path: Path, df: pd.DataFrame, notices: list) -> None:
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_notices = tmp.with_suffix(".notices.tmp")
+    try:
+        SIDECAR_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_notices.write_bytes(pickle.dumps(notices))
+        os.replace(tmp_notices, _notices_path(path))     # 提示先落盘：有 parquet 就一定有提示
+        _arrow_safe(df).to_parquet(tmp)
+        os.replace(tmp, path)                 # 原子替换，并发写同一个文件也不会读到半截
+    except Exception:
+        # 写不了（只读目录、重复列名等）就当没有 sidecar，不影响统计
+        tmp.unlink(missing_ok=True)
+        tmp_notices.unlink(missing_ok=True)
+        return
+    files = sorted(SIDECAR_DIR.glob("*.parquet"), key=lambda f: f.stat().st_mtime)
+    for old in files[:-SIDECAR_MAX_FILES]:
+        old.unlink(missing_ok=True)
+        _notices_path(old).unlink(missing_ok=True)
+
+
+def load_cached(kind: str, sources, build, *args, extra: str = "", **kwargs) -> pd.DataFrame:
+    """
+    先找 sidecar，没有再调 build(*args, **kwargs) 读 Excel 并写 sidecar。
+    sources：决定结果的上传文件（台账、筛选条件…），它们的哈希组成缓存键。
+    build 里 notify 的提示随 sidecar 保存，读 sidecar 时重新 notify，两条路径看到的提示一样。
+    """
+    if pa is None:
+        return build(*args, **kwargs)
+    path = _sidecar_path(kind, sources, extra)
+    if path.exists():
+        try:
+            df, notices = _read_sidecar(path), _read_notices(path)
+        except Exception:
+            path.unlink(missing_ok=True)
+        else:
+            _replay(notices)
+            return df
+    notices = []
+    try:
+        with notify_to(notices.append):
+            df = build(*args, **kwargs)
+    finally:
+        _replay(notices)                      # 读取出错时，出错前的提示也照常给出
+    _write_sidecar(path, df, notices)
+    return df
+
+
+def _replay(notices: list) -> None:
+    for level, msg, frame in notices:
+        notify(msg, level=level, frame=frame)
+
+
+# 报表页“以前的数据”输入框 ← 历史结果里的指标（上月_… 取上月末，上一年_… 取上年末）
+HISTORY_PREFILL = {
+    "上月_在保_在保余额": "在保余额",
+    "上一年_在保_在保余额": "在保余额",
+    "上一年_在保_责任余额": "实际在保余额",
+}
+
+
+# 历史结果库：每次出的分类汇总总表（final_all_res）按 主体 + 统计基准日期 + 输入文件签名 存进本地 SQLite，
+# 报表页据此自动带出同一主体上月末/上年末的数，也能按指标查历次结果做环比。写不了库时静默跳过。
+# 几家子公司共用一个库时靠“主体”区分；输入文件签名每期都不同，不能用来找上一期。
+HISTORY_DB = SIDECAR_DIR / "history.sqlite"
+
+
+class ResultHistory:
+    """
+    历次统计结果。runs 记每次保存的主体和时间；results 每个指标一行，(metric, as_of) 建了索引。
+    查询都限定一个主体（entity，默认 ""）；同一主体、同一基准日期存过多份输入时，取最后保存的那一份。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            as_of TEXT NOT NULL, input_sig TEXT NOT NULL, saved_at TEXT NOT NULL, entity TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (as_of, input_sig));
+        CREATE TABLE IF NOT EXISTS results (
+            as_of TEXT NOT NULL, input_sig TEXT NOT NULL, metric TEXT NOT NULL, value REAL,
+            PRIMARY KEY (as_of, input_sig, metric));
+        CREATE INDEX IF NOT EXISTS results_metric ON results (metric, as_of);
+    """
+    # 每个基准日期只取一份：INSERT OR REPLACE 每次都换新的 rowid，rowid 最大的就是最后保存的
+    # （saved_at 只到秒，同一秒存两份会并列）
+    LATEST = ("runs.rowid = (SELECT MAX(x.rowid) FROM runs x "
+              "WHERE x.as_of = runs.as_of AND x.entity = runs.entity) AND runs.entity = ?")
+
+    def __init__(self, path: Path = HISTORY_DB):
+        self.path = Path(path)
+
+    def _connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(self.path, timeout=10)
+        con.executescript(self.SCHEMA)
+        if "entity" not in {row[1] for row in con.execute("PRAGMA table_info(runs)")}:
+            # 早先建的库没有主体列，原有记录归到默认主体
+            con.execute("ALTER TABLE runs ADD COLUMN entity TEXT NOT NULL DEFAULT ''")
+        return con
+
+    def save(self, as_of, input_sig: str, res: dict, entity: str = "") -> bool:
+        day = pd.Timestamp(as_of).date().isoformat()
+        rows = [(day, input_sig, str(k), float(v)) for k, v in res.items() if pd.notna(v)]
+        try:
+            with closing(self._connect()) as con, con:
+                con.execute("DELETE FROM results WHERE as_of = ? AND input_sig = ?", (day, input_sig))
+                con.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", rows)
+                con.execute("INSERT OR REPLACE INTO runs (as_of, input_sig, saved_at, entity) VALUES (?, ?, ?, ?)",
+                            (day, input_sig, datetime.now().isoformat(timespec="seconds"), entity))
+        except (sqlite3.Error, OSError):
+            return False
+        return True
+
+    def lookup(self, as_of, metrics, entity: str = "") -> dict:
+        """该主体某个基准日期（最后保存的一份）结果里的这些指标；没有的指标不出现在结果里。"""
+        metrics = list(metrics)
+        if not self.path.exists() or not metrics:
+            return {}
+        sql = (f"SELECT r.metric, r.value FROM results r JOIN runs USING (as_of, input_sig) "
+               f"WHERE r.as_of = ? AND r.metric IN ({','.join('?' * len(metrics))}) AND {self.LATEST}")
+        try:
+            with closing(self._connect()) as con:
+                return dict(con.execute(sql, [pd.Timestamp(as_of).date().isoformat(), *metrics, entity]).fetchall())
+        except (sqlite3.Error, OSError):
+            return {}
+
+    def series(self, metrics, entity: str = "") -> pd.DataFrame:
+        """该主体这些指标的历次结果（基准日期 × 指标），每个日期取最后保存的一份。"""
+        metrics = list(metrics)
+        if not self.path.exists() or not metrics:
+            return pd.DataFrame(columns=metrics)
+        sql = (f"SELECT r.as_of, r.metric, r.value FROM results r JOIN runs USING (as_of, input_sig) "
+               f"WHERE r.metric IN ({','.join('?' * len(metrics))}) AND {self.LATEST}")
+        try:
+            with closing(self._connect()) as con:
+                df = pd.read_sql_query(sql, con, params=[*metrics, entity])
+        except (sqlite3.Error, OSError):
+            return pd.DataFrame(columns=metrics)
+        df["as_of"] = pd.to_datetime(df["as_of"]).dt.date
+        out = df.pivot(index="as_of", columns="metric", values="value").sort_index()
+        return out.reindex(columns=[m for m in metrics if m in out.columns]).rename_axis("统计基准日期")
+
+    def dates(self, entity: str = "") -> list:
+        if not self.path.exists():
+            return []
+        try:
+            with closing(self._connect()) as con:
+                rows = con.execute("SELECT DISTINCT as_of FROM runs WHERE entity = ? ORDER BY as_of", (entity,))
+                return [pd.Timestamp(d).date() for (d,) in rows]
+        except (sqlite3.Error, OSError):
+            return []
+
+
+# 筛选条件：业务分类 + 国企名单，每份文件只解析一次；台账按业务品种逐列 map 补充分类，不做整表 merge
+class ReferenceData:
+    """筛选条件工作簿的解析结果。对象在会话间共用，只读。"""
+
+    def __init__(self, df_map: pd.DataFrame, gov_names=None):
+        df_map = df_map.copy()
+        df_map["业务品种"] = df_map["业务品种"].astype(str).str.strip()
+        dup = df_map["业务品种"].duplicated()
+        self.columns = list(df_map.columns)
+        self.dup_keys = list(df_map.loc[dup, "业务品种"].unique())
+        self.by_key = df_map[~dup].set_index("业务品种")
+        self.gov_names = None if gov_names is None else frozenset(gov_names)
+
+    def enrich(self, df: pd.DataFrame, key: pd.Series) -> pd.DataFrame:
+        """按 key（去空格后的业务品种）补上台账里没有的业务分类列；台账已有的同名列不动。"""
+        if self.dup_keys:
+            notify(f"业务分类中以下业务品种重复，按第一行取值：{'、'.join(self.dup_keys[:10])}", level="warning")
+        for col in self.columns:
+            if col in df.columns:
+                continue
+            if col == "业务品种":
+                df[col] = key.where(key.isin(self.by_key.index))
+            else:
+                df[col] = key.map(self.by_key[col])
+        return df
+
+
+@shared(max_entries=16)
+def _reference_data(sha: str, version: int, _filter_file) -> ReferenceData:
+    gov_names = None
+    if "国企名单" in workbook_sheets(_filter_file):
+        gov_names = read_sheet(_filter_file, "国企名单")["客户名称"].astype(str).str.strip()
+    return ReferenceData(read_sheet(_filter_file, "业务分类"), gov_names)
+
+
+def reference_data(filter_file) -> ReferenceData:
+    """筛选条件 → ReferenceData，按文件内容哈希缓存。"""
+    return _reference_data(file_sha256(filter_file), LOADER_VERSION, filter_file)
+
+
+# 取值不多的分类文字列存成 Categorical（整数编码 + 取值表）：规则里的 ==/isin 比的是编码，
+# 放在 session_state 里的台账也小得多。只转白名单里的列，且取值个数要过 compact_ledger 的检查。
+CATEGORICAL_COLUMNS = [
+    "企业类别", "企业划型", "业务品种", "业务品种2", "业务品种3", "风险等级", "国企民企",
+    "是否已解保", "债务人类别", "所属行业(工)", "新增/续贷", "公司责任风险比例",
+    "政策扶持领域", "债务人经营主体经济成分", "担保产品", "备案状态",
+]
+CATEGORY_MAX_LEVELS = 1000
+
+
+def compact_ledger(df: pd.DataFrame) -> pd.DataFrame:
+    """CATEGORICAL_COLUMNS 里的纯文字列 → category；取值过多（超过上限或一半行数）的列保持原样。"""
+    for col in CATEGORICAL_COLUMNS:
+        if col not in df.columns:
+            continue
+        s = df[col]
+        if not isinstance(s, pd.Series) or s.dtype != object:
+            continue
+        if pd.api.types.infer_dtype(s, skipna=True) != "string":
+            continue   # 数字、文字混填的列不动
+        n = s.nunique()
+        if n <= CATEGORY_MAX_LEVELS and 2 * n <= len(s):
+            df[col] = s.astype("category")
+    return df
+
+
+# 各台账读哪张表、表头在第几行（loader 和并行读取 ledger_parse_requests 共用）
+LEDGER_SHEETS = {
+    "baohan": (extractsheet_baohan, [2, 3]),
+    "batch": (extractsheet, 0),             # 批量指标用的表（筛 业务品种2 == 批量）
+    "batch2": (extractsheet_taizhang, 0),   # 全量批量台账，代偿匹配用
+    "trad": (extractsheet_taizhang, 2),
+    "daichang": (extractsheet_daichang, 4),
+}
+
+
+def _load_baohan_inline(file_obj) -> pd.DataFrame:
+    sheet, header = LEDGER_SHEETS["baohan"]
+    df = read_sheet(file_obj, sheet, header=header, columns=ledger_columns("baohan"))
+    df.columns = _flatten_cols(df.columns)
+    df = _clean_columns(df)
+    if "合同到期时间" in df.columns:
+        df["合同到期时间"], unknown = parse_expiry(df["合同到期时间"])
+        if unknown:
+            notify(f"保函合同到期时间无法识别，按长期有效处理：{'、'.join(map(str, unknown[:10]))}", level="warning")
+    return compact_ledger(df)  # ← 关键：返回 DataFrame
+
+# 未备案批量台账（新格式）→ 已备案台账（旧格式）的列名映射
+NEW_BATCH_COL_MAP = {
+    "放款日期": "主债权起始日期",
+    "放款到期日": "主债权到期日期",
+    "放款金额": "主债权金额",
+    "年化担保费率": "担保年费率",
+    "客户名称": "债务人名称",
+    "分险比例-放款机构": "分险比例(债权人)",
+    "项目阶段": "是否已解保",
+    "业务状态": "备案状态",
+    "放款机构": "债权人名称",
+}
+
+def convert_new_batch_to_old_format(df: pd.DataFrame) -> pd.DataFrame:
+    # 定义新旧列名的映射关系
+    col_map = NEW_BATCH_COL_MAP
+    # 只重命名存在的列
+    df = df.rename(columns={k: v for k, v in col_map.items() if k in df.columns})
+    df = df.drop(columns=["责任余额"])
+    df["分险比例(直担)"] = 100-df["分险比例(债权人)"]
+    return df
+
+def build_batch_ledger(ledger_file, filter_file, sheet, *, header_row: int = 0) -> pd.DataFrame:
+    """批量台账读取 + 清洗：合并业务分类、未备案台账转换、派生 责任余额/在保余额/实际放款/担保费。不做批量筛选。"""
+    ref = reference_data(filter_file)
+
+    df_batch = read_sheet(ledger_file, sheet, header=header_row, columns=ledger_columns("batch", ref.columns))
+
+    df_batch = _clean_columns(df_batch)
+
+    df_batch["担保产品"] = df_batch["担保产品"].astype(str).str.strip()
+    # 按担保产品补充业务分类的列（业务品种2、业务品种3…）
+    df_batch = ref.enrich(df_batch, df_batch["担保产品"])
+
+    if "分险比例-放款机构" in df_batch.columns:
+        notify("转换未备案的批量台账")
+        df_batch = convert_new_batch_to_old_format(df_batch)
+    else:
+        notify("本次统计已备案的批量台账")
+    df_batch = df_batch.rename(columns={"在保余额": "名义在保余额"})
+    df_batch["责任余额"] = 0.01 * (
+        df_batch["分险比例(直担)"]
+        - df_batch["分险比例-国担"]
+        - df_batch["分险比例-市再担保"]
+        - df_batch["分险比例-省再担保"]
+        - df_batch["分险比例-其他"]
+    ) * df_batch["名义在保余额"]
+    df_batch["在保余额"] = (1 - 0.01 * df_batch["分险比例(债权人)"]) * df_batch["名义在保余额"]
+    df_batch["实际放款"] = (1 - 0.01 * df_batch["分险比例(债权人)"]) * df_batch["主债权金额"]
+
+    df_batch["担保费"] = df_batch["主债权金额"] * 0.01 * df_batch["担保年费率"]
+    df_batch["主债权起始日期"] = pd.to_datetime(df_batch["主债权起始日期"], errors="coerce")
+    df_batch["主债权到期日期"] = pd.to_datetime(df_batch["主债权到期日期"], errors="coerce")
+    return compact_ledger(df_batch)
+
+def select_batch(df_batch: pd.DataFrame) -> pd.DataFrame:
+    """只留 业务品种2 == 批量 的行（批量指标、到期检查用）。"""
+    if "业务品种2" in df_batch.columns:
+        return df_batch[df_batch["业务品种2"] == "批量"]
+    notify("未找到 '业务品种2' 列，已跳过批量筛选。", level="warning")
+    return df_batch
+
+def load_batch_data(ledger_file, filter_file, *, header_row: int = LEDGER_SHEETS["batch"][1]) -> pd.DataFrame:
+    return select_batch(build_batch_ledger(ledger_file, filter_file, LEDGER_SHEETS["batch"][0], header_row=header_row))
+
+def load_batch2_data(ledger_file, filter_file, *, header_row: int = LEDGER_SHEETS["batch2"][1]) -> pd.DataFrame:
+    # 不筛选的全量批量台账，代偿匹配用
+    return build_batch_ledger(ledger_file, filter_file, LEDGER_SHEETS["batch2"][0], header_row=header_row)
+
+def _same_batch_sheet(ledger_file) -> bool:
+    return sheet_name(ledger_file, LEDGER_SHEETS["batch"][0]) == sheet_name(ledger_file, LEDGER_SHEETS["batch2"][0])
+
+def load_batch_frames(ledger_file, filter_file) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    返回 (df_batch, df_batch2)。两个表选择函数通常指向同一张表，
+    这时只读一遍、清洗一遍，df_batch 直接从 df_batch2 筛出来。
+    """
+    sources = [ledger_file, filter_file]
+    df_batch2 = load_cached("batch2", sources, load_batch2_data, ledger_file, filter_file)
+    if _same_batch_sheet(ledger_file):
+        df_batch = select_batch(df_batch2)
+    else:
+        df_batch = load_cached("batch", sources, load_batch_data, ledger_file, filter_file)
+    return df_batch, df_batch2
+
+def load_trad_data(ledger_file, filter_file, *, header_row: int = LEDGER_SHEETS["trad"][1]) -> pd.DataFrame:
+    ref = reference_data(filter_file)
+    if ref.gov_names is None:
+        raise ValueError("筛选条件中没有“国企名单”表")
+    df_taizhang = read_sheet(ledger_file, LEDGER_SHEETS["trad"][0], header=header_row,
+                             columns=ledger_columns("trad", ref.columns))
+    df_taizhang = _clean_columns(df_taizhang)
+
+    df_taizhang["客户名称"] = df_taizhang["客户名称"].astype(str).str.strip()
+    df_taizhang["业务品种"] = df_taizhang["业务品种"].astype(str).str.strip()
+    df_taizhang["国企民企"] = np.where(
+        df_taizhang["客户名称"].isin(ref.gov_names) | (df_taizhang["业务品种"] == "委托贷款"),
+        "国企",
+        "民企",
+    )
+    df_taizhang = ref.enrich(df_taizhang, df_taizhang["业务品种"])
+    df_taizhang = df_taizhang[df_taizhang["业务品种2"] == "传统"]
+    df_taizhang = df_taizhang.rename(columns={"在保余额": "名义在保余额"})
+    df_taizhang["在保余额"] = (1 - df_taizhang["银行"]) * df_taizhang["名义在保余额"]
+
+    df_taizhang["实际放款"] = (1 - df_taizhang["银行"]) * df_taizhang["放款金额"]
+    df_taizhang["放款时间"] = pd.to_datetime(df_taizhang["放款时间"], errors="coerce")
+    df_taizhang["实际到期时间"] = pd.to_datetime(df_taizhang["实际到期时间"], errors="coerce")
+    return compact_ledger(df_taizhang)
+
+DAICHANG_MATCH_SHOW = ["业务编号", "担保产品", "政策扶持领域", "债务人名称", "债务人证件号码",
+                      "主债权金额", "主债权到期日期", "债权人名称", "备案状态"]
+
+def match_daichang_policy(df_daichang: pd.DataFrame, df_batch2: pd.DataFrame) -> tuple[np.ndarray, pd.DataFrame]:
+    """
+    代偿 → 批量匹配：企业名称取顿号前第一个名字，与批量债务人名称（同样取第一个）相等，
+    且担保金额与主债权金额相差在 0.01 以内（np.isclose 口径）。一次 hash join 完成。
+    返回 (每笔代偿的政策扶持领域，未匹配为 ""；匹配到多条业务的明细表)。
+    """
+    left = pd.DataFrame({
+        "key": df_daichang["企业名称"].astype(str).str.split("、").str[0].to_numpy(),
+        "row": np.arange(len(df_daichang)),
+    })
+    right = pd.DataFrame({
+        "key": df_batch2["债务人名称"].astype(str).str.split("、").str[0].to_numpy(),
+        "pos": np.arange(len(df_batch2)),
+    })
+    pairs = left.merge(right, on="key")
+    amt = df_daichang["担保金额"].to_numpy(dtype=float)[pairs["row"].to_numpy()]
+    principal = df_batch2["主债权金额"].to_numpy(dtype=float)[pairs["pos"].to_numpy()]
+    pairs = pairs[np.isclose(principal, amt, atol=0.01)].sort_values(["row", "pos"])
+
+    # 多条匹配时和原来一样取批量台账里排在最前的一条
+    first = pairs.drop_duplicates("row")
+    policy = np.full(len(df_daichang), "", dtype=object)
+    policy[first["row"].to_numpy()] = df_batch2["政策扶持领域"].to_numpy()[first["pos"].to_numpy()]
+
+    multi = pairs[pairs.duplicated("row", keep=False)]
+    show = [c for c in DAICHANG_MATCH_SHOW if c in df_batch2.columns]
+    ambiguous = df_batch2[show].iloc[multi["pos"].to_numpy()].reset_index(drop=True)
+    ambiguous.insert(0, "代偿担保金额", df_daichang["担保金额"].to_numpy()[multi["row"].to_numpy()])
+    ambiguous.insert(0, "代偿企业名称", df_daichang["企业名称"].to_numpy()[multi["row"].to_numpy()])
+    return policy, ambiguous
+
+def load_daichang_data(daichang_file, df_batch2) -> pd.DataFrame:
+    sheet, header = LEDGER_SHEETS["daichang"]
+    df_daichang = read_sheet(daichang_file, sheet, header=header, columns=ledger_columns("daichang"))
+    df_daichang = _clean_columns(df_daichang)
+    df_daichang["代偿时间"] = pd.to_datetime(df_daichang["代偿时间"], errors="coerce")
+    df_daichang["代偿金额"] = pd.to_numeric(df_daichang["代偿金额"], errors="coerce").fillna(0) / 10000
+    df_daichang["担保金额"] = pd.to_numeric(df_daichang["担保金额"], errors="coerce").fillna(0) / 10000
+
+    # Drop rows where 贷款银行 is null or empty
+    df_daichang = df_daichang[df_daichang["贷款银行"].notna() & (df_daichang["贷款银行"].astype(str).str.strip() != "")]
+    # 新增“政策扶持领域”列，默认空，并放在最左侧
+    notify("在批量台账中找到代偿债务人名称，识别政策扶持领域...")
+    policy, ambiguous = match_daichang_policy(df_daichang, df_batch2)
+    df_daichang.insert(0, "政策扶持领域", policy)
+    if not ambiguous.empty:
+        notify("以下代偿在批量台账中匹配到多条业务，已取第一条的政策扶持领域：", level="warning", frame=ambiguous)
+    return compact_ledger(df_daichang)
+
+
+# ===================== 进程池 =====================
+# 并行读取、多主体合并共用一个进程池。子进程只 import 不依赖 streamlit 的模块。
+_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+PROCESS_WORKERS = int(os.environ.get("TAIZHANG_WORKERS", min(4, _CPUS)))   # <2 时不开进程池
+
+
+def _pool_worker() -> None:
+    # 子进程里不再开进程池：多主体合并时每个主体的整套统计都在子进程里跑
+    global PROCESS_WORKERS
+    PROCESS_WORKERS = 1
+
+
+@shared()
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    # spawn：Streamlit 服务进程里有好几个线程，fork 出来的子进程可能卡在别的线程拿着的锁上
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_pool_worker)
+
+
+# ===================== 并行读取 =====================
+# 保函、批量、传统、代偿的 openpyxl 解析互不依赖（代偿要用批量台账的只是后面的政策匹配），
+# 一起放进进程池解析，结果放进解析缓存；之后各 loader 照常按顺序清洗，read_sheet 直接命中缓存，
+# 总耗时约等于最慢的那一份文件。已有 sidecar、或 session 里已有台账的不再解析。
+
+
+def ledger_parse_requests(files: dict, filter_file, loaded=()) -> list:
+    """
+    本次运行各 loader 会读的表：[(显示名, 文件, 表选择, 表头行, 列)]，与 loader 里的 read_sheet 一一对应。
+    files：台账种类 -> 文件（None 表示不参与）；loaded：session 里已经有的台账种类。
+    """
+    def needed(kind, sources):
+        return kind not in loaded and not (pa is not None and _sidecar_path(kind, sources).exists())
+
+    def columns(kind):
+        return ledger_columns(kind, reference_data(filter_file).columns)
+
+    reqs = []
+    baohan, batch, trad, daichang = (files.get(k) for k in ["baohan", "batch", "trad", "daichang"])
+    try:
+        if baohan is not None and needed("baohan", [baohan]):
+            reqs.append(("保函", baohan, *LEDGER_SHEETS["baohan"], ledger_columns("baohan")))
+        if batch is not None and "batch" not in loaded:
+            sources = [batch, filter_file]
+            if needed("batch2", sources):
+                reqs.append(("批量", batch, *LEDGER_SHEETS["batch2"], columns("batch")))
+            if not _same_batch_sheet(batch) and needed("batch", sources):
+                reqs.append(("批量（筛选表）", batch, *LEDGER_SHEETS["batch"], columns("batch")))
+        if trad is not None and needed("trad", [trad, filter_file]):
+            reqs.append(("传统", trad, *LEDGER_SHEETS["trad"], columns("trad")))
+        if daichang is not None and batch is not None and needed("daichang", [daichang, batch, filter_file]):
+            reqs.append(("代偿", daichang, *LEDGER_SHEETS["daichang"], ledger_columns("daichang")))
+    except Exception:
+        pass   # 筛选条件、工作簿读不了：后面的就不预读，由 loader 照常读取并报错
+    return reqs
+
+
+def pending_parses(requests: list) -> list:
+    """去掉解析缓存里已有的表；返回 [(显示名, 缓存键, 文件, 实际表名, 表头行, 列)]。"""
+    cache, seen, todo = _parse_cache(), set(), []
+    for label, file_obj, sheet, header, columns in requests:
+        wanted = None if columns is None else frozenset(columns)
+        key = _parse_key(file_obj, sheet, header, wanted)
+        if key in seen or cache.get(key) is not None:
+            continue
+        try:
+            name = sheet_name(file_obj, sheet)
+        except Exception:
+            continue
+        seen.add(key)
+        todo.append((label, key, file_obj, name, header, wanted))
+    return todo
+
+
+def _job_source(file_obj):
+    """交给子进程的文件：已经落盘的上传给路径，子进程自己读；其余给内容。"""
+    path = file_obj.path() if hasattr(file_obj, "path") else None
+    return str(path) if path is not None else file_obj.getvalue()
+
+
+def parse_parallel(todo: list, log) -> int:
+    """
+    在进程池里解析 pending_parses 的结果，每解析完一份 log 一行、放进解析缓存；返回解析成功的个数。
+    子进程出错的表跳过（loader 会在本进程重读并照常报错）；进程池坏了就重建，本次剩下的交给 loader。
+    """
+    cache, ok, t0 = _parse_cache(), 0, time.perf_counter()
+    futures = {}
+    try:
+        pool = process_pool(PROCESS_WORKERS)
+        futures = {
+            pool.submit(parse_job, _job_source(file_obj), name, header, wanted): (label, key)
+            for label, key, file_obj, name, header, wanted in todo
+        }
+        for fut in as_completed(futures):
+            label, key = futures[fut]
+            try:
+                df = fut.result()
+            except BrokenProcessPool:
+                raise
+            except Exception:
+                log(f"• {label}：并行读取失败，稍后单独读取")
+                continue
+            cache.put(key, df)
+            ok += 1
+            log(f"• {label}已解析：{df.shape[0]} 行（{time.perf_counter() - t0:.1f}s）")
+    except BrokenProcessPool:
+        process_pool.clear()
+        log("• 读取进程异常退出，其余文件逐个读取")
+    finally:
+        for fut in futures:
+            fut.cancel()          # log 抛出（如统计被取消）时，还没开始的解析不再跑
+    return ok
+
+
+# ==========================================
+class CustomerDim:
+    """
+    “单户…”规则用的客户维表：客户列 factorize 成编码（排序与 groupby 一致），
+    各金额列按客户汇总一次、排名一次，规则按编码把客户级标记映射回每一行。
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._df = None
+
+    def _bind(self, d: pd.DataFrame) -> None:
+        if d is self._df:
+            return
+        self._df = d
+        self.codes, self.uniques = pd.factorize(d[self.key], sort=True)   # 空客户为 -1
+        self._sums = {}
+        self._ranked = {}
+
+    def sums(self, d: pd.DataFrame, col: str) -> np.ndarray:
+        """按客户编码排列的合计（与原先 groupby(客户).sum() 逐位相同）。"""
+        self._bind(d)
+        s = self._sums.get(col)
+        if s is None:
+            valid = self.codes >= 0
+            g = d[col][valid].groupby(self.codes[valid]).sum()
+            s = self._sums[col] = g.reindex(range(len(self.uniques)), fill_value=0).to_numpy()
+        return s
+
+    def ranked(self, d: pd.DataFrame, col: str, k: int) -> np.ndarray:
+        """合计最大的前 k 个客户编码，按 金额降序、编码升序（即 nlargest 的 keep="first"）。"""
+        s = self.sums(d, col)
+        hit = self._ranked.get(col)
+        if hit is None or (len(hit) < k and len(hit) < len(s)):
+            k_ = min(k, len(s))
+            if k_ == 0:
+                hit = np.array([], dtype=np.intp)
+            else:
+                cut = s[np.argpartition(-s, k_ - 1)[k_ - 1]]   # 第 k 大的值
+                above = np.flatnonzero(s > cut)
+                tie = np.flatnonzero(s == cut)[: k_ - len(above)]
+                hit = np.concatenate([above, tie])
+                hit = hit[np.lexsort((hit, -s[hit]))]
+            self._ranked[col] = hit
+        return hit[:k]
+
+    def rows(self, flags: np.ndarray) -> np.ndarray:
+        """客户级布尔标记 → 行级布尔数组（空客户为 False）。"""
+        return np.append(flags, False)[self.codes]
+
+    def at_most(self, d: pd.DataFrame, col: str, limit) -> np.ndarray:
+        return self.rows(self.sums(d, col) <= limit)
+
+    def top(self, d: pd.DataFrame, col: str, k: int) -> np.ndarray:
+        flags = np.zeros(len(self.sums(d, col)), dtype=bool)
+        flags[self.ranked(d, col, k)] = True
+        return self.rows(flags)
+
+
+# ==========================================
+# 依赖统计基准日期的规则写成 {规则名: (日期列, 区间, 须 > 0 的金额列 或 None)}，由 date_rules 生成；
+# 其余规则与日期无关，只改日期时它们的掩码直接复用（MetricEngine.rebind）。
+# 区间：year 当年、month 当月、last_year 上一年、after 晚于基准日（到期日类，文字到期日视为无穷远）。
+def period_bounds(as_of: pd.Timestamp) -> dict:
+    """各区间的 [起, 止]（两端都含）。"""
+    y0, y1 = as_of.replace(month=1, day=1), as_of.replace(month=12, day=31)
+    m0, m1 = as_of.replace(day=1), (as_of.replace(day=1) + pd.offsets.MonthEnd(0))
+    ly0, ly1 = y0 - pd.DateOffset(years=1), y1 - pd.DateOffset(years=1)
+    return {"year": (y0, y1), "month": (m0, m1), "last_year": (ly0, ly1)}
+
+
+def date_rules(spec: dict, as_of: pd.Timestamp) -> dict:
+    bounds = period_bounds(as_of)
+
+    def build(col, period, positive):
+        if period == "after":
+            hit = lambda d: expiry_dates(d[col]) > as_of
+        else:
+            lo, hi = bounds[period]
+            hit = lambda d: d[col].between(lo, hi)
+        if positive is None:
+            return hit
+        return lambda d: hit(d) & (d[positive] > 0)
+
+    return {name: build(*rule) for name, rule in spec.items()}
+
+
+# ==========================================
+AGG_MAP_BAOHAN = {
+    "在保余额": ("在保余额", "sum"),
+    "笔数": (None, "count"),
+    "户数": ("客户名称", "nunique"),
+    "责任余额": ("责任余额", "sum"),
+    "放款金额": ("放款金额", "sum"),
+}
+
+BAOHAN_METRICS = [
+    "保函_在保_在保余额",
+    "保函_当年_放款金额",
+]
+
+
+BAOHAN_DATE_RULES = {
+    "当年": ("放款时间", "year", "放款金额"),
+    "当月": ("放款时间", "month", "放款金额"),
+    "上一年": ("放款时间", "last_year", "放款金额"),
+    # 合同到期时间读取时已转成日期；写了文字的（见 EXPIRY_TEXT_SENTINELS）视为无穷远的日期
+    "在保": ("合同到期时间", "after", "在保余额"),
+}
+
+
+def baohan_rules(as_of: pd.Timestamp) -> dict:
+    RULES = {
+        "保函": lambda d: d["客户名称"] != "合计"
+    }
+    RULES.update(date_rules(BAOHAN_DATE_RULES, as_of))
+    return RULES
+
+
+def calc_baohan_metrics(df: pd.DataFrame, as_of: pd.Timestamp, engine="mask") -> pd.Series:
+    base_res = metric_engine("baohan", df, as_of, engine).run(BAOHAN_METRICS)
+    return pd.Series({**base_res}, name="保函业务")
+# ==========================================
+AGG_MAP_DAICHANG = {
+    "代偿金额": lambda df: df["代偿金额"].sum() 
+}
+
+DAICHANG_METRICS = ["代偿_当年_代偿金额","代偿_代偿金额","代偿_当年_小微_代偿金额"
+]
+
+
+DAICHANG_DATE_RULES = {
+    "当年": ("代偿时间", "year", "代偿金额"),
+}
+
+
+def daichang_rules(as_of: pd.Timestamp) -> dict:
+    RULES = {
+        "代偿": lambda d: ~d["企业名称"].astype(str).str.contains("代偿项目", na=False),
+        "小微": lambda d: d["政策扶持领域"].astype(str).str.contains("小微企业", na=False)
+    }
+    RULES.update(date_rules(DAICHANG_DATE_RULES, as_of))
+    return RULES
+
+
+def calc_daichang_metrics(df: pd.DataFrame, as_of: pd.Timestamp, engine="mask") -> pd.Series:
+    base_res = metric_engine("daichang", df, as_of, engine).run(DAICHANG_METRICS)
+    return pd.Series({**base_res}, name="代偿明细")
+# ==========================================
+
+
+
+
+AGG_MAP_TRAD = {
+    "名义放款": ("放款金额", "sum"),
+    "实际放款": ("实际放款", "sum"),
+    "在保余额": ("在保余额", "sum"),
+    "笔数": (None, "count"),
+    "户数": ("客户名称", "nunique"),
+    "责任余额": ("责任余额", "sum"),
+    "名义在保余额": ("名义在保余额", "sum"),
+    "担保费": ("担保费/利息", "sum"),
+}
+
+TRAD_METRICS = [
+    "传统_当年_名义放款", "传统_当年_中型_名义放款", "传统_当年_小微_名义放款",
+    "传统_当年_实际放款", "传统_中小_当年_实际放款","传统_小微_当年_实际放款",
+    "传统_上一年_实际放款", "传统_上一年_户数","传统_中小_当年_户数","传统_小微_当年_户数","传统_当月_实际放款",
+    "传统_当年_户数", "传统_当年_小微_户数", "传统_当年_笔数", 
+    "传统_中小_当年_笔数","传统_小微_当年_笔数",
+    "传统_中小_在保_在保余额", "传统_中型_在保余额", "传统_在保_在保余额", "传统_小微_在保_在保余额",
+
+    "新增_传统_当年_实际放款","新增_传统_当年_名义放款",
+    "新增_传统_当年_支农支小_名义放款", "新增_传统_当年_支农支小_全担_名义放款",
+    "新增_传统_当年_支农支小_惠蓉贷_名义放款", "新增_传统_当年_支农支小_户数",
+
+    "传统_当年_支农支小_名义放款","传统_当年_支农支小_实际放款","传统_当年_支农支小_户数",
+
+    "传统_在保_名义在保余额","传统_在保_在保余额","传统_在保_户数",
+    "传统_广义小微_在保_户数", "传统_广义小微_在保_在保余额",
+    "传统_当年_支农支小_全担_名义放款", "传统_当年_支农支小_惠蓉贷_名义放款",
+    "新增_传统_当年_民企_名义放款", "新增_传统_当年_民企_实际放款", "新增_传统_当年_民企_户数",
+    "传统_当年_民企_名义放款", "传统_当年_民企_实际放款", "传统_当年_民企_户数",
+    "传统_小微_在保_户数",
+
+    "传统_个体工商户及小微企业主_实际放款","传统_个体工商户及小微企业主_在保_在保余额", "传统_个体工商户及小微企业主_在保_户数",
+    "传统_农户及新型农业经营主体_实际放款","传统_农户及新型农业经营主体_在保_在保余额", "传统_农户及新型农业经营主体_在保_户数",
+    "传统_支农支小_在保_在保余额", "传统_支农支小_在保_户数",
+    "传统_担保费率低于1%(含)_在保_在保余额", "传统_本月解保_在保余额", "传统_本年解保_在保余额",
+    "传统_当年_驿享贷_名义放款",
+    "传统_在保_责任余额","传统_在保_担保费","传统_在保_名义放款",
+    "传统_在保_三农_责任余额",
+    "传统_三农_单户在保<=500_责任余额","传统_小微_单户在保<=500_责任余额","传统_小微_单户在保<=500_在保_担保费","传统_小微_单户在保<=500_在保_名义放款",
+    "传统_单户责任前10_责任余额","传统_单户责任最大_责任余额",
+] + [f"传统_{lvl}_在保余额" for lvl in ["正常","关注","次级","可疑","损失"]]
+
+
+TRAD_DATE_RULES = {
+    "当年": ("放款时间", "year", "放款金额"),
+    "当月": ("放款时间", "month", "放款金额"),
+    "上一年": ("放款时间", "last_year", "放款金额"),
+    "本月解保": ("实际到期时间", "month", None),
+    "本年解保": ("实际到期时间", "year", None),
+}
+
+
+def trad_rules(as_of: pd.Timestamp) -> dict:
+    cust = CustomerDim("客户名称")   # 单户在保<=500 / 单户责任前10 / 单户责任最大
+    RULES = {
+        "在保":  lambda d: d["在保余额"] > 0,
+        "传统":  lambda d: d["业务品种2"].isin(["传统"]),
+        "全担":  lambda d: d["公司责任风险比例"] == "100%",
+        "惠蓉贷": lambda d: d["业务品种3"] == "惠蓉贷",
+        "驿享贷": lambda d: d["业务品种"]  == "驿享贷",
+        "担保费率低于1%(含)": lambda d: d["担保费率/利率"] <= 1,
+        "小微":  lambda d: d["企业类别"].isin(["小型","微型"]) & (d["业务品种"] != "惠抵贷"),
+        "中型":  lambda d: d["企业类别"] == "中型",
+        "三农":  lambda d: d["企业类别"] == "三农",
+        "中小":  lambda d: d["企业类别"].isin(["小型","微型","中型"]),
+        "支农支小": lambda d: d["企业类别"].isin(["小型","微型","三农"]),
+        "个体工商户及小微企业主": lambda d: d["业务品种"] == "惠抵贷",
+        "广义小微": lambda d: d["企业类别"].isin(["小型", "微型"]) | (d["业务品种"] == "惠抵贷"),
+        "农户及新型农业经营主体":     lambda d: d["企业类别"].isin(["三农"]),
+        "新增":  lambda d: d["新增/续贷"] == "新增",
+        "民企":  lambda d: d["国企民企"] == "民企",
+        "国企":  lambda d: d["国企民企"] == "国企",
+        "不良": lambda d: d["风险等级"].isin(["次级","可疑","损失"]),
+        "单户在保<=500": lambda d: cust.at_most(d, "在保余额", 500),
+        "单户责任前10": lambda d: cust.top(d, "责任余额", 10),
+        "单户责任最大": lambda d: cust.top(d, "责任余额", 1),
+    }
+    RULES.update({lvl: (lambda d, _lvl=lvl: d["风险等级"] == _lvl)
+                  for lvl in ["正常","关注","次级","可疑","损失"]})
+    RULES.update(date_rules(TRAD_DATE_RULES, as_of))
+    return RULES
+
+
+def calc_trad_metrics(df: pd.DataFrame, as_of: pd.Timestamp, engine="mask") -> pd.Series:
+    base_res = metric_engine("trad", df, as_of, engine).run(TRAD_METRICS)
+
+    # ── ③ 合并并返回 ──────────────────────────────────────────
+    return pd.Series({**base_res}, name="传统业务")
+
+
+# ===================== 批量指标计算 =====================
+
+
+
+
+AGG_MAP_BATCH = {
+    "名义放款": ("主债权金额", "sum"),
+    "实际放款": ("实际放款", "sum"),
+    "责任余额": ("责任余额", "sum"),
+    "在保余额": ("在保余额", "sum"),
+    "名义在保余额": ("在保余额", "sum"),
+    "笔数": (None, "count"),
+    "户数": ("债务人证件号码", "nunique"),
+    "担保费": ("担保费", "sum"),
+}
+
+BATCH_METRICS = [
+        "批量_当年_名义放款",
+        "批量_当年_中型_名义放款",
+        "批量_当年_小微_名义放款",
+        "批量_当年_小微_户数",
+        "批量_当年_笔数",
+        "批量_当年_小微_笔数",
+        "批量_中小_在保_在保余额",
+        "批量_中型_在保_在保余额",
+        "批量_当年_实际放款",
+        "批量_上一年_实际放款",
+        "批量_中小_当年_实际放款",
+        "批量_当年_户数",
+        "批量_中小_当年_户数",
+        "批量_小微_当年_户数",
+        "批量_中小_当年_笔数",
+        "批量_小微_当年_笔数",
+        "批量_上一年_户数",
+        "批量_在保_名义在保余额",
+        "批量_在保_在保余额",
+
+        "批量_在保_户数",
+        "批量_在保_企业_户数",
+        "批量_在保_个人_户数",
+        "批量_在保_非农小微_户数",
+        "批量_在保_非农小微_在保余额",  
+        "批量_在保_农业小微_户数",
+        "批量_在保_农业小微_在保余额",
+        "批量_首贷户_在保_户数",
+        "批量_首贷户_在保_在保余额",
+        "批量_广义小微_在保_户数",
+        "批量_广义小微_在保_在保余额",
+        "批量_个体工商户及小微企业主_实际放款",
+        "批量_个体工商户及小微企业主_在保_在保余额",
+        "批量_个体工商户及小微企业主_在保_户数",
+        "批量_农户_实际放款",
+        "批量_农户_在保_在保余额",
+        "批量_农户_在保_户数",
+        "批量_在保_三农_责任余额",
+        "批量_当年_支农支小_名义放款",
+        "批量_当年_支农支小_实际放款",
+        "批量_当年_支农支小_户数",
+        "批量_支农支小_在保_在保余额",
+        "批量_支农支小_在保_户数",
+        "批量_当年_民企_名义放款",
+        "批量_当年_民企_实际放款",
+        "批量_当年_民企_户数",
+        "批量_担保费率低于1%(含)_在保_在保余额",
+        "批量_当年_科创_实际放款",
+        "批量_科创_在保_在保余额",
+        "批量_科创_在保_户数",
+        "批量_当年_科创_户数",
+        "批量_城镇居民_在保_在保余额",
+        "批量_城镇居民_在保_户数",
+        "批量_当月_实际放款",
+        "批量_三农_单户在保<=500_责任余额","批量_农户_单户在保<=200_责任余额","批量_小微_单户在保<=500_责任余额","批量_小微_单户在保<=500_在保_担保费","批量_小微_单户在保<=500_在保_名义放款",
+        "批量_单户责任前10_责任余额","批量_单户责任最大_责任余额",
+        "批量_在保_责任余额","批量_在保_担保费","批量_在保_名义放款",
+]
+
+
+BATCH_DATE_RULES = {
+    "上一年": ("主债权起始日期", "last_year", "主债权金额"),
+    "当年": ("主债权起始日期", "year", "主债权金额"),
+    "当月": ("主债权起始日期", "month", "主债权金额"),
+    "本月解保": ("主债权到期日期", "month", None),
+    "本年解保": ("主债权到期日期", "year", None),
+}
+
+
+def batch_rules(as_of: pd.Timestamp) -> dict:
+    cust = CustomerDim("债务人证件号码")
+    RULES = {
+        "在保": lambda d: d["是否已解保"] == "在保",
+        "批量": lambda d: d["业务品种2"].isin(["批量"]),
+        "全担": lambda d: d["分险比例(直担)"] == 100,
+        "担保费率低于1%(含)": lambda d: d["担保年费率"] <= 1,
+        "中型": lambda d: d["企业划型"] == "中型企业",
+        "小微": lambda d: d["企业划型"].isin(["小型企业", "微型企业"]),
+        "中小": lambda d: d["企业划型"].isin(["小型企业", "微型企业", "中型企业"]),
+        "企业": lambda d: d["债务人类别"] == "企业/企业",
+        "个人": lambda d: d["债务人类别"] != "企业/企业",
+        "三农": lambda d: d["政策扶持领域"].str.contains("三农", na=False),
+        "农业": lambda d: d["所属行业(工)"] == "农、林、牧、渔业",
+        "非农小微": lambda d: (
+            d["企业划型"].isin(["小型企业", "微型企业"]) & (d["所属行业(工)"] != "农、林、牧、渔业")
+        ),
+        "农业小微": lambda d: (
+            d["企业划型"].isin(["小型企业", "微型企业"]) & (d["所属行业(工)"] == "农、林、牧、渔业")
+        ),
+        "非农小微和小微企业主": lambda d: (
+            (d["企业划型"].isin(["小型企业", "微型企业"]) | d["债务人类别"].isin(["个人/个体工商户", "个人/小微企业主"])) & (d["所属行业(工)"] != "农、林、牧、渔业")
+        ),
+        #d["企业划型"].d["债务人类别"].isin(["个人/个体工商户", "个人/小微企业主"]) & (d["所属行业(工)"] != "农、林、牧、渔业")
+        "支农支小": lambda d: d["政策扶持领域"].isin(["三农", "小微企业", "小微企业,三农"]),
+        "个体工商户及小微企业主": lambda d: d["债务人类别"].isin(["个人/个体工商户", "个人/小微企业主"]),
+        "广义小微": lambda d: d["企业划型"].isin(["小型企业", "微型企业"]) | d["债务人类别"].isin(["个人/个体工商户", "个人/小微企业主"]),
+        "城镇居民": lambda d: d["债务人类别"].isin(["个人/个体工商户"]),
+        "农户": lambda d: d["债务人类别"].isin(["个人/农户"]),
+        "首贷户": lambda d: d.get("首贷户", pd.Series([False]*len(d))) == "是",
+        "民企": lambda d: d["债务人经营主体经济成分"].str.contains("私人控股", na=False),
+        "国企": lambda d: d["债务人经营主体经济成分"].str.contains("国有控股", na=False),
+        "科创": lambda d: d["担保产品"].str.contains("科创", na=False),
+        "单户在保<=500": lambda d: cust.at_most(d, "在保余额", 500),
+        "单户在保<=200": lambda d: cust.at_most(d, "在保余额", 200),
+        "单户责任前10": lambda d: cust.top(d, "责任余额", 10),
+        "单户责任最大": lambda d: cust.top(d, "责任余额", 1),
+    }
+    RULES.update(date_rules(BATCH_DATE_RULES, as_of))
+    return RULES
+
+
+def calc_batch_metrics(df: pd.DataFrame, as_of: pd.Timestamp, engine="mask") -> pd.Series:
+    # 原有指标 
+    base_res = metric_engine("batch", df, as_of, engine).run(BATCH_METRICS)
+
+    # ==== 3. 合并并返回 ====
+    return pd.Series({**base_res}, name="批量业务")
+
+
+
+# ===================== 台账用到的列 =====================
+
+class _ColumnProbe:
+    """假 DataFrame：规则函数每取一列就记下列名，用来反推台账实际用到哪些列。"""
+
+    def __init__(self):
+        self.used = set()
+
+    def __getitem__(self, col):
+        self.used.add(col)
+        return pd.Series([], dtype=object)
+
+    def get(self, col, default=None):
+        return self[col]
+
+    def __len__(self):
+        return 0
+
+
+# loader 自己要读的原始列：派生列（在保余额、责任余额、实际放款…）的来源、代偿匹配用的列
+LOADER_INPUTS = {
+    "baohan": [],
+    "batch": [
+        "担保产品", "业务品种", "在保余额", "责任余额", "主债权金额", "担保年费率",
+        "主债权起始日期", "主债权到期日期", "分险比例(直担)", "分险比例(债权人)",
+        "分险比例-国担", "分险比例-市再担保", "分险比例-省再担保", "分险比例-其他",
+        "债务人名称", "业务编号", "债务人证件号码", "债权人名称", "备案状态", "政策扶持领域",
+        *NEW_BATCH_COL_MAP,
+    ],
+    "trad": ["客户名称", "业务品种", "在保余额", "放款金额", "放款时间", "实际到期时间"],
+    "daichang": ["代偿时间", "代偿金额", "担保金额", "贷款银行", "企业名称"],
+}
+
+LEDGER_RULES = {
+    "baohan": (baohan_rules, AGG_MAP_BAOHAN),
+    "batch": (batch_rules, AGG_MAP_BATCH),
+    "trad": (trad_rules, AGG_MAP_TRAD),
+    "daichang": (daichang_rules, AGG_MAP_DAICHANG),
+}
+
+
+LEDGER_DATE_RULES = {
+    "baohan": BAOHAN_DATE_RULES,
+    "batch": BATCH_DATE_RULES,
+    "trad": TRAD_DATE_RULES,
+    "daichang": DAICHANG_DATE_RULES,
+}
+
+
+def metric_engine(kind: str, df: pd.DataFrame, as_of: pd.Timestamp, engine="mask") -> "MetricEngine":
+    """
+    engine 是 METRIC_ENGINES 里的名字时新建引擎；传入上次用过的同一张表的引擎时，
+    只换掉依赖日期的规则（LEDGER_DATE_RULES），其余规则的掩码、客户编码全部复用。
+    """
+    rules = LEDGER_RULES[kind][0](as_of)
+    if isinstance(engine, str):
+        return METRIC_ENGINES[engine](df, rules, LEDGER_RULES[kind][1])
+    return engine.rebind(rules, LEDGER_DATE_RULES[kind])
+
+
+def ledger_columns(kind: str, extra=()) -> frozenset:
+    """某类台账要读的列：规则和口径里引用的列 + loader 的输入列 + extra（如业务分类表的列，合并时会撞名）。"""
+    rules, agg_map = LEDGER_RULES[kind]
+    probe = _ColumnProbe()
+    fns = list(rules(pd.Timestamp("2000-01-01")).values()) + [m for m in agg_map.values() if callable(m)]
+    for fn in fns:
+        try:
+            fn(probe)
+        except Exception as e:
+            # 出错之后的取列记不下来，读出来的表会缺列：改规则时让它在这里报错，而不是统计时才缺列
+            raise RuntimeError(f"{kind} 台账的规则不能在空表上求值，推不出要读哪些列：{e!r}") from e
+    cols = probe.used | {m[0] for m in agg_map.values() if not callable(m) and m[0]}
+    return frozenset(cols | set(LOADER_INPUTS[kind]) | set(extra))
+
+
+# 明细：四类台账都只读 ledger_columns（+ LEDGER_KEEP_RE 的展示列）。要给用户看的那几行
+# （到期未清零、代偿合并表）在展示、导出时再整表读一次，按行索引补上没读的列；
+# loader 只筛行、不重排，索引就是原表的行号（sidecar 也原样存着）。
+DETAIL_SOURCES = {
+    "trad_overdue": ("trad", "trad_file"),
+    "batch_overdue": ("batch", "batch_file"),
+    "df_daichang": ("daichang", "daichang_file"),
+}
+
+
+def ledger_detail(kind: str, file_obj, rows: pd.DataFrame) -> pd.DataFrame:
+    """rows 是 kind 台账里的一些行，补上整表里没读进来的列；列按原表顺序，派生列留在原来的前后。"""
+    if file_obj is None or rows.empty:
+        return rows
+    sheet, header = LEDGER_SHEETS[kind]
+    full = _clean_columns(read_sheet(file_obj, sheet, header=header))
+    # 读进来又改了名的列（未备案批量台账）不再补一份原名的
+    renamed = {k for k, v in NEW_BATCH_COL_MAP.items() if v in rows.columns} if kind == "batch" else set()
+    skip = set(rows.columns) | ledger_columns(kind) | renamed
+    missing = [c for c in full.columns if c not in skip and not LEDGER_KEEP_RE.search(str(c))]
+    if not missing:
+        return rows
+    out = pd.concat([rows, full.loc[rows.index, missing]], axis=1)
+    lead = list(itertools.takewhile(lambda c: c not in full.columns, rows.columns))   # 如代偿表的 政策扶持领域
+    order = lead + [c for c in full.columns if c in out.columns]
+    return out[order + [c for c in rows.columns if c not in order]]
+
+
+def result_details(results: dict, files: dict) -> dict:
+    """run_statistics 的结果里的明细表换成补齐列的（导出用）；files 同 run_statistics。"""
+    out = dict(results)
+    for key, (kind, file_key) in DETAIL_SOURCES.items():
+        if key in out:
+            out[key] = ledger_detail(kind, files.get(file_key), out[key])
+    return out
+
+
+# ===================== 多日期统计 =====================
+LEDGER_METRICS = {
+    "baohan": BAOHAN_METRICS,
+    "batch": BATCH_METRICS,
+    "trad": TRAD_METRICS,
+    "daichang": DAICHANG_METRICS,
+}
+
+# 多日期统计的在保在每个日期（包括统计基准日期）都按起止日判断：起始日 <= 基准日 < 到期日，
+# 到期日为空视为仍在保。与执行统计按当前余额、状态判断的在保口径不同。
+INFORCE_INTERVALS = {
+    "trad": ("放款时间", "实际到期时间"),
+    "batch": ("主债权起始日期", "主债权到期日期"),
+}
+
+# 台账只有取数那天的余额，别的日期推不回去：按余额列加总的指标、按余额分档 / 排名的单户规则，
+# 以及没有起止日可判断在保的台账的在保指标，多日期统计不输出。
+BALANCE_COLUMNS = {"在保余额", "名义在保余额", "责任余额"}
+BALANCE_RULES = {"单户在保<=500", "单户在保<=200", "单户责任前10", "单户责任最大"}
+
+
+def multi_date_metrics(kind: str) -> list:
+    """kind 台账里能按日期重建的指标（LEDGER_METRICS 的子集），多日期统计只算这些。"""
+    agg_map = LEDGER_RULES[kind][1]
+    skip = BALANCE_RULES | (set() if kind in INFORCE_INTERVALS else {"在保"})
+    out = []
+    for name in LEDGER_METRICS[kind]:
+        keys, agg = MetricEngine.parse(name)
+        mapper = agg_map[agg]
+        if (callable(mapper) or mapper[0] not in BALANCE_COLUMNS) and skip.isdisjoint(keys):
+            out.append(name)
+    return out
+
+
+def _segment_sums(vals: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """vals[lo[i]:hi[i]] 的和（区间可以重叠）；逐段直接相加，不用前缀和相减，避免大数相消的误差。"""
+    if len(vals) == 0:
+        return np.zeros(len(lo))
+    idx = np.column_stack([lo, hi]).ravel()
+    sums = np.add.reduceat(np.append(vals, 0.0), idx)[::2]
+    return np.where(hi > lo, sums, 0.0)
+
+
+class MultiDateEngine:
+    """
+    一次算一串统计基准日期的全部指标，结果是 日期 × 指标 的表。
+    - 与日期无关的规则组合只算一次（MetricEngine 的前缀缓存），所有日期共用；
+    - 只带一个区间类日期规则（当年/当月/上一年/本月解保/本年解保）的 sum/count：
+      行按日期排序一次，各日期的区间用 searchsorted 定位后分段求和；
+    - 在保（按起止日）：按起始日、到期日各排序一次做区间扫描（已起始 − 已到期）；
+    - 其余（户数、after 类到期规则…）逐日期生成掩码，户数全部交给 distinct_counts 一次批量算。
+    要算哪些指标由调用方给，按余额算的指标不该给（见 multi_date_metrics）。
+    """
+
+    def __init__(self, kind: str, df: pd.DataFrame):
+        rules_fn, agg_map = LEDGER_RULES[kind]
+        self.kind = kind
+        self.df = df
+        self.spec = dict(LEDGER_DATE_RULES[kind])
+        self.inforce = INFORCE_INTERVALS.get(kind)
+        if self.inforce:
+            self.spec["在保"] = (self.inforce[0], "inforce", None)
+        static = {k: fn for k, fn in rules_fn(pd.Timestamp.today()).items() if k not in self.spec}
+        self.engine = MetricEngine(df, static, agg_map)
+        self._date_masks: dict[tuple, np.ndarray] = {}
+        self._sorted: dict[tuple, tuple] = {}
+        self._values: dict[str, np.ndarray] = {}
+
+    def _values_of(self, col: str) -> np.ndarray:
+        v = self._values.get(col)
+        if v is None:
+            v = pd.to_numeric(self.df[col], errors="coerce").to_numpy(dtype=float)
+            v = self._values[col] = np.where(np.isnan(v), 0.0, v)   # 与 pandas sum 一样跳过 NaN
+        return v
+
+    def _dates_of(self, col: str) -> np.ndarray:
+        return pd.to_datetime(self.df[col], errors="coerce").to_numpy(dtype="datetime64[ns]")
+
+    def date_mask(self, key: str, as_of: pd.Timestamp) -> np.ndarray:
+        m = self._date_masks.get((key, as_of))
+        if m is None:
+            if self.spec[key][1] == "inforce":
+                start, end = self.inforce
+                fn = lambda d: (d[start] <= as_of) & ~(d[end] <= as_of)
+            else:
+                fn = date_rules({key: self.spec[key]}, as_of)[key]
+            m = self._date_masks[(key, as_of)] = _as_mask(fn(self.df), len(self.df))
+        return m
+
+    def _window(self, static: tuple, key: str, mapper, dates) -> np.ndarray:
+        col, period, positive = self.spec[key]
+        hit = self._sorted.get((static, key))
+        if hit is None:
+            t = self._dates_of(col)
+            keep = self.engine.mask(static) & ~np.isnat(t)
+            if positive is not None:
+                keep &= _as_mask(self.df[positive] > 0, len(self.df))
+            rows = np.flatnonzero(keep)
+            rows = rows[np.argsort(t[rows], kind="stable")]
+            hit = self._sorted[(static, key)] = (rows, t[rows])
+        rows, t = hit
+        bounds = [period_bounds(d)[period] for d in dates]
+        lo = np.searchsorted(t, np.array([b[0] for b in bounds], dtype="datetime64[ns]"), "left")
+        hi = np.searchsorted(t, np.array([b[1] for b in bounds], dtype="datetime64[ns]"), "right")
+        if mapper[1] == "count":
+            return hi - lo
+        return _segment_sums(self._values_of(mapper[0])[rows], lo, hi)
+
+    def _sweep(self, static: tuple, mapper, dates) -> np.ndarray:
+        hit = self._sorted.get((static, "在保"))
+        if hit is None:
+            s, e = self._dates_of(self.inforce[0]), self._dates_of(self.inforce[1])
+            # 到期日不晚于起始日的行任何时点都不在保，先剔掉；剩下的行"已到期"必然"已起始"
+            rows = np.flatnonzero(self.engine.mask(static) & ~np.isnat(s) & (np.isnat(e) | (e > s)))
+            by_start = rows[np.argsort(s[rows], kind="stable")]
+            ended = rows[~np.isnat(e[rows])]
+            by_end = ended[np.argsort(e[ended], kind="stable")]
+            hit = self._sorted[(static, "在保")] = (by_start, s[by_start], by_end, e[by_end])
+        by_start, s, by_end, e = hit
+        d = np.array(dates, dtype="datetime64[ns]")
+        started, ended = np.searchsorted(s, d, "right"), np.searchsorted(e, d, "right")
+        if mapper[1] == "count":
+            return started - ended
+        v = self._values_of(mapper[0])
+        return np.r_[0.0, np.cumsum(v[by_start])][started] - np.r_[0.0, np.cumsum(v[by_end])][ended]
+
+    def run(self, dates, names) -> pd.DataFrame:
+        dates = sorted({pd.Timestamp(d) for d in dates})
+        names = list(dict.fromkeys(names))
+        self.engine.plan(names)
+        out: dict[str, np.ndarray] = {}
+        pending: dict[str, list] = {}
+        for name in names:
+            keys, agg = MetricEngine.parse(name)
+            mapper = self.engine.agg_map[agg]
+            dkeys = list(dict.fromkeys(k for k in keys if k in self.spec))
+            static = tuple(k for k in keys if k not in self.spec)
+            how = None if callable(mapper) else mapper[1]
+            if how in ("sum", "count") and len(dkeys) == 1:
+                period = self.spec[dkeys[0]][1]
+                if period in ("year", "month", "last_year"):
+                    out[name] = self._window(static, dkeys[0], mapper, dates)
+                    continue
+                if period == "inforce":
+                    out[name] = self._sweep(static, mapper, dates)
+                    continue
+            col = out[name] = np.empty(len(dates), dtype=object)
+            base = self.engine.mask(static)
+            for i, d in enumerate(dates):
+                mask = base
+                for k in dkeys:
+                    mask = mask & self.date_mask(k, d)
+                if how == "nunique":
+                    pending.setdefault(mapper[0], []).append((name, i, mask))
+                else:
+                    col[i] = self.engine.aggregate(mapper, mask)
+        for c, group in pending.items():
+            counts = self.engine.distinct_counts(c, [mask for _, _, mask in group])
+            for (name, i, _), n in zip(group, counts):
+                out[name][i] = int(n)
+        index = pd.Index([d.date() for d in dates], name="统计基准日期")
+        return pd.DataFrame(out, index=index, columns=names).astype(object).infer_objects()
+
+
+def calc_metrics_by_date(kind: str, df: pd.DataFrame, dates) -> pd.DataFrame:
+    """kind 台账在多个统计基准日期下能按日期重建的指标（日期 × multi_date_metrics）。"""
+    return MultiDateEngine(kind, df).run(dates, multi_date_metrics(kind))
+
+
+# ===================== 报表公式 =====================
+# "目标=表达式"，表达式只有 + - * /（先乘除后加减，除以 0 得 0）；操作数是指标名或数字，查不到的指标按 0 算。
+RULES_CITY = [
+    "本年累计发生金额（扣除银行分险）=批量_当年_实际放款+传统_当年_实际放款",
+    "本年累计发生金额（扣除银行分险）同比增减=批量_当年_实际放款-批量_上一年_实际放款+传统_当年_实际放款-传统_上一年_实际放款",
+    "在保余额=批量_在保_在保余额+传统_在保_在保余额",
+    "同比增减=在保余额-上月_在保_在保余额",
+    "比年初增减额=在保余额-上一年_在保_在保余额",
+    "累计代偿=代偿_代偿金额",
+    "本年累计代偿=代偿_当年_代偿金额",
+    "本年累计担保户数=批量_当年_户数+传统_当年_户数",
+    "本年累计担保户数同比增减=批量_当年_户数-批量_上一年_户数+传统_当年_户数-传统_上一年_户数",
+    "在保企业客户数量=批量_在保_企业_户数+传统_在保_户数",
+    "在保个人客户数量=批量_在保_个人_户数+传统_个体工商户及小微企业主_在保_户数",
+    "正常类担保余额=批量_正常_名义在保余额+传统_正常_在保余额",
+    "关注类担保余额=批量_关注_名义在保余额+传统_关注_在保余额",
+    "次级类担保余额=批量_次级_名义在保余额+传统_次级_在保余额",
+    "可疑类担保余额=批量_可疑_名义在保余额+传统_可疑_在保余额",
+    "损失类担保余额=批量_损失_名义在保余额+传统_损失_在保余额",
+]
+
+RULES_CD_FIN = [
+    "实际在保余额=批量_在保_责任余额+传统_在保_责任余额",
+    "较年初增减=实际在保余额-上一年_在保_责任余额",
+    "客户数=批量_在保_户数+传统_在保_户数",
+    "1.非农小微企业在保余额=批量_在保_非农小微_在保余额+传统_在保_小微_在保余额",
+    "1.非农小微企业客户数=批量_在保_非农小微_户数+传统_在保_小微_户数",
+    "2.农业小微企业在保余额=批量_在保_农业小微_在保余额",
+    "2.农业小微企业客户数=批量_在保_农业小微_户数",
+    "3.城镇居民（含个体工商户）在保余额=批量_城镇居民_在保_在保余额",
+    "3.城镇居民（含个体工商户）客户数=批量_城镇居民_在保_户数",
+    "4.农村居民（含个体工商户）在保余额=批量_农户_在保_在保余额",
+    "4.农村居民（含个体工商户）客户数=批量_农户_在保_户数",
+    "批量_不良_名义在保余额=批量_次级_名义在保余额-批量_可疑_名义在保余额-批量_损失_名义在保余额",
+    "传统_不良_在保余额=传统_次级_在保余额-传统_可疑_在保余额-传统_损失_在保余额",
+    "不良融资担保余额=批量_不良_名义在保余额+传统_不良_在保余额"
+]
+
+RULES_CITY_YOY = [
+    "本年累计担保金额=批量_当年_实际放款+传统_当年_实际放款",
+    "本年累计担保金额同比增减=批量_当年_实际放款-批量_上一年_实际放款+传统_当年_实际放款-传统_上一年_实际放款",
+    "在保余额=批量_在保_在保余额+传统_在保_在保余额",
+    "同比增减额=在保余额-上月_在保_在保余额",
+    "比年初增减额=在保余额-上一年_在保_在保余额",
+    "累计代偿=代偿_代偿金额",
+    "本年累计代偿=代偿_当年_代偿金额",
+    "本年累计担保户数=批量_当年_户数+传统_当年_户数",
+    "本年累计担保户数同比增减=批量_当年_户数-批量_上一年_户数+传统_当年_户数-传统_上一年_户数",
+    "在保企业客户数量=批量_在保_企业_户数+传统_在保_户数",
+    "在保个人客户数量=批量_在保_个人_户数+传统_个体工商户及小微企业主_在保_户数",
+    "最大单一客户在保余额=传统_单户责任最大_责任余额",
+    "前十大客户在保余额=传统_单户责任前10_责任余额",
+    "正常类担保余额=批量_正常_名义在保余额+传统_正常_在保余额",
+    "关注类担保余额=批量_关注_名义在保余额+传统_关注_在保余额",
+    "次级类担保余额=批量_次级_名义在保余额+传统_次级_在保余额",
+    "可疑类担保余额=批量_可疑_名义在保余额+传统_可疑_在保余额",
+    "损失类担保余额=批量_损失_名义在保余额+传统_损失_在保余额",
+    "非融本年累计担保金额=保函_当年_放款金额",
+    "非融在保余额=保函_在保_在保余额",
+    "非融本年累计代偿=保函_当年_代偿金额",
+    "非融本年累计损失=保函_当年_损失",
+]
+
+RULES_PROV = [
+    "中小企业借款类担保业务当年累计发生额（万元）=批量_中小_当年_实际放款+传统_中小_当年_实际放款",
+    "其中：小微企业当年累计发生额（万元）=批量_小微_当年_实际放款+传统_小微_当年_实际放款",
+    "中小企业借款类担保业务当年累计发生户数=批量_中小_当年_户数+传统_中小_当年_户数",
+    
+    "其中：小微企业当年累计发生户数=批量_小微_当年_户数+传统_小微_当年_户数",
+    "中小企业借款类担保业务当年累计发生笔数 =批量_中小_当年_笔数+传统_中小_当年_笔数",
+    "其中：小微企业当年累计发生笔数=批量_小微_当年_笔数+传统_小微_当年_笔数",
+    "中小企业借款类在保余额=批量_中小_在保_在保余额+传统_中小_在保_在保余额",
+    "其中：小微企业在保余额=批量_小微_在保_在保余额+传统_小微_在保_在保余额",
+    "中小企业借款类代偿当年累计发生额（万元）=代偿_当年_小微_代偿金额",
+    "其中：小微企业代偿当年累计发生额（万元）=代偿_当年_小微_代偿金额",
+    "个体工商户、小微企业主、新型农业经营主体担保业务当年累计发生额（不含创业小额贷款担保业务）=批量_个体工商户及小微企业主_实际放款+批量_农户及新型农业经营主体_实际放款+传统_个体工商户及小微企业主_实际放款+传统_农户及新型农业经营主体_实际放款",
+    "个体工商户、小微企业主、新型农业经营主体担保业务在保余额（不含创业小额贷款担保业务）=批量_个体工商户及小微企业主_在保_在保余额+批量_农户及新型农业经营主体_在保_在保余额+传统_个体工商户及小微企业主_在保_在保余额+传统_农户及新型农业经营主体_在保余额",
+]
+RULES_RESP = [
+    "单户金额500万及以下“三农”类在保余额（实际余额）=批量_三农_单户在保<=500_责任余额+传统_三农_单户在保<=500_责任余额",
+    "其中：单户在保余额200万人民币及以下的农户借款类担保在保余额（实际余额）=批量_农户_单户在保<=200_责任余额",
+    "单户担保金额500万元人民币及以下的小微企业借款类担保余额（实际余额）=批量_小微_单户在保<=500_责任余额+传统_小微_单户在保<=500_责任余额",
+    "单户担保金额500万元人民币及以下的小微企业借款类_其中：费率=单户担保金额500万元人民币及以下的小微企业借款类_在保_担保费/单户担保金额500万元人民币及以下的小微企业借款类_在保_名义放款",
+    "其他借款类在保余额（实际余额）= 在保_责任余额-单户担保金额500万元人民币及以下的小微企业借款类担保余额（实际余额）",
+    "其他借款类_其中：费率=其他借款类_在保_担保费/其他借款类_在保_名义放款",
+    "本月解保额=上月_在保_在保余额+当月_实际放款-在保_在保余额",
+    "本年累计解保=上一年_在保_在保余额+当年_实际放款-当年_在保_在保余额"
+]
+
+
+# 额外自定义指标，可以直接赋值，不通过公式计算
+# 额外自定义指标，可以直接赋值，不通过公式计算
+CUSTOM_VALUES = {
+    "批量_科创_当年代偿_代偿金额": 0,
+    "批量_关注_名义在保余额": 280,
+    "批量_次级_名义在保余额": 30,
+    "批量_可疑_名义在保余额": 0,
+    "批量_损失_名义在保余额": 0,
+    "保函_当年_代偿金额": 0,
+    "保函_当年_损失": 0,
+}
+
+RULES_SUPP = [
+    "批量_正常_名义在保余额=批量_在保_名义在保余额-批量_关注_名义在保余额-批量_次级_名义在保余额-批量_可疑_名义在保余额-批量_损失_名义在保余额",
+    "当月_实际放款=批量_当月_实际放款+传统_当月_实际放款",
+    "在保_在保余额=批量_在保_在保余额+传统_在保_在保余额",
+    "在保_责任余额=批量_在保_责任余额+传统_在保_责任余额",
+    "当年_实际放款=批量_当年_实际放款+传统_当年_实际放款",
+    "在保_担保费=传统_在保_担保费+批量_在保_担保费",
+    "在保_名义放款=传统_在保_名义放款+批量_在保_名义放款",
+    "单户担保金额500万元人民币及以下的小微企业借款类_在保_担保费=批量_小微_单户在保<=500_在保_担保费+传统_小微_单户在保<=500_在保_担保费",
+    "单户担保金额500万元人民币及以下的小微企业借款类_在保_名义放款=批量_小微_单户在保<=500_在保_名义放款+传统_小微_单户在保<=500_在保_名义放款",
+    "其他借款类_在保_担保费=在保_担保费-单户担保金额500万元人民币及以下的小微企业借款类_在保_担保费",
+    "其他借款类_在保_名义放款=在保_名义放款-单户担保金额500万元人民币及以下的小微企业借款类_在保_名义放款",
+]
+
+
+RULES_SUR = [
+  #  "三、当年融资担保业务"
+    "当年累计增加发生额=批量_当年_实际放款+传统_当年_实际放款",
+    "当年累计增加发生额（名义）=批量_当年_名义放款+传统_当年_名义放款",
+    "当年累计发生客户数=批量_当年_户数+传统_当年_户数",
+
+  #  "四、科创企业专项统计",
+    "本年度科创企业累计担保发生额=批量_当年_科创_实际放款",
+    "本年度科创企业累计担保发生户数=批量_当年_科创_户数",
+    "本年度科创业务担保余额=批量_科创_在保_在保余额",
+    "本年度科创业务在保户数=批量_科创_在保_户数",
+    "本年度科创企业累计代偿金额=批量_科创_当年代偿_代偿金额",
+
+  #  "五、支农支小专项统计（二者满足其一即统计）"
+    "本年度新增支农支小业务累计发生额（名义）=批量_当年_支农支小_名义放款+传统_当年_支农支小_名义放款",
+    "本年度新增支农支小业务累计发生额（实际）=批量_当年_支农支小_实际放款+传统_当年_支农支小_实际放款",
+    "本年度新增支农支小户数=批量_当年_支农支小_户数+传统_当年_支农支小_户数",
+
+  #  "六、民营企业专项统计（涵盖所有非国有制经营主体个人+企业）"
+    "本年度新增民营企业累计发生额（名义）=批量_当年_民企_名义放款+传统_当年_民企_名义放款",
+    "本年度新增民营企业累计发生额（实际）=批量_当年_民企_实际放款+传统_当年_民企_实际放款",
+    "本年度新增民企户数=批量_当年_民企_户数+传统_当年_民企_户数",
+
+   # "七、融资性担保在保余额"
+    "名义在保余额=批量_在保_名义在保余额+传统_在保_名义在保余额",
+    "银行分险金额=批量_在保_名义在保余额-批量_在保_在保余额+传统_在保_名义在保余额-传统_在保_在保余额",
+    "再担保分险金额=批量_在保_在保余额-批量_在保_责任余额+传统_在保_在保余额-传统_在保_责任余额",
+    "客户数=批量_在保_户数+传统_在保_户数",
+    "担保费率低于1%(含)的担保余额=批量_担保费率低于1%(含)_在保_在保余额+传统_担保费率低于1%(含)_在保_在保余额",
+    "1.小微企业余额（含小型企业、微型企业、个体工商户以及小微企业主）=批量_广义小微_在保_在保余额+传统_广义小微_在保_在保余额",
+    "2.小微企业户数（含小型企业、微型企业、个体工商户以及小微企业主）=批量_广义小微_在保_户数+传统_广义小微_在保_户数",
+    "其中：个体工商户及小微企业主余额=批量_个体工商户及小微企业主_在保_在保余额+传统_个体工商户及小微企业主_在保_在保余额",
+    "其中：个体工商户及小微企业主户数=批量_个体工商户及小微企业主_在保_户数+传统_个体工商户及小微企业主_在保_户数",
+    "2.农户及新型农业经营主体余额=批量_农户_在保_在保余额",
+    "2.农户及新型农业经营主体户数=批量_农户_在保_户数",
+    "3.支农支小（剔重）余额=批量_支农支小_在保_在保余额+传统_支农支小_在保_在保余额",
+    "3.支农支小（剔重）户数=批量_支农支小_在保_户数+传统_支农支小_在保_户数",
+    "首贷余额=批量_首贷户_在保_在保余额",
+    "首贷户数=批量_首贷户_在保_户数",
+
+
+
+   # "八、非融资性担保余额"
+   "非融资性担保余额=保函_在保_在保余额",
+
+]
+
+REPORT_STEPS = [
+    ("辅助计算", RULES_SUPP),
+    ("市州（辖内）融资性担保机构经营月报表（填写版）", RULES_CITY),
+    ("市州（辖内）融资性担保机构经营月报表（同比数据）", RULES_CITY_YOY),
+    ("月度担保责任余额统计表（填写版）", RULES_RESP),
+    ("成都市金融办融资性担保公司月度统计表（填写版）", RULES_CD_FIN),
+    ("四川省融资担保机构月报数据统计表", RULES_PROV),
+    ("省监管系统--月度经营情况表", RULES_SUR),
+]
+
+_FORMULA_NUM = re.compile(r'^[+-]?\d+(?:\.\d+)?$')
+
+
+def parse_formula(rule: str):
+    """
+    "目标=表达式" → (目标, 首项符号, 运算符列表, 操作数列表)；解析不了返回 None。
+    容错：两个操作数相邻当作漏了 '+'；末尾多出来的运算符照旧保留（按操作数 0 计算）。
+    """
+    m = re.match(r'\s*(.+?)\s*=\s*(.+)', rule)
+    if not m:
+        return None
+    target, expr = m.group(1).strip(), m.group(2).strip()
+    tokens = [t.strip() for t in re.split(r'([+\-*/])', expr) if t and t.strip()]
+    i, first = 0, '+'
+    if tokens and tokens[0] in ('+', '-'):     # 前缀一元 +/-（* 和 / 不作为一元）
+        first, i = tokens[0], 1
+    if i >= len(tokens):
+        return None
+    ops, operands = [], [tokens[i]]
+    i += 1
+    while i < len(tokens):
+        op = tokens[i]
+        if op not in ('+', '-', '*', '/'):
+            ops.append('+')
+            operands.append(op)
+            i += 1
+            continue
+        ops.append(op)
+        if i + 1 < len(tokens):
+            operands.append(tokens[i + 1])
+        i += 2
+    return target, first, ops, operands
+
+
+def _safe_div(a, b):
+    """a / b，除数为 0 得 0；任一边是数组时逐元素算（情景测算）。"""
+    if np.ndim(a) == 0 and np.ndim(b) == 0:
+        return (a / b) if b != 0 else 0.0
+    a, b = np.broadcast_arrays(np.asarray(a, dtype=float), np.asarray(b, dtype=float))
+    return np.divide(a, b, out=np.zeros(a.shape), where=b != 0)
+
+
+def eval_terms(first: str, ops, values):
+    """按 first/ops 把 values 算出来：先乘除后加减，从左到右。values 可以混着标量和 NumPy 列。"""
+    term, add, total = values[0], first, None
+    for idx, op in enumerate(ops, start=1):
+        v = values[idx] if idx < len(values) else 0.0
+        if op == '*':
+            term = term * v
+        elif op == '/':
+            term = _safe_div(term, v)
+        else:
+            total = (term if add == '+' else -term) if total is None else (total + term if add == '+' else total - term)
+            term, add = v, op
+    return (term if add == '+' else -term) if total is None else (total + term if add == '+' else total - term)
+
+
+_MISSING = object()
+
+
+def _same_value(a, b) -> bool:
+    if a is _MISSING or b is _MISSING:
+        return a is b
+    return a == b or (pd.isna(a) and pd.isna(b))
+
+
+def _num(v):
+    if isinstance(v, np.ndarray):
+        return np.where(np.isnan(v), 0.0, v)
+    try:
+        return float(v) if pd.notna(v) else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class FormulaProgram:
+    """
+    报表各步的公式编译一次，按列表顺序求值（与逐条算、结果写回同一个字典的写法结果相同）。
+    - 每条公式是一个节点（同名目标的多次定义是不同节点）；操作数引用它之前最近的同名定义，
+      之前没有的取输入（统计结果、手填值），输入里也没有按 0 算。
+      之前没有、之后才有定义的算"向前引用"：照样取输入或 0，列在 problems 里。
+    - evaluate 传入上一次的结果时，只重算输入有变化的公式及其下游。
+    """
+
+    def __init__(self, steps):
+        self.steps = [title for title, _ in steps]
+        self.nodes = []                  # (步骤序号, 目标, 首项符号, 运算符, 操作数)
+        for k, (_, rules) in enumerate(steps):
+            for rule in rules:
+                parsed = parse_formula(rule)
+                if parsed is not None:
+                    self.nodes.append((k, *parsed))
+        defs: dict[str, list] = {}
+        for j, node in enumerate(self.nodes):
+            defs.setdefault(node[1], []).append(j)
+        self.problems: list[tuple] = []  # (问题, 步骤, 目标, 涉及的指标)
+        self.refs = []                   # 各操作数的来源：("node", j) / ("input", 名) / ("const", 数)
+        for j, (k, target, _, _, operands) in enumerate(self.nodes):
+            refs = []
+            for tok in operands:
+                before = [i for i in defs.get(tok, ()) if i < j]
+                if before:
+                    refs.append(("node", before[-1]))
+                elif tok in defs:
+                    refs.append(("input", tok))
+                    self.problems.append(("向前引用", self.steps[k], target, tok))
+                elif _FORMULA_NUM.match(tok):
+                    refs.append(("const", float(tok)))
+                else:
+                    refs.append(("input", tok))
+            self.refs.append(refs)
+        for name, js in defs.items():
+            if len({tuple(map(str, self.nodes[i][2:])) for i in js}) > 1:     # 同一个目标、公式却不一样
+                self.problems.append(("重复定义且公式不同", "、".join(dict.fromkeys(self.steps[self.nodes[i][0]] for i in js)), name, f"{len(js)} 处"))
+        self.targets = set(defs)
+        self.inputs = {x for refs in self.refs for kind, x in refs if kind == "input"}
+
+    def diagnostics(self, known) -> pd.DataFrame:
+        """
+        公式检查：向前引用、同名目标公式不一致，以及引用了 known（统计结果、手填值等已知指标）
+        之外、也没有公式定义的名字——这些永远按 0 计算。向前引用的名字在 known 里时取的是输入，不算问题。
+        """
+        known = set(known)
+        rows = [p for p in self.problems if not (p[0] == "向前引用" and p[3] in known)]
+        for (k, target, *_), refs in zip(self.nodes, self.refs):
+            rows += [("未定义", self.steps[k], target, x) for kind, x in refs
+                     if kind == "input" and x not in known and x not in self.targets]
+        return pd.DataFrame(rows, columns=["问题", "步骤", "目标", "指标"]).drop_duplicates(ignore_index=True)
+
+    def evaluate(self, inputs: dict, prev: "SimpleNamespace | None" = None) -> SimpleNamespace:
+        """求值。返回的 run.values 与节点一一对应，run.results 是 输入 + 各目标最后一次定义的值。"""
+        inputs = dict(inputs)
+        values = list(prev.values) if prev is not None and prev.program is self else [None] * len(self.nodes)
+        if prev is not None and prev.program is self:
+            changed = {k for k in self.inputs if not _same_value(inputs.get(k, _MISSING), prev.inputs.get(k, _MISSING))}
+            dirty = [any(kind == "input" and x in changed for kind, x in refs) for refs in self.refs]
+        else:
+            dirty = [True] * len(self.nodes)
+        for j in range(len(self.nodes)):            # 操作数只引用之前的节点，按顺序算即可
+            if not dirty[j] and not any(dirty[x] for kind, x in self.refs[j] if kind == "node"):
+                continue
+            dirty[j] = True
+            _, _, first, ops, _ = self.nodes[j]
+            values[j] = _num(eval_terms(first, ops, [self._value(r, inputs, values) for r in self.refs[j]]))
+        results = dict(inputs)
+        for j, node in enumerate(self.nodes):
+            results[node[1]] = values[j]
+        return SimpleNamespace(program=self, inputs=inputs, values=values, results=results,
+                               recomputed=sum(dirty))
+
+    def evaluate_many(self, inputs: dict, scenarios: pd.DataFrame) -> pd.DataFrame:
+        """
+        情景测算：scenarios 每行一组覆盖值（列是输入指标名，空着的沿用 inputs），
+        全部公式按 NumPy 列一次算完，返回 情景 × 指标（覆盖的指标 + 各公式目标）。
+        公式目标不能覆盖（覆盖值只会被向前引用读到，公式算出的值不变），有的话报 ValueError。
+        """
+        bad = [c for c in scenarios.columns if c in self.targets]
+        if bad:
+            raise ValueError(f"情景表不能覆盖公式算出的指标：{'、'.join(map(str, bad))}")
+        n = len(scenarios)
+        inputs = dict(inputs)
+        for col in scenarios.columns:
+            v = pd.to_numeric(scenarios[col], errors="coerce").to_numpy(dtype=float)
+            inputs[col] = np.where(np.isnan(v), inputs.get(col, 0.0), v)
+        results = self.evaluate(inputs).results
+        cols = list(dict.fromkeys([*scenarios.columns, *(node[1] for node in self.nodes)]))
+        return pd.DataFrame(
+            {c: np.broadcast_to(np.asarray(results[c], dtype=float), (n,)) for c in cols}, index=scenarios.index
+        )
+
+    @staticmethod
+    def _value(ref, inputs, values):
+        kind, x = ref
+        if kind == "node":
+            return values[x]
+        if kind == "const":
+            return x
+        return inputs.get(x, 0.0)
+
+    def step_frame(self, run, k: int) -> pd.DataFrame:
+        """第 k 步的展示表：每行 "目标 值 操作数 值 …"，减号、除号的操作数前加标记。"""
+        rows = []
+        for j, (step, target, first, ops, operands) in enumerate(self.nodes):
+            if step != k:
+                continue
+            row = [target, run.values[j]]
+            for tok, sign, ref in zip(operands, [first] + ops, self.refs[j]):
+                label = {'-': f"（➖）{tok}", '/': f"（➗）{tok}"}.get(sign, tok)
+                row += [label, self._value(ref, run.inputs, run.values)]
+            rows.append(row)
+        width = max((len(r) for r in rows), default=0)
+        return pd.DataFrame([r + [None] * (width - len(r)) for r in rows], columns=[str(i + 1) for i in range(width)])
+
+
+@shared()
+def report_program() -> FormulaProgram:
+    return FormulaProgram(REPORT_STEPS)
+
+
+# ===================== 导出 =====================
+@shared()
+def _digest_memo() -> dict:
+    return {}
+
+
+def frame_digest(obj) -> str:
+    """DataFrame/Series 内容的哈希；同一个对象只算一次（对象释放后自动清掉）。"""
+    memo = _digest_memo()
+    key = id(obj)
+    hit = memo.get(key)
+    if hit is None:
+        h = hashlib.sha256(repr((getattr(obj, "name", None), list(getattr(obj, "columns", [])))).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+        hit = memo[key] = h.hexdigest()
+        weakref.finalize(obj, memo.pop, key, None)
+    return hit
+
+
+def _cell(v):
+    if v is None or v is pd.NaT or (isinstance(v, float) and np.isnan(v)):
+        return None
+    if isinstance(v, pd.Timestamp):
+        return v.to_pydatetime()
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+def write_workbook(sheets: dict) -> bytes:
+    """
+    {工作表名: DataFrame} 写成一个 xlsx（不写行索引）。有 xlsxwriter 时用 constant_memory 模式逐行写，
+    内存只占一行；没有就退回 pandas + openpyxl。
+    """
+    out = BytesIO()
+    names = {}
+    for name in sheets:                                  # 工作表名：去掉非法字符、截到 31 字、去重
+        base = re.sub(r"[\[\]:*?/\\]", "_", str(name))[:31] or "Sheet"
+        alias, i = base, 1
+        while alias in names.values():
+            i += 1
+            alias = f"{base[:28]}_{i}"
+        names[name] = alias
+    if xlsxwriter is None:
+        with pd.ExcelWriter(out, engine="openpyxl") as writer:
+            for name, df in sheets.items():
+                df.to_excel(writer, sheet_name=names[name], index=False)
+        return out.getvalue()
+    wb = xlsxwriter.Workbook(out, {
+        "constant_memory": True, "strings_to_formulas": False, "strings_to_urls": False,
+        "nan_inf_to_errors": True, "default_date_format": "yyyy-mm-dd hh:mm:ss",
+    })
+    head = wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    for name, df in sheets.items():
+        ws = wb.add_worksheet(names[name])
+        ws.write_row(0, 0, [_cell(c) for c in df.columns], head)
+        for r, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            ws.write_row(r, 0, [_cell(v) for v in row])
+    wb.close()
+    return out.getvalue()
+
+
+def overdue_view(df: pd.DataFrame, first) -> pd.DataFrame:
+    """到期未清零明细：把 first 里的列挪到最前面。"""
+    return df[list(first) + [c for c in df.columns if c not in first]]
+
+
+OVERDUE_FIRST = {
+    "trad_overdue": ["在保余额", "实际到期时间"],
+    "batch_overdue": ["在保余额", "主债权到期日期"],
+}
+RESULT_SHEETS = {"trad_res": "传统统计", "batch_res": "批量统计", "baohan_res": "保函统计", "daichang_res": "代偿统计"}
+OVERDUE_SHEETS = {"trad_overdue": "传统到期未清零", "batch_overdue": "批量到期未清零"}
+
+
+def report_inputs(results: dict, manual: dict) -> dict:
+    """报表公式的输入：四类统计结果 + 手填的以前数据（HISTORY_PREFILL 那几项）+ 直接赋值的 CUSTOM_VALUES。"""
+    inputs = {}
+    for key in RESULT_SHEETS:
+        if key in results:
+            inputs.update(results[key])
+    inputs.update(manual)
+    inputs.update(CUSTOM_VALUES)
+    return inputs
+
+
+def results_frame(values: dict) -> pd.DataFrame:
+    """报表“全部结果”表：指标、数值两列，取不到数的按 0。"""
+    df = pd.Series(values, name="数值").reset_index().rename(columns={"index": "指标"})
+    df["数值"] = pd.to_numeric(df["数值"], errors="coerce").fillna(0.0)
+    return df
+
+
+def results_workbook(results: dict, manual: dict) -> bytes:
+    """
+    全部结果合成一个工作簿：四类统计结果 + 报表各步的表 + 到期未清零明细。
+    results 同 run_statistics 的返回值；manual 是报表用的手填值。
+    """
+    sheets = {RESULT_SHEETS[key]: results[key].rename_axis("指标").reset_index()
+              for key in RESULT_SHEETS if key in results}
+    program = report_program()
+    run = program.evaluate(report_inputs(results, manual))
+    for k, title in enumerate(program.steps):
+        sheets[title] = program.step_frame(run, k)
+    for key in OVERDUE_SHEETS:
+        if key in results:
+            df = results[key]
+            sheets[OVERDUE_SHEETS[key]] = overdue_view(df, OVERDUE_FIRST[key]) if not df.empty else df
+    return write_workbook(sheets)
+
+
+# ===================== 报表模板 =====================
+# 监管报表模板（.xlsx）放在 templates/ 目录，或在报表页临时上传。模板里加一张“映射”工作表，
+# 三列：工作表、单元格、指标（报表公式的目标名或统计指标名），填报时按它把数写进对应单元格，
+# 输出的文件里去掉“映射”表，其余格式原样保留。
+TEMPLATE_DIR = Path(os.environ.get("TAIZHANG_TEMPLATE_DIR", Path(__file__).resolve().parent / "templates"))
+TEMPLATE_MAP_SHEET = "映射"
+TEMPLATE_MAP_COLUMNS = ["工作表", "单元格", "指标"]
+
+
+class ReportTemplate:
+    """一个模板工作簿：原始字节 + 检查过的映射。对象在会话间共用，只读；每次填报从字节重新打开。"""
+
+    def __init__(self, name: str, data: bytes):
+        self.name, self.data = name, data
+        self.sha = hashlib.sha256(data).hexdigest()
+        self.mapping: list[tuple] = []       # (工作表, 单元格, 指标)
+        self.problems: list[str] = []
+        wb = load_workbook(BytesIO(data))
+        if TEMPLATE_MAP_SHEET not in wb.sheetnames:
+            self.problems.append(f"没有“{TEMPLATE_MAP_SHEET}”工作表")
+            return
+        rows = wb[TEMPLATE_MAP_SHEET].iter_rows(values_only=True)
+        header = [str(v).strip() if v is not None else "" for v in next(rows, ())]
+        if not set(TEMPLATE_MAP_COLUMNS) <= set(header):
+            self.problems.append(f"“{TEMPLATE_MAP_SHEET}”表第一行应为：{'、'.join(TEMPLATE_MAP_COLUMNS)}")
+            return
+        pos = [header.index(c) for c in TEMPLATE_MAP_COLUMNS]
+        for row in rows:
+            sheet, cell, metric = (str(row[i]).strip() if i < len(row) and row[i] is not None else "" for i in pos)
+            if not (sheet and cell and metric):
+                continue
+            cell = cell.upper().replace("$", "")
+            if sheet not in wb.sheetnames or sheet == TEMPLATE_MAP_SHEET:
+                self.problems.append(f"{sheet}!{cell}：模板里没有工作表“{sheet}”")
+            elif not re.fullmatch(r"[A-Z]{1,3}[1-9]\d*", cell):
+                self.problems.append(f"{sheet}!{cell}：单元格地址不对")
+            elif isinstance(wb[sheet][cell], MergedCell):
+                self.problems.append(f"{sheet}!{cell}：在合并单元格里，应填左上角那一格")
+            else:
+                self.mapping.append((sheet, cell, metric))
+
+    def fill(self, values: dict) -> bytes:
+        """按映射一次填完所有单元格；values 里没有的指标保留模板原样。"""
+        wb = load_workbook(BytesIO(self.data))
+        for sheet, cell, metric in self.mapping:
+            if metric in values:
+                wb[sheet][cell] = _cell(values[metric])
+        del wb[TEMPLATE_MAP_SHEET]
+        out = BytesIO()
+        wb.save(out)
+        return out.getvalue()
+
+
+@shared(max_entries=32)
+def _template_file(path: str, mtime_ns: int, size: int) -> ReportTemplate:
+    return ReportTemplate(Path(path).name, Path(path).read_bytes())
+
+
+def directory_templates() -> list:
+    """templates/ 目录里的模板；文件没变就不再重新解析。"""
+    found = []
+    if TEMPLATE_DIR.is_dir():
+        for p in sorted(TEMPLATE_DIR.glob("*.xlsx")):
+            if not p.name.startswith("~$"):             # Excel 打开时的锁文件
+                stat = p.stat()
+                found.append(_template_file(str(p), stat.st_mtime_ns, stat.st_size))
+    return found
+
+
+def template_mapping_sample(program: "FormulaProgram") -> bytes:
+    """“映射”表样例：列出报表各步的全部目标，单元格留空，方便照着填进模板。"""
+    rows = [(program.steps[node[0]], "", node[1]) for node in program.nodes]
+    sample = pd.DataFrame(rows, columns=TEMPLATE_MAP_COLUMNS).drop_duplicates("指标", keep="last")
+    return write_workbook({TEMPLATE_MAP_SHEET: sample})
+
+
+# ===================== 执行统计 =====================
+class LedgerStore:
+    """
+    一组输入文件读出来的台账 + 各台账的指标引擎（页面上放在 session_state 里）。
+    只改统计基准日期时整份复用：不再读文件，引擎里与日期无关的掩码也不重算。
+    """
+
+    def __init__(self, sig: str):
+        self.sig = sig
+        self.frames = {}
+        self.engines = {}
+
+    def fork(self) -> "LedgerStore":
+        """
+        后台统计用的副本：已读的台账照用；引擎各复制一份（MetricEngine.copy），
+        换统计基准日期时 rebind 改的是副本，页面上这份和还没停下的上一轮统计都不受影响。
+        """
+        other = LedgerStore(self.sig)
+        other.frames = dict(self.frames)
+        other.engines = {kind: eng.copy() for kind, eng in self.engines.items()}
+        return other
+
+    def frame(self, kind: str, build):
+        if kind not in self.frames:
+            self.frames[kind] = build()
+        return self.frames[kind]
+
+    def engine(self, kind: str, df: pd.DataFrame):
+        eng = self.engines.get(kind)
+        if eng is None or eng.df is not df:
+            eng = self.engines[kind] = METRIC_ENGINES[LEDGER_ENGINE](df, {}, LEDGER_RULES[kind][1])
+        return eng
+
+
+STAT_FILE_KEYS = ["filter_file", "trad_file", "batch_file", "baohan_file", "daichang_file"]
+
+
+def overdue_rows(df: pd.DataFrame, due_col: str, as_of_dt: pd.Timestamp) -> pd.DataFrame:
+    """到期日早于基准日、在保余额仍不为 0 的明细。"""
+    return df[
+        (df[due_col].notna()) &
+        (df[due_col] < as_of_dt.normalize()) &
+        (df["在保余额"] != 0)
+    ]
+
+
+def run_statistics(files: dict, as_of, ledgers: LedgerStore, step) -> dict:
+    """
+    “执行统计”的全部计算：读四类台账、算指标、挑出到期未清零的明细。不碰 session_state，结果以 dict 返回。
+    files：STAT_FILE_KEYS -> 文件（不参与统计为 None）；
+    step(key, label)：和 status_log 一样的上下文管理器，给出 (log, done)。
+    """
+    filter_file, trad_file, batch_file, baohan_file, daichang_file = (files.get(k) for k in STAT_FILE_KEYS)
+    as_of_dt = pd.to_datetime(as_of)
+    res = {}
+
+    # 四份台账先在进程池里一起解析，下面各段读取时直接用解析结果
+    todo = pending_parses(ledger_parse_requests(
+        {"baohan": baohan_file, "batch": batch_file, "trad": trad_file, "daichang": daichang_file},
+        filter_file, loaded=ledgers.frames))
+    if PROCESS_WORKERS > 1 and len(todo) > 1:
+        with step("ingest", f"并行读取 {len(todo)} 个工作表…") as (log, done):
+            t0 = time.perf_counter()
+            ok = parse_parallel(todo, log)
+            done(f"并行读取完成：{ok}/{len(todo)} 个工作表，{time.perf_counter() - t0:.1f}s")
+
+    with step("baohan", "读取保函…") as (log, done):
+        if baohan_file is None:
+            done("无保函文件，相关指标显示为0", "error")
+        elif baohan_file:
+            df_baohan = ledgers.frame("baohan", lambda: load_cached("baohan", [baohan_file], _load_baohan_inline, baohan_file))
+            log(f"• 保函表已读取：{df_baohan.shape[0]} 行 × {df_baohan.shape[1]} 列")
+
+            log("• 统计保函指标…")
+            res["baohan_res"] = calc_baohan_metrics(df_baohan, as_of_dt, ledgers.engine("baohan", df_baohan))
+            done("保函统计完成")
+    with step("batch", "读取批量…") as (log, done):
+        if batch_file is None:
+            done("无批量文件，相关指标显示为0", "error")
+        elif batch_file:
+            df_batch, df_batch2 = ledgers.frame("batch", lambda: load_batch_frames(batch_file, filter_file))
+
+            df_batch_overdue = overdue_rows(df_batch, "主债权到期日期", as_of_dt)
+            log("批量在保余额检查")
+            res["batch_overdue"] = df_batch_overdue
+            log("统计批量指标")
+            res["batch_res"] = calc_batch_metrics(df_batch, as_of_dt, ledgers.engine("batch", df_batch))
+            done("批量统计完成")
+    with step("trad", "读取传统…") as (log, done):
+        if trad_file is None:
+            done("无传统文件，相关指标显示为0", "error")
+        if trad_file:
+            df_trad = ledgers.frame("trad", lambda: load_cached("trad", [trad_file, filter_file], load_trad_data, trad_file, filter_file))
+            log(f"• 传统表已读取：{df_trad.shape[0]} 行 × {df_trad.shape[1]} 列")
+            df_trad_overdue = overdue_rows(df_trad, "实际到期时间", as_of_dt)
+            res["trad_overdue"] = df_trad_overdue
+            log("传统在保余额检查...")
+            res["trad_res"] = calc_trad_metrics(df_trad, as_of_dt, ledgers.engine("trad", df_trad))
+            done("传统统计完成")
+    with step("daichang", "读取代偿…") as (log, done):
+        if daichang_file is None:
+            done("无代偿文件，相关指标显示为0", "error")
+        if daichang_file and batch_file:
+            df_daichang = ledgers.frame("daichang", lambda: load_cached(
+                "daichang", [daichang_file, batch_file, filter_file], load_daichang_data, daichang_file, df_batch2))
+            res["df_daichang"] = df_daichang
+            log(f"• 代偿表已读取：{df_daichang.shape[0]} 行 × {df_daichang.shape[1]} 列")
+            log("统计代偿指标…")
+            res["daichang_res"] = calc_daichang_metrics(df_daichang, as_of_dt, ledgers.engine("daichang", df_daichang))
+            done("代偿统计完成")
+    return res
+
+
+# ===================== 报表 =====================
+def previous_dates(as_of) -> dict:
+    """报表“以前的数据”取哪天的历史结果：上月末、上年末。"""
+    as_of = pd.Timestamp(as_of)
+    return {
+        "上月": (as_of.replace(day=1) - pd.Timedelta(days=1)).date(),
+        "上一年": (as_of.replace(month=1, day=1) - pd.Timedelta(days=1)).date(),
+    }
+
+
+def history_prefill(history: ResultHistory, as_of, entity: str = "") -> dict:
+    """HISTORY_PREFILL 里能从该主体的历史结果带出来的项：{输入名: (历史基准日期, 值)}。"""
+    out = {}
+    for p, day in previous_dates(as_of).items():
+        keys = [k for k in HISTORY_PREFILL if k.startswith(p + "_")]
+        found = history.lookup(day, {HISTORY_PREFILL[k] for k in keys}, entity)
+        out.update({k: (day, found[HISTORY_PREFILL[k]]) for k in keys if HISTORY_PREFILL[k] in found})
+    return out
+
+
+def has_report(results: dict) -> bool:
+    """有放款类指标（传统或批量参与了统计）才出报表，同报表页。"""
+    return any("_名义放款" in k for key in RESULT_SHEETS if key in results for k in results[key].index)
+
+
+def report_results(results: dict, manual: dict) -> dict:
+    """报表“全部结果”{指标: 数值}（同报表页的 final_all_res）；没有放款类指标时为空。"""
+    if not has_report(results):
+        return {}
+    run = report_program().evaluate(report_inputs(results, manual))
+    df = results_frame(run.results)
+    return dict(zip(df["指标"], df["数值"]))
+
+
+# ===================== 批量运行 =====================
+# 不开页面跑完整统计（命令行、定时任务用，见 taizhang_cli.py）：读取照常走解析缓存、sidecar，
+# 报表结果照常存进历史结果库，页面上打开同样的文件、同一基准日期可以直接复用。
+class LocalFile:
+    """本地工作簿，当作上传文件用：和 UploadHandle 一样有 open / getvalue / path。"""
+
+    def __init__(self, path):
+        self._path = Path(path)
+        self.name = self._path.name
+        h = hashlib.sha256()
+        with open(self._path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        self._sha256 = h.hexdigest()
+
+    def open(self):
+        return open(self._path, "rb")
+
+    def getvalue(self) -> bytes:
+        return self._path.read_bytes()
+
+    def path(self):
+        return self._path
+
+
+def input_signature(files: dict) -> str:
+    """一组输入文件的签名，格式同页面的 _ingest_signature（给了的文件都算参与统计）。"""
+    parts = []
+    for key in STAT_FILE_KEYS:
+        f = files.get(key)
+        used = f is not None
+        parts.append(f"{key}:{used}:{used}:{getattr(f, 'name', '')}:{file_sha256(f) if used else ''}")
+    return "|".join(parts)
+
+
+def _log_line(line) -> None:
+    level, msg, frame = line
+    if frame is not None:
+        msg = f"{msg}\n{frame.to_string(max_rows=20)}"
+    logger.log(logging.WARNING if level == "warning" else logging.INFO, msg)
+
+
+@contextmanager
+def log_step(key: str, label: str):
+    """run_statistics 的 step：进度和 notify 的提示都写 logging。"""
+    logger.info(label)
+
+    def log(msg: str):
+        logger.info("  %s", msg)
+
+    def done(new_label: str, new_state: str = "complete", new_expanded: bool | None = False):
+        logger.log(logging.WARNING if new_state == "error" else logging.INFO, new_label)
+
+    with notify_to(_log_line):
+        yield log, done
+
+
+def run_pipeline(paths: dict, as_of, *, manual: dict | None = None, history: ResultHistory | None = None,
+                 entity: str = "", step=log_step) -> SimpleNamespace:
+    """
+    完整统计一次：paths 是 STAT_FILE_KEYS -> 工作簿路径（没有的给 None 或不给），筛选条件必须有。
+    manual：报表的手填值，没给的从历史结果库带出（同报表页），再没有按 0；
+    history：给了就把报表结果存进去；entity 是历史结果库里的主体（带出、保存都只看这个主体）。
+    返回 results（run_statistics 的结果，明细表补齐了列）、manual、report（报表“全部结果”，没有放款类指标时为空）、
+    frames（读出来的台账，格式同 LedgerStore.frames）。
+    """
+    files = {k: LocalFile(paths[k]) if paths.get(k) else None for k in STAT_FILE_KEYS}
+    if files["filter_file"] is None:
+        raise ValueError("缺少筛选条件文件")
+    sig = input_signature(files)
+    ledgers = LedgerStore(sig)
+    results = result_details(run_statistics(files, as_of, ledgers, step), files)
+
+    found = history_prefill(history, as_of, entity) if history is not None else {}
+    manual = {k: float((manual or {}).get(k, found.get(k, (None, 0.0))[1] or 0.0)) for k in HISTORY_PREFILL}
+    report = report_results(results, manual)
+    if report and history is not None:
+        history.save(as_of, hashlib.sha256(sig.encode()).hexdigest()[:32], report, entity)
+    return SimpleNamespace(results=results, manual=manual, report=report, signature=sig, frames=ledgers.frames)
+
+
+# ===================== 多主体合并 =====================
+# 几家子公司各有一套工作簿：各主体的整套统计放进进程池同时跑，子进程把指标和读出来的台账一起送回；
+# 合并口径不是把各主体的指标相加，而是把同类台账拼成一张表再按同样的规则统计一遍，
+# 这样户数、单户在保 / 单户责任前10 这类按客户汇总的指标在主体之间自动去重。
+CONSOLIDATED = "合并"
+
+
+def _entity_run(paths: dict, as_of, manual: dict) -> SimpleNamespace:
+    # 进程池任务。合并模式只输出文件，不读写历史结果库
+    return run_pipeline(paths, as_of, manual=manual)
+
+
+def _stack(parts: dict) -> pd.DataFrame:
+    """{主体: 台账} 拼成一张，最前面加一列“主体”。"""
+    frames = []
+    for name, df in parts.items():
+        df = df.copy(deep=False)
+        df.insert(0, "主体", name)
+        frames.append(df)
+    return compact_ledger(pd.concat(frames, ignore_index=True))
+
+
+def consolidated_frames(runs: dict) -> dict:
+    """各主体的台账（LedgerStore.frames 的格式）按类拼接。"""
+    out = {}
+    for kind in ["baohan", "trad", "daichang"]:
+        parts = {name: run.frames[kind] for name, run in runs.items() if kind in run.frames}
+        if parts:
+            out[kind] = _stack(parts)
+    parts = {name: run.frames["batch"] for name, run in runs.items() if "batch" in run.frames}
+    if parts:
+        out["batch"] = tuple(_stack({name: p[i] for name, p in parts.items()}) for i in range(2))
+    return out
+
+
+def consolidated_results(frames: dict, as_of, details: dict | None = None) -> dict:
+    """
+    拼接后的台账按 run_statistics 的口径再统计一遍，结果格式也相同。
+    details：{主体: run_pipeline 的 results}，给了就把各主体补齐列的明细表拼起来当合并的明细
+    （明细只是筛行，拼起来与在拼接台账上筛的行相同）。
+    """
+    as_of_dt = pd.to_datetime(as_of)
+    ledgers, res = LedgerStore(CONSOLIDATED), {}
+    if "baohan" in frames:
+        df = frames["baohan"]
+        res["baohan_res"] = calc_baohan_metrics(df, as_of_dt, ledgers.engine("baohan", df))
+    if "batch" in frames:
+        df = frames["batch"][0]
+        res["batch_overdue"] = overdue_rows(df, "主债权到期日期", as_of_dt)
+        res["batch_res"] = calc_batch_metrics(df, as_of_dt, ledgers.engine("batch", df))
+    if "trad" in frames:
+        df = frames["trad"]
+        res["trad_overdue"] = overdue_rows(df, "实际到期时间", as_of_dt)
+        res["trad_res"] = calc_trad_metrics(df, as_of_dt, ledgers.engine("trad", df))
+    if "daichang" in frames:
+        df = res["df_daichang"] = frames["daichang"]
+        res["daichang_res"] = calc_daichang_metrics(df, as_of_dt, ledgers.engine("daichang", df))
+    for key in DETAIL_SOURCES:
+        parts = {name: r[key] for name, r in (details or {}).items() if key in r}
+        if key in res and parts:
+            res[key] = _stack(parts)
+    return res
+
+
+def run_consolidation(entities: dict, as_of, *, manual: dict | None = None) -> dict:
+    """
+    多主体统计 + 合并。entities：{主体名: (STAT_FILE_KEYS -> 路径, 手填值)}；
+    主体之间在进程池里并行（PROCESS_WORKERS < 2 或只有一个主体时逐个跑）。
+    manual：合并口径的手填值，没给的取各主体手填值之和。
+    返回 {主体名: run_pipeline 的结果, …, CONSOLIDATED: 合并的结果}，合并结果没有 signature。
+    """
+    if CONSOLIDATED in entities:
+        raise ValueError(f"主体名不能叫“{CONSOLIDATED}”")
+    runs, t0 = {}, time.perf_counter()
+
+    def finished(name, run):
+        runs[name] = run
+        logger.info("%s：统计完成（%.1fs）", name, time.perf_counter() - t0)
+
+    todo = dict(entities)
+    if PROCESS_WORKERS > 1 and len(todo) > 1:
+        futures = {}
+        try:
+            pool = process_pool(PROCESS_WORKERS)
+            futures = {pool.submit(_entity_run, paths, as_of, m): name for name, (paths, m) in todo.items()}
+            for fut in as_completed(futures):
+                name = futures[fut]
+                try:
+                    finished(name, fut.result())
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    raise RuntimeError(f"主体“{name}”统计出错：{e!r}") from e
+                del todo[name]
+        except BrokenProcessPool:
+            process_pool.clear()
+            logger.warning("统计进程异常退出，其余主体逐个统计")
+        finally:
+            for fut in futures:
+                fut.cancel()
+    for name, (paths, m) in todo.items():
+        try:
+            finished(name, _entity_run(paths, as_of, m))
+        except Exception as e:
+            raise RuntimeError(f"主体“{name}”统计出错：{e!r}") from e
+
+    runs = {name: runs[name] for name in entities}      # 按清单顺序
+    results = consolidated_results(consolidated_frames(runs), as_of,
+                                   {name: run.results for name, run in runs.items()})
+    manual = {k: float((manual or {}).get(k, sum(run.manual[k] for run in runs.values()))) for k in HISTORY_PREFILL}
+    runs[CONSOLIDATED] = SimpleNamespace(results=results, manual=manual, report=report_results(results, manual),
+                                         signature=None, frames=None)
+    logger.info("%s：统计完成（%.1fs）", CONSOLIDATED, time.perf_counter() - t0)
+    return runs
+
+
+def consolidation_frame(runs: dict) -> pd.DataFrame:
+    """各主体 + 合并的报表“全部结果”并排：指标 × 主体，某主体没有的指标为空。"""
+    names = list(dict.fromkeys(k for run in runs.values() for k in run.report))
+    table = pd.DataFrame({name: [run.report.get(k) for k in names] for name, run in runs.items()}, index=names)
+    return table.rename_axis("指标").reset_index()
@@ -0,0 +1,187 @@
+"""
+上传文件库（不依赖 streamlit）。
+
+同样内容的上传在进程里只存一份（按 SHA-256），所有会话共用同一个只读句柄，读取时不再复制；
+超过内存预算就把最久没用的文件落到临时目录，读时 mmap 回来。
+会话每次运行都登记自己在用的文件，闲置太久的会话不再算引用，没人引用的文件随即释放。
+"""
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+from types import SimpleNamespace
+
+UPLOAD_MEMORY_BUDGET = int(os.environ.get("TAIZHANG_UPLOAD_BUDGET_MB", 512)) << 20
+UPLOAD_IDLE_SECONDS = 4 * 3600
+
+
+class UploadExpired(RuntimeError):
+    """上传的文件已被清理（会话闲置太久），需要重新上传。"""
+
+
+class _ViewFile(io.RawIOBase):
+    """memoryview 上的只读文件对象（mmap 在 Python 3.13 之前没有 seekable()，zipfile 用不了）。"""
+
+    def __init__(self, view: memoryview):
+        self._view, self._pos = view, 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else self._pos + size
+        data = bytes(self._view[self._pos:end])
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class UploadHandle:
+    """上传文件的只读句柄：open() 每次返回一个从头读的文件对象，view() 返回 memoryview，都不复制内容。"""
+
+    def __init__(self, store: "UploadStore", sha: str, size: int):
+        self._store, self._sha256, self.size = store, sha, size
+
+    def open(self):
+        return self._store.open(self._sha256)
+
+    def view(self) -> memoryview:
+        return self._store.view(self._sha256)
+
+    def getvalue(self) -> bytes:
+        """兼容只认 BytesIO 的调用方（会复制一份）。"""
+        return bytes(self.view())
+
+    def path(self):
+        """落盘文件的路径；还在内存里时返回 None。"""
+        return self._store.path(self._sha256)
+
+
+class UploadStore:
+    """上传文件库：put 存入、touch 登记会话在用的文件；按 sha 取已被清理的文件时抛 UploadExpired。"""
+
+    def __init__(self, budget: int = UPLOAD_MEMORY_BUDGET, idle_seconds: float = UPLOAD_IDLE_SECONDS):
+        self.budget, self.idle_seconds = budget, idle_seconds
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict()   # sha -> SimpleNamespace(data, path, handle)，最近用过的在后
+        self._sessions: dict[str, tuple] = {}        # 会话 token -> (最后活动时间, 引用的 sha 集合)
+        self._dir = None
+        self.in_memory = 0
+
+    def put(self, data, token: str) -> UploadHandle:
+        view = memoryview(data).cast("B")
+        sha = hashlib.sha256(view).hexdigest()
+        with self._lock:
+            e = self._entries.get(sha)
+            if e is None:
+                e = self._entries[sha] = SimpleNamespace(data=bytes(view), path=None,
+                                                         handle=UploadHandle(self, sha, view.nbytes))
+                self.in_memory += view.nbytes
+            self._entries.move_to_end(sha)
+            _, shas = self._sessions.get(token, (0, frozenset()))
+            self._sessions[token] = (time.time(), shas | {sha})
+            self._enforce_budget()
+            return e.handle
+
+    def touch(self, token: str, shas) -> list:
+        """登记会话 token 当前在用的文件，顺便清理闲置会话；返回其中已经被清理掉的 sha。"""
+        now = time.time()
+        with self._lock:
+            self._sessions[token] = (now, frozenset(s for s in shas if s))
+            for t, (seen, _) in list(self._sessions.items()):
+                if now - seen > self.idle_seconds:
+                    del self._sessions[t]
+            used = set().union(*(s for _, s in self._sessions.values()))
+            for sha in [s for s in self._entries if s not in used]:
+                self._drop(sha)
+            return [s for s in self._sessions[token][1] if s not in self._entries]
+
+    def _entry(self, sha: str):
+        with self._lock:
+            e = self._entries.get(sha)
+            if e is None:
+                raise UploadExpired(sha)
+            self._entries.move_to_end(sha)
+            return e
+
+    def open(self, sha: str):
+        e = self._entry(sha)
+        data = e.data
+        if data is not None:
+            return BytesIO(data)                  # BytesIO 直接共用 bytes，不复制
+        if e.handle.size == 0:
+            return BytesIO(b"")
+        return _ViewFile(self._map(e))
+
+    def view(self, sha: str) -> memoryview:
+        e = self._entry(sha)
+        data = e.data
+        if data is not None or e.handle.size == 0:
+            return memoryview(data or b"")
+        return self._map(e)
+
+    def path(self, sha: str):
+        e = self._entry(sha)
+        return e.path if e.data is None else None
+
+    @staticmethod
+    def _map(e) -> memoryview:
+        with open(e.path, "rb") as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _enforce_budget(self) -> None:
+        for sha, e in list(self._entries.items()):    # 从最久没用的开始落盘
+            if self.in_memory <= self.budget:
+                break
+            if e.data is not None:
+                self._spill(sha, e)
+
+    def _spill(self, sha: str, e) -> None:
+        if self._dir is None:
+            self._dir = Path(tempfile.mkdtemp(prefix="taizhang_uploads_"))
+            weakref.finalize(self, shutil.rmtree, self._dir, True)
+        path = self._dir / sha
+        try:
+            path.write_bytes(e.data)
+        except OSError:
+            return                                  # 临时目录写不了就留在内存里
+        self.in_memory -= len(e.data)
+        e.data, e.path = None, path                 # 正在读的 BytesIO 仍持有原 bytes，读完即释放
+
+    def _drop(self, sha: str) -> None:
+        e = self._entries.pop(sha)
+        if e.data is not None:
+            self.in_memory -= len(e.data)
+        if e.path is not None:
+            try:
+                e.path.unlink()
+            except OSError:
+                pass                                # 还有 mmap 没关（Windows），留给退出时清理
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"files": len(self._entries), "sessions": len(self._sessions), "in_memory": self.in_memory,
+                    "on_disk": sum(e.handle.size for e in self._entries.values() if e.data is None)}
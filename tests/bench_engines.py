@@ -0,0 +1,46 @@
+"""
+两种指标引擎（mask、cube）在大台账上的耗时对比（不是 pytest 用例，直接运行）：
+
+    python tests/bench_engines.py --rows 1000000
+
+首次：新建引擎算一遍；再算：同一个引擎换统计基准日期再算（同页面上只改日期）。
+cube 的结果必须与 mask 逐位一致。
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pandas as pd  # noqa: E402
+
+from ledgers import make_batch, make_trad  # noqa: E402
+from taizhang_pipeline import LEDGER_RULES, METRIC_ENGINES, calc_batch_metrics, calc_trad_metrics  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    dates = pd.Timestamp("2025-06-30"), pd.Timestamp("2025-09-30")
+    for kind, make, calc in [("batch", make_batch, calc_batch_metrics), ("trad", make_trad, calc_trad_metrics)]:
+        df = make(args.rows)
+        print(f"{kind}：{len(df)} 行")
+        base = None
+        for name, cls in METRIC_ENGINES.items():
+            eng = cls(df, {}, LEDGER_RULES[kind][1])
+            t0 = time.perf_counter()
+            first = calc(df, dates[0], eng)
+            t1 = time.perf_counter()
+            calc(df, dates[1], eng)
+            t2 = time.perf_counter()
+            if base is None:
+                base = first
+            same = all(a == b or (pd.isna(a) and pd.isna(b)) for a, b in zip(first, base))
+            print(f"  {name:8s} 首次 {t1 - t0:6.2f}s  再算 {t2 - t1:6.2f}s  与 mask 一致：{same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+import pytest
+
+from ledgers import make_batch, make_trad
+
+
+@pytest.fixture(scope="session")
+def trad_ledger():
+    return make_trad(20_000)
+
+
+@pytest.fixture(scope="session")
+def batch_ledger():
+    return make_batch(20_000)
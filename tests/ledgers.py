@@ -0,0 +1,114 @@
+"""测试用的合成台账（列和取值分布仿照清洗后的实际台账，即 load_*_data 的输出）和上传工作簿。"""
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from taizhang_pipeline import compact_ledger
+
+
+def _dates(rng, n, start, end, missing=0.05):
+    lo, hi = pd.Timestamp(start).value // 10**9, pd.Timestamp(end).value // 10**9
+    s = pd.Series(pd.to_datetime(rng.integers(lo, hi, n), unit="s").normalize())
+    s[rng.random(n) < missing] = pd.NaT
+    return s
+
+
+def _amounts(rng, n, scale, zero=0.3, missing=0.02):
+    v = np.round(rng.gamma(1.5, scale, n), 2)
+    v[rng.random(n) < zero] = 0.0
+    v[rng.random(n) < missing] = np.nan
+    return v
+
+
+def make_trad(n: int, seed: int = 0) -> pd.DataFrame:
+    """清洗后的传统台账（load_trad_data 的输出格式），取值分布仿照实际台账。"""
+    rng = np.random.default_rng(seed)
+    pick = lambda values, p=None: rng.choice(np.array(values, dtype=object), n, p=p)
+    df = pd.DataFrame({
+        "客户名称": [f"客户{i}" for i in rng.integers(0, max(n // 3, 1), n)],
+        "业务品种": pick(["流贷", "惠抵贷", "驿享贷", "委托贷款", "惠蓉贷"]),
+        "业务品种2": pick(["传统"]),
+        "业务品种3": pick(["惠蓉贷", "其他"], [0.2, 0.8]),
+        "企业类别": pick(["小型", "微型", "中型", "三农", "大型"]),
+        "新增/续贷": pick(["新增", "续贷"]),
+        "国企民企": pick(["国企", "民企"], [0.1, 0.9]),
+        "风险等级": pick(["正常", "关注", "次级", "可疑", "损失"], [0.8, 0.1, 0.05, 0.03, 0.02]),
+        "公司责任风险比例": pick(["100%", "80%", "50%"]),
+        "担保费率/利率": np.round(rng.uniform(0.3, 2.5, n), 2),
+        "放款金额": _amounts(rng, n, 300, zero=0.05),
+        "名义在保余额": _amounts(rng, n, 200),
+        "责任余额": _amounts(rng, n, 150),
+        "担保费/利息": _amounts(rng, n, 3),
+        "银行": pick([0.0, 0.2, 0.3]).astype(float),
+        "放款时间": _dates(rng, n, "2023-01-01", "2025-12-31"),
+        "实际到期时间": _dates(rng, n, "2024-01-01", "2027-12-31", missing=0.3),
+    })
+    df["在保余额"] = (1 - df["银行"]) * df["名义在保余额"]
+    df["实际放款"] = (1 - df["银行"]) * df["放款金额"]
+    return compact_ledger(df)
+
+
+def make_batch(n: int, seed: int = 0) -> pd.DataFrame:
+    """清洗后的批量台账（load_batch_data 的输出格式），取值分布仿照实际台账。"""
+    rng = np.random.default_rng(seed)
+    pick = lambda values, p=None: rng.choice(np.array(values, dtype=object), n, p=p)
+    df = pd.DataFrame({
+        "债务人证件号码": [f"ID{i:08d}" for i in rng.integers(0, max(n // 2, 1), n)],
+        "债务人名称": [f"债务人{i}" for i in rng.integers(0, max(n // 2, 1), n)],
+        "业务品种2": pick(["批量"]),
+        "是否已解保": pick(["在保", "已解保"], [0.6, 0.4]),
+        "分险比例(直担)": pick([100, 80, 70]).astype(int),
+        "担保年费率": np.round(rng.uniform(0.3, 2.0, n), 2),
+        "企业划型": pick(["小型企业", "微型企业", "中型企业", "大型企业", np.nan]),
+        "债务人类别": pick(["企业/企业", "个人/个体工商户", "个人/小微企业主", "个人/农户"]),
+        "政策扶持领域": pick(["三农", "小微企业", "小微企业,三农", "其他", np.nan]),
+        "所属行业(工)": pick(["农、林、牧、渔业", "制造业", "批发和零售业"]),
+        "首贷户": pick(["是", "否"], [0.2, 0.8]),
+        "债务人经营主体经济成分": pick(["私人控股", "国有控股", np.nan]),
+        "担保产品": pick(["科创贷", "惠农贷", "小微快贷"]),
+        "主债权金额": _amounts(rng, n, 100, zero=0.02),
+        "名义在保余额": _amounts(rng, n, 80),
+        "分险比例(债权人)": pick([0, 10, 20]).astype(float),
+        "主债权起始日期": _dates(rng, n, "2023-01-01", "2025-12-31"),
+        "主债权到期日期": _dates(rng, n, "2024-01-01", "2027-12-31"),
+    })
+    df["责任余额"] = 0.01 * df["分险比例(直担)"] * df["名义在保余额"]
+    df["在保余额"] = (1 - 0.01 * df["分险比例(债权人)"]) * df["名义在保余额"]
+    df["实际放款"] = (1 - 0.01 * df["分险比例(债权人)"]) * df["主债权金额"]
+    df["担保费"] = df["主债权金额"] * 0.01 * df["担保年费率"]
+    return compact_ledger(df)
+
+
+def workbook(sheets: dict, **to_excel) -> BytesIO:
+    """{表名: DataFrame} 写成 xlsx，返回上传文件那样的 BytesIO。"""
+    buf = BytesIO()
+    with pd.ExcelWriter(buf, engine="openpyxl") as xw:
+        for name, df in sheets.items():
+            df.to_excel(xw, sheet_name=name, index=False, **to_excel)
+    return BytesIO(buf.getvalue())
+
+
+# 担保产品 → 业务分类；“经营贷”不是批量业务，读取时应被 select_batch 筛掉
+PRODUCT_CLASSES = pd.DataFrame({
+    "业务品种": ["科创贷", "惠农贷", "小微快贷", "经营贷"],
+    "业务品种2": ["批量", "批量", "批量", "传统"],
+    "业务品种3": ["科创", "三农", "小微", "其他"],
+})
+
+
+def filter_book(classes: pd.DataFrame = PRODUCT_CLASSES) -> BytesIO:
+    """筛选条件工作簿（业务分类表）。"""
+    return workbook({"业务分类": classes})
+
+
+def raw_batch(n: int, seed: int = 0) -> pd.DataFrame:
+    """读取前的批量台账（已备案格式），与 make_batch 同分布，另有一成非批量产品。"""
+    rng = np.random.default_rng(seed)
+    df = make_batch(n, seed).drop(columns=["业务品种2", "责任余额", "在保余额", "实际放款", "担保费"])
+    df = df.rename(columns={"名义在保余额": "在保余额"})
+    df["担保产品"] = np.where(rng.random(n) < 0.1, "经营贷", df["担保产品"].astype(str))
+    for col in ["分险比例-国担", "分险比例-市再担保", "分险比例-省再担保", "分险比例-其他"]:
+        df[col] = rng.choice([0, 10, 20], n)
+    df["业务编号"] = [f"PL{i:06d}" for i in range(n)]
+    return df
@@ -0,0 +1,85 @@
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import taizhang_pipeline as app
+from ledgers import workbook
+
+
+def _fresh_cache(monkeypatch, max_bytes=app.PARSE_CACHE_MAX_BYTES):
+    cache = app.ParseCache(max_bytes)
+    monkeypatch.setattr(app, "_parse_cache", lambda: cache)
+    return cache
+
+
+def _count_parses(monkeypatch):
+    calls = []
+    parse = pd.ExcelFile.parse
+    monkeypatch.setattr(pd.ExcelFile, "parse", lambda self, *a, **k: calls.append(k.get("sheet_name")) or parse(self, *a, **k))
+    return calls
+
+
+def test_same_content_parsed_once(monkeypatch):
+    _fresh_cache(monkeypatch)
+    calls = _count_parses(monkeypatch)
+    df = pd.DataFrame({"业务品种": ["流贷", "惠抵贷"], "业务品种2": ["传统", "传统"]})
+    first, second = workbook({"业务分类": df}), workbook({"业务分类": df})   # 内容相同的两次上传
+
+    a = app.read_sheet(first, "业务分类")
+    a["业务品种2"] = "改过"                                        # 调用方拿到的是副本
+    b = app.read_sheet(second, "业务分类")
+    assert calls == ["业务分类"]
+    assert b.equals(df)
+
+    app.read_sheet(second, "业务分类", header=1)                   # 表头行不同，另算一份
+    assert calls == ["业务分类", "业务分类"]
+
+
+def test_selector_function_is_part_of_key(monkeypatch):
+    _fresh_cache(monkeypatch)
+    book = workbook({"总台账": pd.DataFrame({"a": [1]}), "其他": pd.DataFrame({"b": [2]})})
+    assert list(app.read_sheet(book, app.extractsheet_taizhang).columns) == ["a"]
+    assert list(app.read_sheet(book, "其他").columns) == ["b"]
+
+
+def test_lru_respects_byte_budget():
+    frames = {k: pd.DataFrame({"x": range(1000)}) for k in "abc"}
+    size = app._frame_nbytes(frames["a"])
+    cache = app.ParseCache(2 * size)
+    for k, df in frames.items():
+        cache.put(k, df)
+    assert cache.get("a") is None and cache.get("b") is not None and cache.get("c") is not None
+    cache.get("b")                      # b 最近用过，再放一份时淘汰 c
+    cache.put("a", frames["a"])
+    assert cache.get("c") is None and cache.get("b") is not None
+    cache.put("big", pd.DataFrame({"x": range(10_000)}))      # 单个超过上限的不缓存
+    assert cache.get("big") is None
+
+
+@pytest.mark.skipif(app.pa is None, reason="需要 pyarrow")
+def test_sidecar_roundtrip(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "SIDECAR_DIR", tmp_path)
+    frame = pd.DataFrame({
+        "客户名称": ["甲", np.nan, "丙"],
+        "在保余额": [1.5, np.nan, 0.0],
+        "放款时间": pd.to_datetime(["2025-01-02", None, "2024-12-31"]),
+        "备注": ["文字", 3, np.nan],                  # 数字、文字混填
+    })
+    builds = []
+
+    def build(src):
+        builds.append(src)
+        return frame.copy()
+
+    ledger, filters = BytesIO(b"ledger"), BytesIO(b"filters")
+    first = app.load_cached("trad", [ledger, filters], build, ledger)
+    second = app.load_cached("trad", [ledger, filters], build, ledger)
+    assert len(builds) == 1
+    assert first.equals(frame)
+    assert second.drop(columns="备注").equals(frame.drop(columns="备注"))
+    assert second["备注"].tolist()[:2] == ["文字", "3"] and pd.isna(second["备注"].iloc[2])
+
+    app.load_cached("trad", [ledger, BytesIO(b"filters v2")], build, ledger)   # 任一源文件变了就重读
+    assert len(builds) == 2
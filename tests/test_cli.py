@@ -0,0 +1,52 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+import taizhang_cli
+import taizhang_pipeline
+from ledgers import filter_book, raw_batch, workbook
+
+
+def test_cli_writes_batch_results(tmp_path, monkeypatch):
+    monkeypatch.setattr(taizhang_pipeline, "SIDECAR_DIR", tmp_path / "cache")
+    filters, batch = tmp_path / "筛选条件.xlsx", tmp_path / "批量.xlsx"
+    filters.write_bytes(filter_book().getvalue())
+    batch.write_bytes(workbook({"批量台账": raw_batch(300)}).getvalue())
+
+    out = tmp_path / "out"
+    argv = ["--filter", str(filters), "--batch", str(batch), "--as-of", "2025-06-30",
+            "--out", str(out), "--no-history", "-q"]
+    assert taizhang_cli.main(argv) == 0
+    got = json.loads((out / "统计结果_20250630.json").read_text(encoding="utf-8"))
+    assert got["as_of"] == "2025-06-30" and list(got["results"]) == ["batch_res"]
+
+    df = taizhang_pipeline.load_batch_data(taizhang_pipeline.LocalFile(batch), taizhang_pipeline.LocalFile(filters))
+    want = taizhang_pipeline.calc_batch_metrics(df, pd.Timestamp("2025-06-30"))
+    assert got["results"]["batch_res"] == {k: taizhang_pipeline._cell(v) for k, v in want.items()}
+    assert "批量统计" in pd.read_excel(out / "统计结果_20250630.xlsx", sheet_name=None)
+
+
+def test_consolidation_dedupes_customers(tmp_path, monkeypatch):
+    monkeypatch.setattr(taizhang_pipeline, "SIDECAR_DIR", tmp_path / "cache")
+    monkeypatch.setattr(taizhang_pipeline, "PROCESS_WORKERS", 1)
+    filters, batch = tmp_path / "筛选条件.xlsx", tmp_path / "批量.xlsx"
+    filters.write_bytes(filter_book().getvalue())
+    batch.write_bytes(workbook({"批量台账": raw_batch(300)}).getvalue())
+    paths = dict.fromkeys(taizhang_pipeline.STAT_FILE_KEYS)
+    paths.update(filter_file=str(filters), batch_file=str(batch))
+
+    # 两个主体用同一份台账：合并后笔数、金额翻倍，户数不变；单户类按合并后的客户余额重新判断
+    runs = taizhang_pipeline.run_consolidation({"甲": (paths, {}), "乙": (paths, {})}, "2025-06-30")
+    assert list(runs) == ["甲", "乙", taizhang_pipeline.CONSOLIDATED]
+    one, both = runs["甲"].results["batch_res"], runs[taizhang_pipeline.CONSOLIDATED].results["batch_res"]
+    df = runs["甲"].frames["batch"][0]
+    stacked = taizhang_pipeline.calc_batch_metrics(pd.concat([df, df], ignore_index=True), pd.Timestamp("2025-06-30"))
+    for k in one.index:
+        if k.endswith("户数"):
+            assert both[k] == one[k], k
+        elif "单户" in k:
+            assert np.isclose(both[k], stacked[k]), k
+        else:
+            assert np.isclose(both[k], 2 * one[k]), k
+    assert any(k.endswith("户数") and one[k] > 0 for k in one.index)
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from taizhang_pipeline import CustomerDim
+
+
+def _ledger(n: int = 3_000, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    customers = np.array([f"客户{i}" for i in range(400)] + [np.nan], dtype=object)
+    return pd.DataFrame({
+        "客户": rng.choice(customers, n),
+        "在保余额": rng.choice([0.0, 100.0, 250.0, 500.0, 800.0], n),    # 取值少，合计多有并列
+        "责任余额": np.round(rng.gamma(1.5, 100, n), 2),
+    })
+
+
+@pytest.mark.parametrize("limit", [0, 500, 2000])
+def test_at_most_matches_groupby(limit):
+    df = _ledger()
+    sums = df["在保余额"].groupby(df["客户"]).sum()
+    expected = df["客户"].isin(set(sums.index[sums <= limit])).to_numpy()
+    assert np.array_equal(CustomerDim("客户").at_most(df, "在保余额", limit), expected)
+
+
+@pytest.mark.parametrize("col", ["在保余额", "责任余额"])
+def test_top_matches_nlargest(col):
+    df = _ledger()
+    dim = CustomerDim("客户")
+    for k in [10, 1, 3, 400, 1000]:             # 同一个对象依次取不同的 k，排名要跟着补齐
+        top = set(df[col].groupby(df["客户"]).sum().nlargest(k).index)
+        assert np.array_equal(dim.top(df, col, k), df["客户"].isin(top).to_numpy()), k
+
+
+def test_new_frame_rebinds():
+    dim = CustomerDim("客户")
+    a, b = _ledger(seed=1), _ledger(seed=2)
+    dim.top(a, "责任余额", 10)
+    top = set(b["责任余额"].groupby(b["客户"]).sum().nlargest(10).index)
+    assert np.array_equal(dim.top(b, "责任余额", 10), b["客户"].isin(top).to_numpy())
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+import taizhang_pipeline as app
+
+
+def _loop_policy(df_daichang, df_batch2):
+    """原先逐行匹配的写法，作对照：返回 (政策扶持领域, 匹配到多条的代偿行号)。"""
+    first_names = df_batch2["债务人名称"].astype(str).str.split("、").str[0]
+    policy, multi = [], []
+    for i, row in df_daichang.reset_index(drop=True).iterrows():
+        mask = (first_names == str(row["企业名称"]).split("、")[0]) & \
+            np.isclose(df_batch2["主债权金额"], row["担保金额"], atol=0.01)
+        matched = df_batch2[mask]
+        policy.append(matched.iloc[0]["政策扶持领域"] if len(matched) else "")
+        if len(matched) > 1:
+            multi.append(i)
+    return policy, multi
+
+
+def test_hash_join_matches_loop():
+    rng = np.random.default_rng(0)
+    names = [f"企业{i}" for i in range(40)]
+    df_batch2 = pd.DataFrame({
+        "债务人名称": [f"{n}、担保人" if rng.random() < 0.2 else n for n in rng.choice(names, 400)],
+        "主债权金额": rng.choice([100.0, 200.0, 300.0], 400),
+        "政策扶持领域": rng.choice(["三农", "小微企业", "其他"], 400),
+        "业务编号": [f"PL{i}" for i in range(400)],
+    })
+    df_daichang = pd.DataFrame({
+        "企业名称": rng.choice(names + ["无此企业"], 120),
+        "担保金额": rng.choice([100.0, 200.005, 300.02, 400.0], 120),     # 差 0.005 算匹配，0.02 不算
+    })
+    policy, ambiguous = app.match_daichang_policy(df_daichang, df_batch2)
+    expected, multi = _loop_policy(df_daichang, df_batch2)
+    assert policy.tolist() == expected
+    assert any(expected) and not all(expected)
+    assert set(ambiguous["代偿企业名称"]) == set(df_daichang["企业名称"].iloc[multi])
+
+
+def test_ambiguous_rows_listed():
+    df_batch2 = pd.DataFrame({
+        "债务人名称": ["甲公司", "甲公司、乙", "丙公司"],
+        "主债权金额": [50.0, 50.0, 80.0],
+        "政策扶持领域": ["三农", "小微企业", "其他"],
+        "业务编号": ["A", "B", "C"],
+    })
+    df_daichang = pd.DataFrame({"企业名称": ["甲公司", "丙公司、丁"], "担保金额": [50.0, 80.0]})
+    policy, ambiguous = app.match_daichang_policy(df_daichang, df_batch2)
+    assert policy.tolist() == ["三农", "其他"]                     # 多条时取台账里最前的一条
+    assert ambiguous["业务编号"].tolist() == ["A", "B"]
+    assert ambiguous["代偿企业名称"].tolist() == ["甲公司", "甲公司"]
+    assert "企业名称_首" not in df_batch2.columns
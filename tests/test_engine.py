@@ -0,0 +1,175 @@
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ledgers import make_trad
+from taizhang_pipeline import (
+    LEDGER_DATE_RULES, TRAD_DATE_RULES, LedgerStore, MetricEngine, calc_batch_metrics, calc_trad_metrics,
+    compact_ledger, date_rules, metric_engine,
+)
+
+RULES = {
+    "在保": lambda d: d["余额"] > 0,
+    "当年": lambda d: d["放款时间"].dt.year == 2025,
+    "小微": lambda d: d["类别"].isin(["小型", "微型"]),
+    "民企": lambda d: d["性质"] == "民企",           # 性质有空值
+    "全部": lambda d: True,                           # 标量也要能当掩码
+}
+AGG_MAP = {
+    "余额": ("余额", "sum"),
+    "笔数": ("余额", "count"),
+    "户数": ("客户", "nunique"),
+    "最大": lambda d: d["余额"].max(),
+}
+METRICS = [f"{'_'.join(keys)}_{agg}" for keys in
+           [["在保"], ["在保", "当年"], ["当年", "在保"], ["在保", "小微", "民企"], ["小微", "全部"], ["民企"]]
+           for agg in AGG_MAP]
+
+
+def _ledger(n: int = 500, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    balance = np.round(rng.gamma(1.5, 100, n), 2)
+    balance[rng.random(n) < 0.3] = 0.0
+    balance[rng.random(n) < 0.05] = np.nan
+    return pd.DataFrame({
+        "客户": rng.choice([f"客户{i}" for i in range(60)] + [np.nan], n),
+        "余额": balance,
+        "放款时间": pd.to_datetime(rng.integers(1_672_531_200, 1_767_225_600, n), unit="s"),
+        "类别": rng.choice(["小型", "微型", "中型"], n),
+        "性质": rng.choice(np.array(["民企", "国企", np.nan], dtype=object), n),
+    })
+
+
+def _reduce_value(df: pd.DataFrame, name: str):
+    """原先每个指标各自 reduce(&) 的算法，作对照。"""
+    *keys, agg = name.split("_")
+    mask = reduce(lambda a, b: a & b, [RULES[k](df) for k in keys], pd.Series(True, index=df.index))
+    mapper = AGG_MAP[agg]
+    if callable(mapper):
+        return mapper(df.loc[mask])
+    col, how = mapper
+    if how == "sum":
+        return df.loc[mask, col].sum()
+    if how == "count":
+        return int(mask.sum())
+    return df.loc[mask, col].nunique()
+
+
+def test_engine_matches_reduce():
+    df = _ledger()
+    res = MetricEngine(df, RULES, AGG_MAP).run(METRICS)
+    assert list(res) == METRICS
+    for name in METRICS:
+        assert res[name] == _reduce_value(df, name), name
+
+
+def test_rules_evaluated_once():
+    calls = []
+    counted = lambda k: lambda d: calls.append(k) or RULES[k](d)
+    MetricEngine(_ledger(), {k: counted(k) for k in RULES}, AGG_MAP).run(METRICS)
+    assert sorted(calls) == sorted(RULES)
+
+
+@pytest.mark.parametrize("calc, ledger", [(calc_batch_metrics, "batch_ledger"), (calc_trad_metrics, "trad_ledger")])
+def test_cube_matches_mask_exactly(calc, ledger, request):
+    df = request.getfixturevalue(ledger)
+    for as_of in [pd.Timestamp("2025-06-30"), pd.Timestamp("2024-12-31")]:
+        cube, mask = calc(df, as_of, "cube"), calc(df, as_of, "mask")
+        assert list(cube.index) == list(mask.index)
+        assert all(a == b or (pd.isna(a) and pd.isna(b)) for a, b in zip(cube, mask)), \
+            [(k, a, b) for k, a, b in zip(mask.index, cube, mask) if a != b]
+
+
+@pytest.mark.parametrize("calc, ledger", [(calc_batch_metrics, "batch_ledger"), (calc_trad_metrics, "trad_ledger")])
+def test_categoricals_do_not_change_metrics(calc, ledger, request):
+    df = request.getfixturevalue(ledger)
+    assert (df.dtypes == "category").sum() >= 5
+    plain = df.astype({c: object for c in df.columns[df.dtypes == "category"]})
+    as_of = pd.Timestamp("2025-06-30")
+    assert calc(df, as_of).equals(calc(plain, as_of))
+
+
+def test_compact_ledger_skips_mixed_and_high_cardinality():
+    df = pd.DataFrame({
+        "企业类别": ["小型", "微型"] * 50,
+        "备案状态": ["已备案", 1] * 50,                        # 数字、文字混填
+        "担保产品": [f"产品{i}" for i in range(100)],           # 取值超过一半行数
+        "客户名称": ["甲", "乙"] * 50,                          # 不在白名单
+    })
+    out = compact_ledger(df.copy())
+    assert out["企业类别"].dtype == "category"
+    assert (out.dtypes[["备案状态", "担保产品", "客户名称"]] == object).all()
+    assert out.astype(object).equals(df)
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+def test_distinct_counts_match_nunique(categorical):
+    df = _ledger(2_000)
+    if categorical:
+        df["客户"] = df["客户"].astype("category")
+    rng = np.random.default_rng(1)
+    masks = [rng.random(len(df)) < p for p in rng.uniform(0, 0.2, 150)]   # 超过 64 个，分块打包
+    masks += [np.zeros(len(df), dtype=bool), np.ones(len(df), dtype=bool)]
+    counts = MetricEngine(df, RULES, AGG_MAP).distinct_counts("客户", masks)
+    assert counts.tolist() == [df["客户"][m].nunique() for m in masks]
+
+
+@pytest.mark.parametrize("calc, ledger, kind", [(calc_batch_metrics, "batch_ledger", "batch"),
+                                                (calc_trad_metrics, "trad_ledger", "trad")])
+def test_rebind_matches_fresh_engine(calc, ledger, kind, request):
+    df = request.getfixturevalue(ledger)
+    may, june = pd.Timestamp("2025-05-31"), pd.Timestamp("2025-06-30")
+    engine = metric_engine(kind, df, may)
+    calc(df, may, engine)
+    static = {k: m for k, m in engine._rule_masks.items() if k not in LEDGER_DATE_RULES[kind]}
+    assert calc(df, june, engine).equals(calc(df, june))
+    assert all(engine._rule_masks[k] is m for k, m in static.items())     # 与日期无关的掩码没有重算
+
+
+def test_date_rules_match_explicit_bounds(trad_ledger):
+    d, as_of = trad_ledger, pd.Timestamp("2025-06-30")
+    rules = date_rules(TRAD_DATE_RULES, as_of)
+    amount = d["放款金额"] > 0
+    expected = {
+        "当年": d["放款时间"].between(pd.Timestamp("2025-01-01"), pd.Timestamp("2025-12-31")) & amount,
+        "当月": d["放款时间"].between(pd.Timestamp("2025-06-01"), pd.Timestamp("2025-06-30")) & amount,
+        "上一年": d["放款时间"].between(pd.Timestamp("2024-01-01"), pd.Timestamp("2024-12-31")) & amount,
+        "本月解保": d["实际到期时间"].between(pd.Timestamp("2025-06-01"), pd.Timestamp("2025-06-30")),
+        "本年解保": d["实际到期时间"].between(pd.Timestamp("2025-01-01"), pd.Timestamp("2025-12-31")),
+    }
+    assert set(rules) == set(expected)
+    for k, m in expected.items():
+        assert rules[k](d).equals(m), k
+
+
+def test_fork_does_not_share_engines(batch_ledger):
+    may, june = pd.Timestamp("2025-05-31"), pd.Timestamp("2025-06-30")
+    page = LedgerStore("sig")
+    expected = calc_batch_metrics(batch_ledger, may, page.engine("batch", batch_ledger))
+    masks = dict(page.engines["batch"]._rule_masks)
+
+    run = page.fork()
+    assert run.engines["batch"] is not page.engines["batch"]
+    moved = calc_batch_metrics(batch_ledger, june, run.engine("batch", batch_ledger))
+    assert moved.equals(calc_batch_metrics(batch_ledger, june))
+
+    # 副本换了日期，页面上这份的掩码、结果都不变
+    assert page.engines["batch"]._rule_masks.keys() == masks.keys()
+    assert all(page.engines["batch"]._rule_masks[k] is m for k, m in masks.items())
+    assert calc_batch_metrics(batch_ledger, may, page.engine("batch", batch_ledger)).equals(expected)
+
+
+def test_trad_broad_small_micro():
+    # 广义小微 = 小型、微型企业，或惠抵贷（个体工商户及小微企业主）
+    df = make_trad(6).assign(
+        客户名称=["甲", "甲", "乙", "丙", "丁", "戊"],
+        企业类别=["小型", "微型", "中型", "中型", "小型", "三农"],
+        业务品种=["流贷", "流贷", "惠抵贷", "流贷", "流贷", "惠抵贷"],
+        业务品种2="传统",
+        在保余额=[100.0, 50.0, 30.0, 70.0, 0.0, 0.0],
+    )
+    res = calc_trad_metrics(df, pd.Timestamp("2025-06-30"))
+    assert res["传统_广义小微_在保_户数"] == 2
+    assert res["传统_广义小微_在保_在保余额"] == 180.0
@@ -0,0 +1,28 @@
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+from taizhang_pipeline import frame_digest, write_workbook
+
+
+def test_workbook_roundtrip():
+    df = pd.DataFrame({
+        "名称": ["甲", None, "=1+1"],
+        "金额": [1.5, np.nan, np.float32(2.0)],
+        "日期": pd.to_datetime(["2025-01-31", None, "2025-03-31"]),
+    })
+    data = write_workbook({"统计/明细": df, "统计?明细": df.head(1)})
+    sheets = pd.read_excel(BytesIO(data), sheet_name=None)
+    assert list(sheets) == ["统计_明细", "统计_明细_2"]
+    back = sheets["统计_明细"]
+    assert back["名称"].tolist()[::2] == ["甲", "=1+1"] and pd.isna(back["名称"][1])
+    assert np.allclose(back["金额"], df["金额"], equal_nan=True)
+    assert back["日期"].equals(df["日期"])
+
+
+def test_digest_follows_content():
+    df = pd.DataFrame({"a": [1, 2], "b": ["x", "y"]})
+    assert frame_digest(df) == frame_digest(df.copy())
+    assert frame_digest(df) != frame_digest(df.assign(a=[1, 3]))
+    assert frame_digest(df) != frame_digest(df.rename(columns={"b": "c"}))
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from taizhang_pipeline import _FORMULA_NUM, REPORT_STEPS, FormulaProgram, eval_terms, parse_formula
+
+
+def _sequential(steps, inputs):
+    """原来的求值方式：按列表顺序逐条算，结果写回同一个字典。"""
+    values = dict(inputs)
+    for _, rules in steps:
+        for rule in rules:
+            parsed = parse_formula(rule)
+            if parsed is not None:
+                target, first, ops, operands = parsed
+                values[target] = eval_terms(first, ops, [_operand(t, values) for t in operands])
+    return values
+
+
+def _operand(tok, values):
+    if tok in values:
+        return float(values[tok])
+    return float(tok) if _FORMULA_NUM.match(tok) else 0.0
+
+
+def _inputs(program, seed=0):
+    rng = np.random.default_rng(seed)
+    return {name: float(rng.integers(0, 10**6)) / 100 for name in sorted(program.inputs)}
+
+
+def test_report_matches_sequential():
+    program = FormulaProgram(REPORT_STEPS)
+    inputs = _inputs(program)
+    run = program.evaluate(inputs)
+    expected = _sequential(REPORT_STEPS, inputs)
+    assert run.results.keys() == expected.keys()
+    assert all(np.isclose(run.results[k], expected[k]) for k in expected)
+
+
+def test_incremental_matches_fresh():
+    program = FormulaProgram(REPORT_STEPS)
+    inputs = _inputs(program)
+    run = program.evaluate(inputs)
+    changed = dict(inputs, **{next(iter(sorted(program.inputs))): -1.0})
+    again = program.evaluate(changed, run)
+    assert 0 < again.recomputed < len(program.nodes)
+    assert again.values == program.evaluate(changed).values
+
+
+def test_redefinition_uses_latest_before():
+    steps = [("一", ["A=x+1", "B=A*2"]), ("二", ["A=B+x", "C=A-B"])]
+    program = FormulaProgram(steps)
+    run = program.evaluate({"x": 3.0})
+    assert run.results == _sequential(steps, {"x": 3.0})
+    assert run.results["C"] == 3.0
+    assert program.diagnostics({"x"})["问题"].tolist() == ["重复定义且公式不同"]
+
+
+def test_scenarios_match_one_by_one():
+    program = FormulaProgram(REPORT_STEPS)
+    inputs = _inputs(program)
+    names = sorted(program.inputs)[:3]
+    scenarios = pd.DataFrame({names[0]: [1.0, None, 5.0], names[1]: [None, 0.0, 2.5], names[2]: [7.0, 8.0, None]},
+                             index=["甲", "乙", "丙"])
+    matrix = program.evaluate_many(inputs, scenarios)
+    assert list(matrix.index) == ["甲", "乙", "丙"]
+    for label, row in scenarios.iterrows():
+        results = program.evaluate(dict(inputs, **row.dropna().to_dict())).results
+        assert all(np.isclose(matrix.loc[label, c], results[c]) for c in matrix.columns), label
+
+
+def test_forward_reference_is_reported_not_resolved():
+    steps = [("一", ["A=B+1", "C=A*2"]), ("二", ["B=x*2"])]
+    program = FormulaProgram(steps)
+    assert program.evaluate({"x": 3.0}).results == _sequential(steps, {"x": 3.0})
+    assert program.evaluate({"x": 3.0}).results["A"] == 1.0                # B 之后才定义：按 0
+    assert program.evaluate({"x": 3.0, "B": 5.0}).results["A"] == 6.0      # 输入里有就取输入
+    assert program.diagnostics({"x"}).values.tolist() == [["向前引用", "一", "A", "B"]]
+    assert program.diagnostics({"x", "B"}).empty
+
+
+def test_scenarios_cannot_override_targets():
+    program = FormulaProgram([("一", ["A=x+1"])])
+    with pytest.raises(ValueError, match="A"):
+        program.evaluate_many({"x": 1.0}, pd.DataFrame({"A": [2.0]}))
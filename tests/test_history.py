@@ -0,0 +1,85 @@
+import sqlite3
+from contextlib import closing
+
+import pandas as pd
+
+from taizhang_pipeline import ResultHistory, history_prefill
+
+
+def test_save_lookup_series(tmp_path):
+    history = ResultHistory(tmp_path / "history.sqlite")
+    assert history.lookup("2025-05-31", ["在保余额"]) == {}
+    assert history.dates() == []
+
+    assert history.save("2025-04-30", "sig-a", {"在保余额": 1.0, "实际在保余额": 10.0, "空": float("nan")})
+    assert history.save(pd.Timestamp("2025-05-31"), "sig-a", {"在保余额": 2.0})
+    assert history.lookup("2025-04-30", ["在保余额", "空", "没有"]) == {"在保余额": 1.0}
+    assert history.dates() == [pd.Timestamp("2025-04-30").date(), pd.Timestamp("2025-05-31").date()]
+
+    hist = history.series(["在保余额", "实际在保余额"])
+    assert hist["在保余额"].tolist() == [1.0, 2.0]
+    assert hist["实际在保余额"].isna().tolist() == [False, True]
+
+    # 同一输入再存一次：整份替换，不留旧指标
+    assert history.save("2025-04-30", "sig-a", {"在保余额": 3.0})
+    assert history.lookup("2025-04-30", ["在保余额", "实际在保余额"]) == {"在保余额": 3.0}
+
+
+def test_unwritable_path_is_skipped(tmp_path):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    history = ResultHistory(blocker / "history.sqlite")
+    assert not history.save("2025-05-31", "sig", {"在保余额": 1.0})
+    assert history.lookup("2025-05-31", ["在保余额"]) == {}
+
+
+def test_two_sigs_on_one_date(tmp_path):
+    history = ResultHistory(tmp_path / "history.sqlite")
+    # 同一秒内存两份：saved_at 并列，取最后保存的一份
+    assert history.save("2025-05-31", "sig-a", {"在保余额": 1.0, "实际在保余额": 10.0})
+    assert history.save("2025-05-31", "sig-b", {"在保余额": 2.0, "实际在保余额": 20.0})
+    assert history.lookup("2025-05-31", ["在保余额"]) == {"在保余额": 2.0}
+
+    hist = history.series(["在保余额", "实际在保余额"])
+    assert list(hist.index) == [pd.Timestamp("2025-05-31").date()]
+    assert hist.loc[pd.Timestamp("2025-05-31").date()].tolist() == [2.0, 20.0]
+
+    # 再存一次 sig-a：它成了最后保存的
+    assert history.save("2025-05-31", "sig-a", {"在保余额": 3.0})
+    assert history.lookup("2025-05-31", ["在保余额", "实际在保余额"]) == {"在保余额": 3.0}
+
+
+def test_entities_do_not_mix(tmp_path):
+    history = ResultHistory(tmp_path / "history.sqlite")
+    history.save("2025-05-31", "sig-a", {"在保余额": 1.0}, entity="甲公司")
+    history.save("2025-05-31", "sig-b", {"在保余额": 2.0}, entity="乙公司")
+    history.save("2024-12-31", "sig-c", {"在保余额": 5.0, "实际在保余额": 6.0}, entity="乙公司")
+
+    assert history.lookup("2025-05-31", ["在保余额"], "甲公司") == {"在保余额": 1.0}
+    assert history.lookup("2025-05-31", ["在保余额"], "乙公司") == {"在保余额": 2.0}
+    assert history.lookup("2025-05-31", ["在保余额"]) == {}
+    assert history.dates("甲公司") == [pd.Timestamp("2025-05-31").date()]
+    assert history.series(["在保余额"], "乙公司")["在保余额"].tolist() == [5.0, 2.0]
+
+    found = history_prefill(history, "2025-06-30", "甲公司")
+    assert found == {"上月_在保_在保余额": (pd.Timestamp("2025-05-31").date(), 1.0)}
+    assert set(history_prefill(history, "2025-06-30", "乙公司")) == set(found) | {
+        "上一年_在保_在保余额", "上一年_在保_责任余额"}
+
+
+def test_old_database_without_entity(tmp_path):
+    path = tmp_path / "history.sqlite"
+    with closing(sqlite3.connect(path)) as con, con:
+        con.executescript("""
+            CREATE TABLE runs (as_of TEXT NOT NULL, input_sig TEXT NOT NULL, saved_at TEXT NOT NULL,
+                               PRIMARY KEY (as_of, input_sig));
+            CREATE TABLE results (as_of TEXT NOT NULL, input_sig TEXT NOT NULL, metric TEXT NOT NULL, value REAL,
+                                  PRIMARY KEY (as_of, input_sig, metric));
+            INSERT INTO runs VALUES ('2025-05-31', 'old', '2025-06-01T09:00:00');
+            INSERT INTO results VALUES ('2025-05-31', 'old', '在保余额', 7.0);
+        """)
+    history = ResultHistory(path)
+    assert history.lookup("2025-05-31", ["在保余额"]) == {"在保余额": 7.0}
+    assert history.save("2025-05-31", "new", {"在保余额": 8.0}, entity="甲公司")
+    assert history.lookup("2025-05-31", ["在保余额"]) == {"在保余额": 7.0}
+    assert history.lookup("2025-05-31", ["在保余额"], "甲公司") == {"在保余额": 8.0}
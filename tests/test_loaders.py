@@ -0,0 +1,176 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from io import BytesIO
+
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+import taizhang_pipeline as app
+from ledgers import filter_book, make_batch, make_trad, raw_batch, workbook
+from taizhang_io import stream_sheet
+from taizhang_pipeline import (
+    LEDGER_RULES, ledger_columns, ledger_detail, load_cached, notify, notify_to, overdue_rows,
+)
+
+
+def _sheet(rows, title="台账") -> BytesIO:
+    wb = Workbook()
+    ws = wb.active
+    ws.title = title
+    for row in rows:
+        ws.append(row)
+    buf = BytesIO()
+    wb.save(buf)
+    return BytesIO(buf.getvalue())
+
+
+def test_stream_matches_parse():
+    book = _sheet([
+        ["编号", "客户名称", "金额", "放款时间", "状态", "无关列"],
+        [1, "甲", 1.0, datetime(2025, 1, 2), "在保", "x"],
+        [2, None, 2.5, None, "#N/A", None],
+        [3, "丙", None, datetime(2024, 12, 31), "解保", "y"],
+        [None] * 6,
+    ])
+    got = stream_sheet(book, "台账", 0, frozenset({"金额", "状态"}))
+    assert list(got.columns) == ["编号", "客户名称", "金额", "放款时间", "状态"]   # 编号、名称、时间始终保留
+    assert got.equals(pd.ExcelFile(book).parse("台账", header=0)[list(got.columns)])
+
+
+def test_stream_two_row_header():
+    book = _sheet([
+        ["保函台账"], [None],
+        ["序号", "合同", None, "担保金额"],
+        [None, "编号", "到期时间", None],
+        [1, "BH-1", datetime(2026, 3, 1), 100],
+        [2, "BH-2", "无固定到期日", 200.5],
+    ], title="保函")
+    got = stream_sheet(book, "保函", [2, 3], frozenset({"担保金额", "合同_到期时间"}))
+    want = pd.ExcelFile(book).parse("保函", header=[2, 3])
+    want.columns = app._clean_names(app._flatten_cols(want.columns))
+    got.columns = app._clean_names(app._flatten_cols(got.columns))
+    assert list(got.columns) == ["合同_编号", "合同_到期时间", "担保金额"]
+    assert got.equals(want[list(got.columns)])
+
+
+@pytest.mark.parametrize("calc, make, kind", [(app.calc_trad_metrics, make_trad, "trad"),
+                                              (app.calc_batch_metrics, make_batch, "batch")])
+def test_rule_columns_are_enough(calc, make, kind):
+    df = make(2_000)
+    df["无关列"] = "x"
+    projected = df[[c for c in df.columns if c in app.ledger_columns(kind)]]
+    assert "无关列" not in projected.columns
+    as_of = pd.Timestamp("2025-06-30")
+    assert calc(projected, as_of).equals(calc(df, as_of))
+
+
+def test_batch_frames_share_one_build(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "SIDECAR_DIR", tmp_path)
+    builds = []
+    build = app.build_batch_ledger
+    monkeypatch.setattr(app, "build_batch_ledger", lambda *a, **k: builds.append(a[2]) or build(*a, **k))
+    ledger, filters = workbook({"批量台账": raw_batch(300)}), filter_book()
+
+    df_batch, df_batch2 = app.load_batch_frames(ledger, filters)
+    assert len(builds) == 1                         # 两个表选择函数都指向“批量台账”，只读一遍
+    assert (df_batch["业务品种2"] == "批量").all() and len(df_batch) < len(df_batch2) == 300
+    assert df_batch.equals(app.load_batch_data(ledger, filters))
+
+
+def _forever_expiredate(x):
+    """原先逐行 apply 的写法，作对照。"""
+    try:
+        return pd.to_datetime(x, errors="raise")
+    except Exception:
+        return pd.Timestamp.max
+
+
+def test_parse_expiry_matches_per_row():
+    raw = pd.Series([datetime(2026, 3, 1), "2025-12-31", "2025/7/1", "无固定到期日", "保全解除之日",
+                     "见附件", "9999-12-31", None, "  "], dtype=object)
+    parsed, unknown = app.parse_expiry(raw)
+    assert parsed.equals(pd.to_datetime(raw.apply(_forever_expiredate)))
+    assert unknown == ["见附件", "9999-12-31"]        # 超出范围的日期也提示
+
+
+def test_parallel_parse_fills_cache(tmp_path, monkeypatch):
+    cache = app.ParseCache(app.PARSE_CACHE_MAX_BYTES)
+    monkeypatch.setattr(app, "_parse_cache", lambda: cache)
+    monkeypatch.setattr(app, "SIDECAR_DIR", tmp_path)
+    ledger, filters = workbook({"批量台账": raw_batch(300)}), filter_book()
+    requests = app.ledger_parse_requests({"batch": ledger}, filters)
+    todo = app.pending_parses(requests)
+    assert [label for label, *_ in todo] == ["批量"]
+
+    with ProcessPoolExecutor(2, mp_context=multiprocessing.get_context("spawn")) as pool:
+        monkeypatch.setattr(app, "process_pool", lambda workers: pool)
+        assert app.parse_parallel(todo, lambda msg: None) == 1
+    assert app.pending_parses(requests) == []
+
+    # 子进程解析的结果与本进程读的一样
+    parsed = cache.get(todo[0][1])
+    monkeypatch.setattr(app, "_parse_cache", lambda: app.ParseCache(app.PARSE_CACHE_MAX_BYTES))
+    _, file_obj, sheet, header, columns = requests[0]
+    assert parsed.equals(app.read_sheet(file_obj, sheet, header=header, columns=columns))
+
+
+@pytest.mark.parametrize("kind", sorted(LEDGER_RULES))
+def test_rule_columns_can_be_probed(kind):
+    # 规则在空表上求值出错时 ledger_columns 会报错，不会少记列
+    cols = ledger_columns(kind)
+    assert cols
+
+
+@pytest.mark.skipif(app.pa is None, reason="需要 pyarrow")
+def test_detail_reads_dropped_columns(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "SIDECAR_DIR", tmp_path)
+    raw = raw_batch(300)
+    raw.insert(3, "无关列", [f"x{i}" for i in range(len(raw))])
+    ledger, filters = workbook({"批量台账": raw}), filter_book()
+    as_of = pd.Timestamp("2030-01-01")
+
+    for _ in range(2):                                  # 第二次读的是 sidecar，索引仍是原表的行号
+        df_batch, _ = app.load_batch_frames(ledger, filters)
+        assert "无关列" not in df_batch.columns         # 统计只读规则用到的列
+        rows = overdue_rows(df_batch, "主债权到期日期", as_of)
+        assert not rows.empty
+        detail = ledger_detail("batch", ledger, rows)
+        assert detail["无关列"].tolist() == raw.loc[rows.index, "无关列"].tolist()
+        assert detail[list(rows.columns)].equals(rows)
+        assert list(detail.columns).index("无关列") < list(detail.columns).index("责任余额")   # 原表列在派生列前
+
+
+def test_probe_failure_is_loud(monkeypatch):
+    rules = {"坏规则": lambda d: d["放款时间"].dt.year == 2025}     # 空 object 列没有 .dt
+    monkeypatch.setitem(LEDGER_RULES, "trad", (lambda as_of: rules, LEDGER_RULES["trad"][1]))
+    with pytest.raises(RuntimeError, match="trad"):
+        ledger_columns("trad")
+
+
+@pytest.mark.skipif(app.pa is None, reason="需要 pyarrow")
+def test_sidecar_replays_notices(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "SIDECAR_DIR", tmp_path)
+    ambiguous = pd.DataFrame({"债务人名称": ["甲", "甲"], "政策扶持领域": ["三农", "小微企业"]})
+    builds = []
+
+    def build(src):
+        builds.append(src)
+        notify("保函合同到期时间无法识别，按长期有效处理：见附件", level="warning")
+        notify("以下代偿在批量台账中匹配到多条业务", level="warning", frame=ambiguous)
+        return pd.DataFrame({"金额": [1.0, 2.0]})
+
+    src = BytesIO(b"ledger")
+    runs = []
+    for _ in range(2):
+        seen = []
+        with notify_to(seen.append):
+            df = load_cached("baohan", [src], build, src)
+        runs.append(seen)
+        assert df["金额"].tolist() == [1.0, 2.0]
+    assert len(builds) == 1                     # 第二次读的是 sidecar
+    first, second = runs
+    assert [(lv, msg) for lv, msg, _ in second] == [(lv, msg) for lv, msg, _ in first]
+    assert [lv for lv, _, _ in first] == ["warning", "warning"]
+    assert second[0][2] is None and second[1][2].equals(ambiguous)
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from taizhang_pipeline import (
+    BATCH_METRICS, TRAD_METRICS, calc_batch_metrics, calc_metrics_by_date, calc_trad_metrics, multi_date_metrics,
+)
+
+DATES = [pd.Timestamp("2025-03-31"), pd.Timestamp("2025-04-30"), pd.Timestamp("2025-06-30")]
+
+
+@pytest.mark.parametrize("kind, calc, ledger", [("trad", calc_trad_metrics, "trad_ledger"),
+                                                ("batch", calc_batch_metrics, "batch_ledger")])
+def test_matches_single_date(kind, calc, ledger, request):
+    # 不涉及在保的指标逐日期与单日统计一致（在保口径不同，见 test_inforce_is_interval_on_all_dates）
+    df = request.getfixturevalue(ledger)
+    res = calc_metrics_by_date(kind, df, DATES)
+    for day in DATES:
+        single = calc(df, day)
+        row = res.loc[day.date()]
+        names = [k for k in row.index if "_在保_" not in k]
+        assert names and all(np.isclose(row[k], single[k], rtol=1e-12, atol=1e-9) for k in names)
+
+
+def test_balance_metrics_are_left_out(trad_ledger):
+    res = calc_metrics_by_date("trad", trad_ledger, DATES)
+    for name in ["传统_在保_在保余额", "传统_在保_责任余额", "传统_小微_单户在保<=500_责任余额", "传统_单户责任最大_责任余额"]:
+        assert name in TRAD_METRICS and name not in res.columns
+    assert list(res.columns) == multi_date_metrics("trad")
+    # 流量类、按起止日重建的在保笔数/户数照常有值
+    assert res["传统_当年_实际放款"].notna().all() and res["传统_在保_户数"].notna().all()
+    assert multi_date_metrics("baohan") == ["保函_当年_放款金额"]       # 保函没有起止日，在保类都不输出
+
+
+def test_inforce_is_interval_on_all_dates(batch_ledger):
+    res = calc_metrics_by_date("batch", batch_ledger, DATES)
+    s, e = batch_ledger["主债权起始日期"], batch_ledger["主债权到期日期"]
+    assert "批量_在保_户数" in BATCH_METRICS
+    for day in DATES:
+        inforce = (batch_ledger["业务品种2"] == "批量") & (s <= day) & ~(e <= day) & (e.isna() | (e > s))
+        assert res.loc[day.date(), "批量_在保_户数"] == batch_ledger.loc[inforce, "债务人证件号码"].nunique()
@@ -0,0 +1,30 @@
+import pandas as pd
+
+import taizhang_pipeline as app
+from ledgers import workbook
+
+
+def test_enrich_maps_by_stripped_key():
+    ref = app.ReferenceData(pd.DataFrame({
+        "业务品种": [" 科创贷", "惠农贷", "科创贷"],          # 重复的科创贷按第一行
+        "业务品种2": ["批量", "批量", "传统"],
+        "业务品种3": ["科创", "三农", "其他"],
+    }))
+    assert ref.dup_keys == ["科创贷"]
+    ledger = pd.DataFrame({"担保产品": ["科创贷", "惠农贷", "未知"], "业务品种3": ["原值"] * 3})
+    out = ref.enrich(ledger, ledger["担保产品"])
+    assert out["业务品种"].tolist()[:2] == ["科创贷", "惠农贷"] and pd.isna(out["业务品种"].iloc[2])
+    assert out["业务品种2"].tolist()[:2] == ["批量", "批量"] and pd.isna(out["业务品种2"].iloc[2])
+    assert out["业务品种3"].tolist() == ["原值"] * 3           # 台账已有的列不动
+    assert len(out) == 3
+
+
+def test_filter_workbook_parsed_once_per_content():
+    classes = pd.DataFrame({"业务品种": ["流贷"], "业务品种2": ["传统"]})
+    gov = pd.DataFrame({"客户名称": [" 国企甲 ", "国企乙"]})
+    a = app.reference_data(workbook({"业务分类": classes, "国企名单": gov}))
+    b = app.reference_data(workbook({"业务分类": classes, "国企名单": gov}))
+    assert a is b
+    assert a.gov_names == {"国企甲", "国企乙"}
+    assert app.reference_data(workbook({"业务分类": classes})).gov_names is None
+    assert list(a.by_key.index) == ["流贷"]
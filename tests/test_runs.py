@@ -0,0 +1,38 @@
+import threading
+
+from taizhang_pipeline import LedgerStore, notify
+from zxy0730streamlit import StatRun
+
+
+def _job(gate: threading.Event):
+    def run(files, as_of, ledgers, step):
+        with step("trad", "传统统计") as (log, done):
+            log("开始")
+            notify("读到 3 行")
+            gate.wait(5)
+            log("继续")
+            done("传统统计完成")
+        return {"trad_res": as_of}
+    return run
+
+
+def test_run_finishes_with_logs():
+    gate = threading.Event()
+    gate.set()
+    run = StatRun(1, "sig", LedgerStore("sig")).start(_job(gate), {}, "2025-06-30")
+    run.thread.join(5)
+    assert run.state == "done" and run.results == {"trad_res": "2025-06-30"}
+    assert run.logs["trad"]["title"] == "传统统计完成"
+    assert run.logs["trad"]["lines"][:1] == ["开始"] and run.logs["trad"]["lines"][-1] == "继续"
+    assert len(run.logs["trad"]["lines"]) == 3
+
+
+def test_cancel_stops_at_next_log():
+    gate = threading.Event()
+    run = StatRun(2, "sig", LedgerStore("sig")).start(_job(gate), {}, "2025-06-30")
+    run.cancel()
+    gate.set()
+    run.thread.join(5)
+    assert run.state == "cancelled" and run.results == {}
+    assert run.logs["trad"]["title"].endswith("（已取消）") and run.logs["trad"]["state"] == "error"
+    assert "继续" not in run.logs["trad"]["lines"]
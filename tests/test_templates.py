@@ -0,0 +1,47 @@
+from io import BytesIO
+
+from openpyxl import Workbook, load_workbook
+
+from taizhang_pipeline import TEMPLATE_MAP_COLUMNS, TEMPLATE_MAP_SHEET, ReportTemplate
+
+
+def _template(mapping) -> bytes:
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "表一"
+    ws["A1"] = "小微企业余额"
+    ws["B2"] = "原值"
+    ws.merge_cells("C1:D1")
+    ws = wb.create_sheet(TEMPLATE_MAP_SHEET)
+    ws.append(TEMPLATE_MAP_COLUMNS)
+    for row in mapping:
+        ws.append(row)
+    out = BytesIO()
+    wb.save(out)
+    return out.getvalue()
+
+
+def test_fill_mapped_cells():
+    template = ReportTemplate("a.xlsx", _template([
+        ("表一", "$b$1", "在保余额"),
+        ("表一", "B2", "没有的指标"),
+        ("表一", "D1", "户数"),
+        ("表二", "A1", "户数"),
+        ("表一", "1A", "户数"),
+        (None, None, None),
+    ]))
+    assert template.mapping == [("表一", "B1", "在保余额"), ("表一", "B2", "没有的指标")]
+    assert len(template.problems) == 3
+
+    wb = load_workbook(BytesIO(template.fill({"在保余额": 12.5, "户数": 3})))
+    assert wb.sheetnames == ["表一"]
+    assert wb["表一"]["B1"].value == 12.5
+    assert wb["表一"]["B2"].value == "原值"
+
+
+def test_missing_mapping_sheet():
+    wb = Workbook()
+    out = BytesIO()
+    wb.save(out)
+    template = ReportTemplate("b.xlsx", out.getvalue())
+    assert template.mapping == [] and template.problems
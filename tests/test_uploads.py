@@ -0,0 +1,50 @@
+import time
+
+import pandas as pd
+import pytest
+
+import taizhang_pipeline as app
+from ledgers import make_trad, workbook
+from taizhang_uploads import UploadExpired, UploadStore
+
+
+def test_same_content_is_stored_once():
+    store = UploadStore(budget=1 << 20)
+    a = store.put(b"abc", "s1")
+    b = store.put(bytearray(b"abc"), "s2")
+    assert a is b and store.stats()["files"] == 1 and store.in_memory == 3
+    assert a.open().read() == b"abc" and a.getvalue() == b"abc" and a.path() is None
+
+
+def test_over_budget_spills_to_disk():
+    store = UploadStore(budget=5)
+    old = store.put(b"0123456789", "s")
+    new = store.put(b"xyz", "s")
+    assert old.path() is not None and new.path() is None       # 最久没用的先落盘
+    assert store.stats() == {"files": 2, "sessions": 1, "in_memory": 3, "on_disk": 10}
+    f = old.open()
+    f.seek(-4, 2)
+    assert f.read() == b"6789" and bytes(old.view()) == b"0123456789"
+
+
+def test_spilled_workbook_reads_like_bytes():
+    book = workbook({"台账": make_trad(50)}).getvalue()
+    store = UploadStore(budget=0)
+    handle = store.put(book, "s")
+    assert handle.path() is not None
+    got = app.read_sheet(handle, "台账", header=0)
+    assert got.equals(pd.read_excel(handle.open(), sheet_name="台账"))
+    assert app.file_sha256(handle) == app.file_sha256(app.LocalFile(handle.path()))
+
+
+def test_idle_sessions_release_files():
+    store = UploadStore(budget=1 << 20, idle_seconds=60)
+    handle = store.put(b"abc", "idle")
+    sha = app.file_sha256(handle)
+    other = store.put(b"def", "active")
+    store._sessions["idle"] = (time.time() - 120, frozenset({sha}))
+    assert store.touch("active", [app.file_sha256(other)]) == []
+    assert store.stats()["files"] == 1
+    with pytest.raises(UploadExpired):
+        handle.open()
+    assert store.touch("idle", [sha]) == [sha]                  # 回来的会话得知文件已清理
@@ -1,10 +1,24 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
 from datetime import datetime
-from functools import reduce
 from io import BytesIO
+import hashlib
 import re
+import threading
+import time
+from pathlib import Path
+from uuid import uuid4
+
+# 读取、统计、报表公式、导出都在 taizhang_pipeline（不依赖 streamlit，命令行也能用）
+from taizhang_pipeline import (
+    CUSTOM_VALUES, DETAIL_SOURCES, HISTORY_PREFILL, LEDGER_METRICS, OVERDUE_FIRST, OVERDUE_SHEETS, RESULT_SHEETS,
+    STAT_FILE_KEYS, TEMPLATE_DIR, TEMPLATE_MAP_COLUMNS, TEMPLATE_MAP_SHEET,
+    LedgerStore, ReportTemplate, ResultHistory,
+    calc_metrics_by_date, directory_templates, file_sha256, frame_digest, has_report, history_prefill,
+    ledger_detail, notify_to, overdue_view, report_program, results_frame, results_workbook, run_statistics,
+    set_notify_display, template_mapping_sample, write_workbook,
+)
+from taizhang_uploads import UploadExpired, UploadStore
 
 # ===================== 通用辅助 =====================
 
@@ -106,7 +120,9 @@ def render_topbar_controls():
     bar_left, bar_right = st.columns([3, 1])
 
     with bar_left:
-        st.date_input("统计基准日期", datetime.today(), key="as_of")
+        st.date_input("统计基准日期", datetime.today(), key="as_of", on_change=_on_as_of_change)
+        # 几家子公司共用历史结果库时按主体分开存、分开带出上期数
+        st.text_input("主体", key="entity", placeholder="只统计一家可不填")
         filter_ok, any_checked, can_run = _can_run_now()
         # 友好提示
         if not filter_ok:
@@ -119,8 +135,7 @@ def render_topbar_controls():
     with bar_right:
         # 顶部栏按钮（你已有）：
         if st.button("🚀 执行统计", key="_btn_run_top", use_container_width=True, disabled=not can_run):
-            st.session_state["_do_run"] = True
-            _clear_all_results()   # 保险
+            st.session_state["_do_run"] = True   # 上次的结果先留着，新一轮算完再整体替换
 
 
 
@@ -142,14 +157,31 @@ def _reset_logs_for_new_run():
     st.session_state["_last_run_logs"] = {}
 
 def _clear_all_results():
+    _cancel_stat_run()           # 输入变了：还在后台跑的统计作废
     for k in [
         "trad_res","batch_res","baohan_res","daichang_res",
         "trad_overdue","batch_overdue","df_daichang",
         "final_all_res","_last_success_sig",
+        "_details",              # detail_view 补齐列的明细
         "_last_run_logs",        # ← 勾选/上传变化时连日志一起清空
+        "_last_run_error",
     ]:
         st.session_state.pop(k, None)
 
+def _render_log_line(line):
+    """日志里的一行：普通文字，或 notify 记下的 (级别, 文字, 明细表)。"""
+    if isinstance(line, str):
+        st.write(line)
+        return
+    level, msg, frame = line
+    (st.warning if level == "warning" else st.write)(msg)
+    if frame is not None:
+        st.dataframe(frame, use_container_width=True)
+
+# loader 里的提示（taizhang_pipeline.notify）：后台统计线程里记进当前步骤的日志（StatRun.step 用 notify_to），
+# 否则直接显示在页面上
+set_notify_display(_render_log_line)
+
 @contextmanager
 def status_log(step_key: str, label: str, *, expanded=True, state="running", **kwargs):
     """
@@ -159,10 +191,9 @@ def status_log(step_key: str, label: str, *, expanded=True, state="running", **k
             log("• xxx")
             done("保函统计完成", "complete")
     """
-    run_id = st.session_state.get("_run_id", 0)
     rec = {"title": label, "state": state, "expanded": expanded, "lines": []}
     _logs()[step_key] = rec
-    with st.status(label, expanded=expanded, state=state, key=f"run{run_id}:{step_key}", **kwargs) as s:
+    with st.status(label, expanded=expanded, state=state, **kwargs) as s:
         def log(msg: str):
             rec["lines"].append(msg)
             st.write(msg)
@@ -180,35 +211,68 @@ def render_saved_logs(header: str = "📝 上次执行日志"):
     if not logs:
         return
     st.markdown(f"#### {header}")
-    order = ["baohan", "batch", "trad", "daichang"]
+    order = ["ingest", "baohan", "batch", "trad", "daichang"]
     for key in order:
         rec = logs.get(key)
         if not rec:
             continue
-        with st.status(rec["title"], state=rec["state"], expanded=False, key=f"saved:{key}:{st.session_state.get('_run_id',0)}"):
+        with st.status(rec["title"], state=rec["state"], expanded=False):
             for line in rec.get("lines", []):
-                st.write(line)
+                _render_log_line(line)
+    err = st.session_state.get("_last_run_error")
+    if err is not None:
+        st.error(f"统计出错：{err!r}")
 
 def _on_use_toggle(base_key: str):
     # 只要勾选变化 → 清空结果 + 清空日志
     _clear_all_results()
+    _clear_ledgers()
     _invalidate_success()
 
 def _on_upload_change(base_key: str, source_suffix: str = "uploader_sb"):
     uf = st.session_state.get(f"{base_key}:{source_suffix}")
     if uf is not None:
-        st.session_state[base_key] = BytesIO(uf.getvalue())
+        with uf.getbuffer() as buf:
+            handle = upload_store().put(buf, _upload_token())
+        st.session_state[base_key] = handle
         st.session_state[f"{base_key}:filename"] = getattr(uf, "name", "")
+        st.session_state[f"{base_key}:sha256"] = file_sha256(handle)
         st.session_state[f"{base_key}:use"] = True
+        # 内容已进上传文件库：换一个上传器 key，旧控件连同 Streamlit 自己存的那份文件一起释放
+        st.session_state[f"{base_key}:uploader_gen"] = st.session_state.get(f"{base_key}:uploader_gen", 0) + 1
     else:
-        for k in [base_key, f"{base_key}:filename", f"{base_key}:use"]:
+        for k in [base_key, f"{base_key}:filename", f"{base_key}:sha256", f"{base_key}:use"]:
             st.session_state.pop(k, None)
     _clear_all_results()
+    _clear_ledgers()
     _invalidate_success()
 
 def _invalidate_success():
     st.session_state.pop("_last_success_sig", None)
 
+def _upload_token() -> str:
+    return st.session_state.setdefault("_upload_token", uuid4().hex)
+
+def _touch_uploads():
+    """登记本会话在用的上传文件；已被清理的（会话闲置太久）清掉对应槽位，提示重新上传。"""
+    shas = {st.session_state.get(f"{k}:sha256"): k for k in FILE_SLOTS if st.session_state.get(k) is not None}
+    _forget_uploads(upload_store().touch(_upload_token(), shas))
+
+def _forget_uploads(expired):
+    """清掉已被清理的文件（sha）所在的槽位，提示重新上传。"""
+    slots = {st.session_state.get(f"{k}:sha256"): k for k in FILE_SLOTS if st.session_state.get(k) is not None}
+    for sha in expired:
+        key = slots.get(sha)
+        if key is None:
+            continue
+        st.warning(f"{FILE_SLOTS[key]}：文件闲置太久已清理，请重新上传")
+        for k in [key, f"{key}:filename", f"{key}:sha256", f"{key}:use"]:
+            st.session_state.pop(k, None)
+    if expired:
+        _clear_all_results()
+        _clear_ledgers()
+        _invalidate_success()
+
 
 def _toggle_sidebar_uploader(base_key: str):
     st.session_state[f"{base_key}:show_upload"] = not st.session_state.get(f"{base_key}:show_upload", False)
@@ -266,6 +330,7 @@ def _on_use_toggle(base_key: str):
     # 如需“取消勾选时顺便清掉文件缓存”，可在此处 pop 掉 {base_key} 等
     # 当前只清结果，保留已上传的文件，方便你快速切换
     _clear_all_results()
+    _clear_ledgers()
     _invalidate_success()
 
 
@@ -274,430 +339,70 @@ def get_cached_file(key: str):
     b = st.session_state.get(f"{key}:bytes")
     return BytesIO(b) if b else None
 
-def forever_expiredate(x):
-    try:
-        dt = pd.to_datetime(x, errors="raise")
-        return dt
-    except Exception:
-        return pd.Timestamp.max
-def extractsheet_taizhang(xl: pd.ExcelFile) -> str:
-    for name in xl.sheet_names:
-        if ("台账" in name) or ("总台账" in name):
-            return name
-    return xl.sheet_names[0]
-def extractsheet(xl: pd.ExcelFile) -> str:
-    """直接返回第一张表名"""
-    return xl.sheet_names[0]
-def extractsheet_baohan(xl: pd.ExcelFile) -> str:
-    for name in xl.sheet_names:
-        if ("保函" in name) or ("非融" in name):
-            return name
-    return xl.sheet_names[0]
-def extractsheet_daichang(xl: pd.ExcelFile) -> str:
-    for name in xl.sheet_names:
-        if ("代偿" in name):
-            return name
-    return xl.sheet_names[0]
-def _clean_columns(df: pd.DataFrame) -> pd.DataFrame:
-    df.columns = (
-        df.columns
-        .str.replace(r"\s+", "", regex=True)
-        .str.replace(r"[（(]\s*(?:万元|%|元)\s*[）)]", "", regex=True)
-        .str.replace("（", "(", regex=False)
-        .str.replace("）", ")", regex=False)
-    )
-    return df
 
-# ===================== 数据读取 =====================
+# ===================== 上传文件 =====================
+# 上传文件库（taizhang_uploads.UploadStore）在进程里只有一个，所有会话共用
+@st.cache_resource(show_spinner=False)
+def upload_store() -> UploadStore:
+    return UploadStore()
 
-# ==========================================
-AGG_MAP_BAOHAN = {
-    "在保余额": ("在保余额", "sum"),
-    "笔数": (None, "count"),
-    "户数": ("客户名称", "nunique"),
-    "责任余额": ("责任余额", "sum"),
-    "放款金额": ("放款金额", "sum"),
-}
 
-def calc_baohan_metrics(df: pd.DataFrame, as_of: pd.Timestamp) -> pd.Series:
-    y0, y1 = as_of.replace(month=1, day=1), as_of.replace(month=12, day=31)
-    m0, m1 = as_of.replace(day=1), (as_of.replace(day=1) + pd.offsets.MonthEnd(0))
-    ly0, ly1 = y0 - pd.DateOffset(years=1), y1 - pd.DateOffset(years=1)
-
-    # 合同到期时间如果写了文字而不是时间（例：无固定到期日，保全解除之日），视为无穷远的日期
-
-    RULES = {
-        "当年": lambda d: d["放款时间"].between(y0, y1) & (d["放款金额"] > 0),
-        "当月": lambda d: d["放款时间"].between(m0, m1) & (d["放款金额"] > 0),
-        "上一年": lambda d: d["放款时间"].between(ly0, ly1) & (d["放款金额"] > 0),
-        "在保": lambda d: (d["在保余额"] > 0) & (
-            d["合同到期时间"].apply(forever_expiredate) > as_of_dt
-        ),
-        "保函": lambda d: d["客户名称"] != "合计"
-    }
+# ===================== 导出 =====================
+# Excel 只在点下载时才生成，并按结果内容的哈希缓存；重跑页面不再为没人点的按钮写 Excel。
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Streamlit 1.52 起 download_button 的 data 可以传函数，点击时才调用；更早的版本先点“生成”再下载
+DEFERRED_DOWNLOAD = tuple(int(x) for x in re.findall(r"\d+", st.__version__)[:2]) >= (1, 52)
 
-    metrics = [
-        "保函_在保_在保余额",
-        "保函_当年_放款金额",
-    ]
-
-    def _c(name):
-        *keys, agg = name.split("_")
-        mask = reduce(lambda a, b: a & b, [RULES[k](df) for k in keys], pd.Series(True, index=df.index))
-        mapper = AGG_MAP_BAOHAN[agg]
-        if callable(mapper):
-            return mapper(df.loc[mask])
-        col, how = mapper
-        if how == "sum":
-            return df.loc[mask, col].sum()
-        if how == "count":
-            return int(mask.sum())
-        if how == "nunique":
-            return df.loc[mask, col].nunique()
-
-    base_res = {m: _c(m) for m in metrics}
-    return pd.Series({**base_res}, name="保函业务")
-# ==========================================
-AGG_MAP_DAICHANG = {
-    "代偿金额": lambda df: df["代偿金额"].sum() 
-}
 
-def calc_daichang_metrics(df: pd.DataFrame, as_of: pd.Timestamp) -> pd.Series:
+@st.cache_data(max_entries=32, show_spinner=False)
+def _export_bytes(digest: str, _build) -> bytes:
+    return _build()
 
-    y0, y1 = as_of.replace(month=1, day=1), as_of.replace(month=12, day=31)
-    m0, m1 = as_of.replace(day=1), (as_of.replace(day=1) + pd.offsets.MonthEnd(0))
-    ly0, ly1 = y0 - pd.DateOffset(years=1), y1 - pd.DateOffset(years=1)
-    RULES = {
-        "当年": lambda d: d["代偿时间"].between(y0, y1) & (d["代偿金额"] > 0),
-        "代偿": lambda d: ~d["企业名称"].astype(str).str.contains("代偿项目", na=False),
-        "小微": lambda d: d["政策扶持领域"].astype(str).str.contains("小微企业", na=False)
-    }
 
-    metrics = ["代偿_当年_代偿金额","代偿_代偿金额","代偿_当年_小微_代偿金额"
-    ]
-
-    def _c(name):
-        *keys, agg = name.split("_")
-        mask = reduce(lambda a, b: a & b, [RULES[k](df) for k in keys], pd.Series(True, index=df.index))
-        mapper = AGG_MAP_DAICHANG[agg]
-        if callable(mapper):
-            return mapper(df.loc[mask])
-        col, how = mapper
-        if how == "sum":
-            return df.loc[mask, col].sum()
-        if how == "count":
-            return int(mask.sum())
-        if how == "nunique":
-            return df.loc[mask, col].nunique()
-
-    base_res = {m: _c(m) for m in metrics}
-    return pd.Series({**base_res}, name="代偿明细")
-# ==========================================
-
-
-
-
-def calc_trad_metrics(df: pd.DataFrame, as_of: pd.Timestamp) -> pd.Series:
-    y0, y1 = as_of.replace(month=1, day=1), as_of.replace(month=12, day=31)
-    m0, m1 = as_of.replace(day=1), (as_of.replace(day=1) + pd.offsets.MonthEnd(0))
-    ly0, ly1 = y0 - pd.DateOffset(years=1), y1 - pd.DateOffset(years=1)
-    AGG_MAP_TRAD = {
-    "名义放款": ("放款金额", "sum"),
-    "实际放款": ("实际放款", "sum"),
-    "在保余额": ("在保余额", "sum"),
-    "笔数": (None, "count"),
-    "户数": ("客户名称", "nunique"),
-    "责任余额": ("责任余额", "sum"),
-    "名义放款": ("放款金额", "sum"),
-    "名义在保余额": ("名义在保余额", "sum"),
-    "担保费": ("担保费/利息", "sum"),
-}
-    y0, y1 = as_of.replace(month=1, day=1), as_of.replace(month=12, day=31)
-    m0, m1 = as_of.replace(day=1), (as_of.replace(day=1) + pd.offsets.MonthEnd(0))
-    ly0, ly1 = y0 - pd.DateOffset(years=1), y1 - pd.DateOffset(years=1)
+def lazy_download(label: str, file_name: str, build, digest: str, key: str) -> None:
+    """下载按钮：build() 生成文件内容，点了才调用；同一 digest 的内容只生成一次。"""
+    make = lambda: _export_bytes(digest, build)
+    if DEFERRED_DOWNLOAD:
+        st.download_button(label, data=make, file_name=file_name, mime=XLSX_MIME,
+                           use_container_width=True, key=key)
+        return
+    ready = st.session_state.setdefault("_export_ready", {})
+    if ready.get(key) != digest:
+        if not st.button(f"📦 生成：{label.replace('💾 ', '')}", key=f"{key}:make", use_container_width=True):
+            return
+        ready[key] = digest
+    st.download_button(label, data=make(), file_name=file_name, mime=XLSX_MIME,
+                       use_container_width=True, key=key)
+
+
+def all_results_export():
+    """
+    全部结果合成一个工作簿：四类统计结果 + 报表各步的表 + 到期未清零明细。
+    返回 (digest, build)；还没有结果时返回 None。报表用的手填值取报表页上次填的（没填按 0）。
+    """
+    state = st.session_state
+    results = {key: state[key] for key in RESULT_SHEETS if key in state}
+    if not results:
+        return None
+    overdue = {key: state[key] for key in OVERDUE_SHEETS if key in state}
+    manual = {key: state.get(key, 0.0) for key in HISTORY_PREFILL}
+    parts = [frame_digest(x) for x in (*results.values(), *overdue.values())]
+    digest = hashlib.sha256(repr((sorted(results), sorted(overdue), parts, sorted(manual.items()))).encode()).hexdigest()
+    # 明细表的补齐列只在点了“生成”之后才去读
+    return digest, lambda: results_workbook({**results, **{key: detail_view(key) for key in overdue}}, manual)
 
-    df_t_sum_zaibao = (
-        df.groupby("客户名称", as_index=False)["在保余额"]
-                .sum().rename(columns={"在保余额": "客户在保余额"})
-    )
-    df_t_sum_zeren = (
-        df.groupby("客户名称", as_index=False)["责任余额"]
-            .sum().rename(columns={"责任余额": "客户责任余额"})
-    )
-    nameset500_t_zaibao = set(
-        df_t_sum_zaibao.loc[df_t_sum_zaibao["客户在保余额"] <= 500, "客户名称"]
-    )
-    nameset10_t_zeren = set(
-        df_t_sum_zeren.nlargest(10, "客户责任余额")["客户名称"]
-    )
-    nameset1_t_zeren = set(
-        df_t_sum_zeren.nlargest(1, "客户责任余额")["客户名称"]
-    )
-    # 打印出 set_t_500_zaibao
-    #check#st.text(f"单户在保余额<500万客户: {nameset500_t_zaibao}")
-    #check#st.text(f"责任前10客户: {nameset10_t_zeren}")
-    # 打印前10客户及其责任余额表格
-    df_top10 = df_t_sum_zeren[df_t_sum_zeren["客户名称"].isin(nameset10_t_zeren)].sort_values("客户责任余额", ascending=False)
-    #st.dataframe(df_top10, use_container_width=True)                                                                           #check
-    #check#st.text(f"责任最大客户: {nameset1_t_zeren}")
-    RULES = {
-        "当年":  lambda d: d["放款时间"].between(y0,  y1)  & (d["放款金额"] > 0),
-        "当月":  lambda d: d["放款时间"].between(m0, m1) & (d["放款金额"] > 0),
-        "本月解保": lambda d: d["实际到期时间"].between(m0, m1),
-        "本年解保": lambda d: d["实际到期时间"].between(y0,  y1),
-        "在保":  lambda d: d["在保余额"] > 0,
-        "传统":  lambda d: d["业务品种2"].isin(["传统"]),
-        "全担":  lambda d: d["公司责任风险比例"] == "100%",
-        "惠蓉贷": lambda d: d["业务品种3"] == "惠蓉贷",
-        "驿享贷": lambda d: d["业务品种"]  == "驿享贷",
-        "担保费率低于1%(含)": lambda d: d["担保费率/利率"] <= 1,
-        "小微":  lambda d: d["企业类别"].isin(["小型","微型"]) & (d["业务品种"] != "惠抵贷"),
-        "中型":  lambda d: d["企业类别"] == "中型",
-        "三农":  lambda d: d["企业类别"] == "三农",
-        "中小":  lambda d: d["企业类别"].isin(["小型","微型","中型"]),
-        "支农支小": lambda d: d["企业类别"].isin(["小型","微型","三农"]),
-        "个体工商户及小微企业主": lambda d: d["业务品种"] == "惠抵贷",
-        "广义小微": lambda d: d["企业类别"].isin(["小型", "微型"]) | d["业务品种"] == "惠抵贷",
-        "农户及新型农业经营主体":     lambda d: d["企业类别"].isin(["三农"]),
-        "新增":  lambda d: d["新增/续贷"] == "新增",
-        "民企":  lambda d: d["国企民企"] == "民企",
-        "国企":  lambda d: d["国企民企"] == "国企",
-        "上一年": lambda d: d["放款时间"].between(ly0, ly1) & (d["放款金额"] > 0),
-        "不良": lambda d: d["风险等级"].isin(["次级","可疑","损失"]),
-        "单户在保<=500": lambda d: d["客户名称"].isin(nameset500_t_zaibao),
-        "单户责任前10": lambda d: d["客户名称"].isin(nameset10_t_zeren),
-        "单户责任最大": lambda d: d["客户名称"].isin(nameset1_t_zeren),
-    }
-    RULES.update({lvl: (lambda d, _lvl=lvl: d["风险等级"] == _lvl)
-                  for lvl in ["正常","关注","次级","可疑","损失"]})
-
-    指标列表 = [
-    "传统_当年_名义放款", "传统_当年_中型_名义放款", "传统_当年_小微_名义放款",
-    "传统_当年_实际放款", "传统_中小_当年_实际放款","传统_小微_当年_实际放款",
-    "传统_上一年_实际放款", "传统_上一年_户数","传统_中小_当年_户数","传统_小微_当年_户数","传统_当月_实际放款",
-    "传统_当年_户数", "传统_当年_小微_户数", "传统_当年_笔数", 
-    "传统_中小_当年_笔数","传统_小微_当年_笔数",
-    "传统_中小_在保_在保余额", "传统_中型_在保余额", "传统_在保_在保余额", "传统_小微_在保_在保余额",
-
-    "新增_传统_当年_实际放款","新增_传统_当年_名义放款",
-    "新增_传统_当年_支农支小_名义放款", "新增_传统_当年_支农支小_全担_名义放款",
-    "新增_传统_当年_支农支小_惠蓉贷_名义放款", "新增_传统_当年_支农支小_户数",
-
-    "传统_当年_支农支小_名义放款","传统_当年_支农支小_实际放款","传统_当年_支农支小_户数",
-
-    "传统_在保_名义在保余额","传统_在保_在保余额","传统_在保_户数",
-    "传统_广义小微_在保_户数", "传统_广义小微_在保_在保余额",
-    "传统_当年_支农支小_全担_名义放款", "传统_当年_支农支小_惠蓉贷_名义放款",
-    "新增_传统_当年_民企_名义放款", "新增_传统_当年_民企_实际放款", "新增_传统_当年_民企_户数",
-    "传统_当年_民企_名义放款", "传统_当年_民企_实际放款", "传统_当年_民企_户数",
-    "传统_小微_在保_户数",
-
-    "传统_个体工商户及小微企业主_实际放款","传统_个体工商户及小微企业主_在保_在保余额", "传统_个体工商户及小微企业主_在保_户数",
-    "传统_农户及新型农业经营主体_实际放款","传统_农户及新型农业经营主体_在保_在保余额", "传统_农户及新型农业经营主体_在保_户数",
-    "传统_支农支小_在保_在保余额", "传统_支农支小_在保_户数",
-    "传统_担保费率低于1%(含)_在保_在保余额", "传统_本月解保_在保余额", "传统_本年解保_在保余额",
-    "传统_当年_驿享贷_名义放款",
-    "传统_在保_责任余额","传统_在保_担保费","传统_在保_名义放款",
-    "传统_在保_三农_责任余额",
-    "传统_三农_单户在保<=500_责任余额","传统_小微_单户在保<=500_责任余额","传统_小微_单户在保<=500_在保_担保费","传统_小微_单户在保<=500_在保_名义放款",
-    "传统_单户责任前10_责任余额","传统_单户责任最大_责任余额",
-    ] + [f"传统_{lvl}_在保余额" for lvl in ["正常","关注","次级","可疑","损失"]]
-
-    def _c(name):
-        *keys, agg = name.split("_")
-        mask = reduce(lambda a, b: a & b, [RULES[k](df) for k in keys], pd.Series(True, index=df.index))
-        mapper = AGG_MAP_TRAD[agg]
-        if callable(mapper):
-            return mapper(df.loc[mask])
-        col, how = mapper
-        if how == "sum":
-            return df.loc[mask, col].sum()
-        if how == "count":
-            return int(mask.sum())
-        if how == "nunique":
-            return df.loc[mask, col].nunique()
-        
-    base_res = {n: _c(n) for n in 指标列表}
-
-
-
-    # ── ③ 合并并返回 ──────────────────────────────────────────
-    return pd.Series({**base_res}, name="传统业务")
-
-
-# ===================== 批量指标计算 =====================
-
-
-
-
-def calc_batch_metrics(df: pd.DataFrame, as_of: pd.Timestamp) -> pd.Series:
-    y0, y1 = as_of.replace(month=1, day=1), as_of.replace(month=12, day=31)
-    m0, m1 = as_of.replace(day=1), (as_of.replace(day=1) + pd.offsets.MonthEnd(0))
-    ly0, ly1 = y0 - pd.DateOffset(years=1), y1 - pd.DateOffset(years=1)
-
-    df_b_sum_zaibao = (
-        df.groupby("债务人证件号码", as_index=False)["在保余额"]
-                .sum().rename(columns={"在保余额": "客户在保余额"})
-    )
-    df_b_sum_zeren = (
-        df.groupby("债务人证件号码", as_index=False)["责任余额"]
-                .sum().rename(columns={"责任余额": "客户责任余额"})
-    )
-    nameset500_b_zaibao = set(
-        df_b_sum_zaibao.loc[df_b_sum_zaibao["客户在保余额"] <= 500, "债务人证件号码"]
-    )
-    nameset200_b_zaibao = set(
-        df_b_sum_zaibao.loc[df_b_sum_zaibao["客户在保余额"] <= 200, "债务人证件号码"]
-    )
-    nameset10_b_zeren = set(
-        df_b_sum_zeren.nlargest(10, "客户责任余额")["债务人证件号码"]
-    )
-    nameset1_b_zeren = set(
-        df_b_sum_zeren.nlargest(1, "客户责任余额")["债务人证件号码"]
-    )
-    # 打印出 seb_b_500_zaibao
-
-    #check#st.text(f"责任前10客户: {nameset10_b_zeren}")
-    # 打印前10客户及其责任余额表格
-    df_top10 = df_b_sum_zeren[df_b_sum_zeren["债务人证件号码"].isin(nameset10_b_zeren)].sort_values("客户责任余额", ascending=False)
-    #st.dataframe(df_top10, use_container_width=True)           #check
-    #check#st.text(f"责任最大客户: {nameset1_b_zeren}")
-    #check#st.text(f"所有列名: {list(df.columns)}")
-
-    
-    AGG_MAP_BATCH = {
-    "名义放款": ("主债权金额", "sum"),
-    "实际放款": ("实际放款", "sum"),
-    "责任余额": ("责任余额", "sum"),
-    "在保余额": ("在保余额", "sum"),
-    "名义在保余额": ("在保余额", "sum"),
-    "笔数": (None, "count"),
-    "户数": ("债务人证件号码", "nunique"),
-    "担保费": ("担保费", "sum"),
-}
-    RULES = {
-        "上一年": lambda d: d["主债权起始日期"].between(ly0, ly1) & (d["主债权金额"] > 0),
-        "当年": lambda d: d["主债权起始日期"].between(y0, y1) & (d["主债权金额"] > 0),
-        "当月": lambda d: d["主债权起始日期"].between(m0, m1) & (d["主债权金额"] > 0),
-        "在保": lambda d: d["是否已解保"] == "在保",
-        "批量": lambda d: d["业务品种2"].isin(["批量"]),
-        "全担": lambda d: d["分险比例(直担)"] == 100,
-        "担保费率低于1%(含)": lambda d: d["担保年费率"] <= 1,
-        "中型": lambda d: d["企业划型"] == "中型企业",
-        "小微": lambda d: d["企业划型"].isin(["小型企业", "微型企业"]),
-        "中小": lambda d: d["企业划型"].isin(["小型企业", "微型企业", "中型企业"]),
-        "企业": lambda d: d["债务人类别"] == "企业/企业",
-        "个人": lambda d: d["债务人类别"] != "企业/企业",
-        "三农": lambda d: d["政策扶持领域"].str.contains("三农", na=False),
-        "农业": lambda d: d["所属行业(工)"] == "农、林、牧、渔业",
-        "非农小微": lambda d: (
-            d["企业划型"].isin(["小型企业", "微型企业"]) & (d["所属行业(工)"] != "农、林、牧、渔业")
-        ),
-        "农业小微": lambda d: (
-            d["企业划型"].isin(["小型企业", "微型企业"]) & (d["所属行业(工)"] == "农、林、牧、渔业")
-        ),
-        "非农小微和小微企业主": lambda d: (
-            (d["企业划型"].isin(["小型企业", "微型企业"]) | d["债务人类别"].isin(["个人/个体工商户", "个人/小微企业主"])) & (d["所属行业(工)"] != "农、林、牧、渔业")
-        ),
-        #d["企业划型"].d["债务人类别"].isin(["个人/个体工商户", "个人/小微企业主"]) & (d["所属行业(工)"] != "农、林、牧、渔业")
-        "支农支小": lambda d: d["政策扶持领域"].isin(["三农", "小微企业", "小微企业,三农"]),
-        "个体工商户及小微企业主": lambda d: d["债务人类别"].isin(["个人/个体工商户", "个人/小微企业主"]),
-        "广义小微": lambda d: d["企业划型"].isin(["小型企业", "微型企业"]) | d["债务人类别"].isin(["个人/个体工商户", "个人/小微企业主"]),
-        "城镇居民": lambda d: d["债务人类别"].isin(["个人/个体工商户"]),
-        "农户": lambda d: d["债务人类别"].isin(["个人/农户"]),
-        "首贷户": lambda d: d.get("首贷户", pd.Series([False]*len(d))) == "是",
-        "本月解保": lambda d: d["主债权到期日期"].between(m0, m1),
-        "本年解保": lambda d: d["主债权到期日期"].between(y0, y1),
-        "民企": lambda d: d["债务人经营主体经济成分"].str.contains("私人控股", na=False),
-        "国企": lambda d: d["债务人经营主体经济成分"].str.contains("国有控股", na=False),
-        "科创": lambda d: d["担保产品"].str.contains("科创", na=False),
-        "单户在保<=500": lambda d: d["债务人证件号码"].isin(nameset500_b_zaibao),
-        "单户在保<=200": lambda d: d["债务人证件号码"].isin(nameset200_b_zaibao),
-        "单户责任前10": lambda d: d["债务人证件号码"].isin(nameset10_b_zeren),
-        "单户责任最大": lambda d: d["债务人证件号码"].isin(nameset1_b_zeren),
-    }
 
-    metrics = [
-        "批量_当年_名义放款",
-        "批量_当年_中型_名义放款",
-        "批量_当年_小微_名义放款",
-        "批量_当年_小微_户数",
-        "批量_当年_笔数",
-        "批量_当年_小微_笔数",
-        "批量_中小_在保_在保余额",
-        "批量_中型_在保_在保余额",
-        "批量_当年_实际放款",
-        "批量_上一年_实际放款",
-        "批量_中小_当年_实际放款",
-        "批量_当年_户数",
-        "批量_中小_当年_户数",
-        "批量_小微_当年_户数",
-        "批量_中小_当年_笔数",
-        "批量_小微_当年_笔数",
-        "批量_上一年_户数",
-        "批量_在保_名义在保余额",
-        "批量_在保_在保余额",
-
-        "批量_在保_户数",
-        "批量_在保_企业_户数",
-        "批量_在保_个人_户数",
-        "批量_在保_非农小微_户数",
-        "批量_在保_非农小微_在保余额",  
-        "批量_在保_农业小微_户数",
-        "批量_在保_农业小微_在保余额",
-        "批量_首贷户_在保_户数",
-        "批量_首贷户_在保_在保余额",
-        "批量_广义小微_在保_户数",
-        "批量_广义小微_在保_在保余额",
-        "批量_个体工商户及小微企业主_实际放款",
-        "批量_个体工商户及小微企业主_在保_在保余额",
-        "批量_个体工商户及小微企业主_在保_户数",
-        "批量_农户_实际放款",
-        "批量_农户_在保_在保余额",
-        "批量_农户_在保_户数",
-        "批量_在保_三农_责任余额",
-        "批量_当年_支农支小_名义放款",
-        "批量_当年_支农支小_实际放款",
-        "批量_当年_支农支小_户数",
-        "批量_支农支小_在保_在保余额",
-        "批量_支农支小_在保_户数",
-        "批量_当年_民企_名义放款",
-        "批量_当年_民企_实际放款",
-        "批量_当年_民企_户数",
-        "批量_担保费率低于1%(含)_在保_在保余额",
-        "批量_当年_科创_实际放款",
-        "批量_科创_在保_在保余额",
-        "批量_科创_在保_户数",
-        "批量_当年_科创_户数",
-        "批量_城镇居民_在保_在保余额",
-        "批量_城镇居民_在保_户数",
-        "批量_当月_实际放款",
-        "批量_三农_单户在保<=500_责任余额","批量_农户_单户在保<=200_责任余额","批量_小微_单户在保<=500_责任余额","批量_小微_单户在保<=500_在保_担保费","批量_小微_单户在保<=500_在保_名义放款",
-        "批量_单户责任前10_责任余额","批量_单户责任最大_责任余额",
-        "批量_在保_责任余额","批量_在保_担保费","批量_在保_名义放款",
-    ]
-
-    def _c(name):
-        *keys, agg = name.split("_")
-        mask = reduce(lambda a, b: a & b, [RULES[k](df) for k in keys], pd.Series(True, index=df.index))
-        mapper = AGG_MAP_BATCH[agg]
-        if callable(mapper):
-            return mapper(df.loc[mask])
-        col, how = mapper
-        if how == "sum":
-            return df.loc[mask, col].sum()
-        if how == "count":
-            return int(mask.sum())
-        if how == "nunique":
-            return df.loc[mask, col].nunique()
-
-    # 原有指标 
-    base_res = {m: _c(m) for m in metrics}
-
-    # ==== 3. 合并并返回 ====
-    return pd.Series({**base_res}, name="批量业务")
+@st.cache_resource(max_entries=32, show_spinner=False)
+def _template_upload(sha: str, name: str, _data: bytes) -> ReportTemplate:
+    return ReportTemplate(name, _data)
 
 
+def report_templates(uploaded=()) -> list:
+    """templates/ 目录里的模板 + 上传的模板；文件没变（或内容相同）就不再重新解析。"""
+    found = directory_templates()
+    found += [_template_upload(file_sha256(f), f.name, f.getvalue()) for f in uploaded]
+    return list({t.sha: t for t in found}.values())
+
 
 FILE_SLOTS = {
     "filter_file":   "筛选条件---(必选)",
@@ -737,29 +442,58 @@ def render_status_sidebar():
 
             with c2:
 
-                # 每行下方直接放原生 uploader（一次点击）
+                # 每行下方直接放原生 uploader（一次点击）；上传后控件换新，文件名显示在下面
+                widget = f"uploader_sb:{st.session_state.get(f'{key}:uploader_gen', 0)}"
                 st.file_uploader(
-                    label="", type=("xlsx",), key=f"{key}:uploader_sb",
+                    label="", type=("xlsx",), key=f"{key}:{widget}",
                     label_visibility="collapsed", accept_multiple_files=False,
-                    on_change=_on_upload_change, args=(key, "uploader_sb"),
+                    on_change=_on_upload_change, args=(key, widget),
                     width=200,
                 )
+                if uploaded and fname:
+                    st.caption(f"已上传：{fname}")
 
             if key != "filter_file":
                 used_map[key] = uploaded and st.session_state.get(use_key, False)
 
     return page
 
-# 用参与统计的关键输入生成一个“签名”
-def _current_signature() -> str:
-    parts = [str(st.session_state.get("as_of"))]  # 统计基准日期也纳入
+# 输入文件的“签名”：决定读出来的台账，不含统计基准日期
+def _ingest_signature() -> str:
+    parts = []
     for key in ["filter_file", "trad_file", "batch_file", "baohan_file", "daichang_file"]:
         fname = st.session_state.get(f"{key}:filename", "")
+        sha   = st.session_state.get(f"{key}:sha256", "")   # 同名文件内容变了也能识别
         used  = st.session_state.get(f"{key}:use", False)
         present = st.session_state.get(key) is not None
-        parts.append(f"{key}:{present}:{used}:{fname}")
+        parts.append(f"{key}:{present}:{used}:{fname}:{sha}")
     return "|".join(parts)
 
+# 用参与统计的关键输入生成一个“签名”
+def _current_signature() -> str:
+    return str(st.session_state.get("as_of")) + "|" + _ingest_signature()  # 统计基准日期也纳入
+
+
+def _ledger_store() -> LedgerStore:
+    sig = _ingest_signature()
+    store = st.session_state.get("_ledgers")
+    if store is None or store.sig != sig:
+        store = st.session_state["_ledgers"] = LedgerStore(sig)
+    return store
+
+def _clear_ledgers():
+    st.session_state.pop("_ledgers", None)
+    st.session_state.pop("multi_date_res", None)
+
+def _on_as_of_change():
+    # 只改了日期：台账还在 session 里、且已经出过结果，就直接按新日期重算
+    store = st.session_state.get("_ledgers")
+    st.session_state.pop("final_all_res", None)
+    if store is not None and store.sig == _ingest_signature() and any(
+        k in st.session_state for k in ["trad_res", "batch_res", "baohan_res", "daichang_res"]
+    ):
+        st.session_state["_do_run"] = True
+
 # 在需要显示的地方调用它：签名一致就显示“统计完成”
 def show_persistent_success():
     sig = _current_signature()
@@ -767,13 +501,204 @@ def show_persistent_success():
         st.success("✅ 统计完成")
 
 
+# ===================== 执行统计 =====================
+# 小工具：根据 :use 返回文件或 None
+def effective_file(key: str):
+    return st.session_state.get(key) if st.session_state.get(f"{key}:use", False) else None
+
+
+def detail_view(key: str) -> pd.DataFrame:
+    """
+    明细表（DETAIL_SOURCES）补齐列：统计时只读了规则用到的列，展示 / 导出时再整表读一次台账补上。
+    结果跟着明细表本身缓存；输入一变结果就清掉，所以此时的文件就是算出这些行的那份。
+    """
+    rows = st.session_state[key]
+    memo = st.session_state.setdefault("_details", {})
+    if key in memo and memo[key][0] is rows:
+        return memo[key][1]
+    kind, file_key = DETAIL_SOURCES[key]
+    try:
+        detail = ledger_detail(kind, effective_file(file_key), rows)
+    except UploadExpired as e:
+        _forget_uploads([e.args[0]])
+        return rows
+    memo[key] = (rows, detail)
+    return detail
+
+
+class RunCancelled(Exception):
+    """后台统计被取消（输入变了）。"""
+
+
+class StatRun:
+    """
+    一次后台“执行统计”：run_statistics 在线程里跑，只算数、记日志（记录格式同 status_log），
+    不碰 st.* 和 session_state。页面用 fragment 定时读 logs 显示进度，跑完由 _poll_stat_run
+    在脚本线程里把 results 写回 session_state。cancel() 之后在下一条日志处停下。
+    """
+
+    def __init__(self, run_id: int, sig: str, ledgers: LedgerStore):
+        self.id, self.sig, self.ledgers = run_id, sig, ledgers
+        self.logs: dict = {}
+        self.results: dict = {}
+        self.state = "running"          # running / done / cancelled / error
+        self.error = None
+        self._cancel = threading.Event()
+
+    def start(self, fn, *args) -> "StatRun":
+        self.thread = threading.Thread(target=self._execute, args=(fn, *args), daemon=True,
+                                       name=f"stat-run-{self.id}")
+        self.thread.start()
+        return self
+
+    def _execute(self, fn, *args):
+        try:
+            results = fn(*args, self.ledgers, self.step)
+        except RunCancelled:
+            self.state = "cancelled"
+        except Exception as e:
+            self.error, self.state = e, "error"
+        else:
+            self.results, self.state = results, "done"
+
+    def cancel(self):
+        self._cancel.set()
+
+    def check(self):
+        if self._cancel.is_set():
+            raise RunCancelled()
+
+    @contextmanager
+    def step(self, key: str, label: str):
+        self.check()
+        rec = {"title": label, "state": "running", "expanded": True, "lines": []}
+        self.logs[key] = rec
+
+        def log(msg: str):
+            self.check()
+            rec["lines"].append(msg)
+
+        def done(new_label: str, new_state: str = "complete", new_expanded: bool | None = False):
+            rec["title"], rec["state"] = new_label, new_state
+            if new_expanded is not None:
+                rec["expanded"] = new_expanded
+
+        try:
+            with notify_to(rec["lines"].append):
+                yield log, done
+        except RunCancelled:
+            rec["title"], rec["state"] = f"{rec['title']}（已取消）", "error"
+            raise
+        except Exception:
+            rec["state"] = "error"
+            raise
+
+
+def _cancel_stat_run():
+    run = st.session_state.pop("_stat_run", None)
+    if run is not None:
+        run.cancel()
+
+
+def start_stat_run():
+    """按当前勾选的文件和统计基准日期在后台开始统计；同样的输入已经在算就不重复开。"""
+    sig = _current_signature()
+    run = st.session_state.get("_stat_run")
+    if run is not None and run.state == "running" and run.sig == sig:
+        return
+    _cancel_stat_run()
+    files = {k: effective_file(k) for k in STAT_FILE_KEYS}
+    as_of = st.session_state.get("as_of", datetime.today())   # 基准日来自 sidebar
+    _reset_logs_for_new_run()
+    run = StatRun(st.session_state["_run_id"], sig, _ledger_store().fork())
+    st.session_state["_stat_run"] = run.start(run_statistics, files, as_of)
+    _invalidate_success()
+
+
+def _poll_stat_run():
+    """每次脚本运行开头调用：后台统计跑完了就把结果整体换上；输入已经变了的作废。"""
+    run = st.session_state.get("_stat_run")
+    if run is None:
+        return
+    current = run.sig == _current_signature()
+    if not current:
+        run.cancel()
+    if run.state == "running":
+        return
+    del st.session_state["_stat_run"]
+    if run.state == "cancelled" or not current:
+        return
+    st.session_state["_last_run_logs"] = run.logs
+    if isinstance(run.error, UploadExpired):
+        # 统计途中文件被清理（_touch_uploads 之后才过期）：同样清掉槽位、提示重新上传，不当作出错
+        _forget_uploads([run.error.args[0]])
+        return
+    if run.state == "error":
+        st.session_state["_last_run_error"] = run.error   # 上次的结果保留
+        return
+    for k in RESULT_KEYS:
+        st.session_state.pop(k, None)
+    st.session_state.pop("_last_run_error", None)
+    st.session_state.update(run.results)
+    st.session_state["_last_success_sig"] = run.sig
+    if run.ledgers.sig == _ingest_signature():
+        st.session_state["_ledgers"] = run.ledgers
+
+
+# 统计进行中：fragment 每 RUN_POLL_SECONDS 秒只重跑进度这一块，其余页面照常可用
+RUN_POLL_SECONDS = 1.0
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+
+
+def _show_run_progress(run: StatRun, compact: bool):
+    if compact:
+        steps = list(run.logs.values())
+        now = steps[-1]["title"] if steps else "准备中…"
+        st.info(f"⏳ 正在后台统计：{now}（当前显示的是上次的结果）")
+        return
+    for rec in list(run.logs.values()):
+        with st.status(rec["title"], state=rec["state"], expanded=rec["expanded"], width=500):
+            for line in list(rec["lines"]):
+                _render_log_line(line)
+
+
+def _run_monitor(compact: bool = False):
+    run = st.session_state.get("_stat_run")
+    if run is None:
+        return
+    if run.state != "running":
+        st.rerun()          # 跑完了：整页重跑，由 _poll_stat_run 换上结果
+    _show_run_progress(run, compact)
+
+
+if _fragment is not None:
+    run_monitor = _fragment(run_every=RUN_POLL_SECONDS)(_run_monitor)
+else:
+    def run_monitor(compact: bool = False):
+        """没有 fragment 的老版本 Streamlit：在本次运行里等统计跑完（和以前一样会占住页面）。"""
+        run = st.session_state.get("_stat_run")
+        box = st.empty()
+        while run is not None and run.state == "running":
+            with box.container():
+                _show_run_progress(run, compact)
+            time.sleep(RUN_POLL_SECONDS)
+        if run is not None:
+            st.rerun()
+
+
 
 
 st.set_page_config(page_title="担保业务统计工具", layout="wide")
 
 set_sidebar_width(360)   # ← 想多宽填多少，比如 320/360/400
 
+_touch_uploads()
+_poll_stat_run()
 page = render_status_sidebar()
+if st.session_state.pop("_do_run", False):
+    start_stat_run()
+if st.session_state.get("_stat_run") is not None:
+    run_monitor(compact=page != "工作日志")
 
 
 
@@ -816,322 +741,9 @@ if page == "工作日志":
 #         # _ = show_upload_summary()
 # # ……（上面还是上传器那一段）……
 
-# # 小工具：根据 :use 返回文件或 None
-    def effective_file(key: str):
-        return st.session_state.get(key) if st.session_state.get(f"{key}:use", False) else None
-
-    # === 用侧边栏按钮发出的信号来触发执行 ===
-# 报表页：仅在这次点击后运行一次
-
-    if st.session_state.pop("_do_run", False):
-        log_area = st.empty()          # 可选：把日志放在一个占位容器里
-        with log_area.container():
-                # ↓↓↓ 这里放你 4 段 st.status(...) 的全部代码 ↓↓↓
-                # with st.status("读取保函…", ...): ...
-                # with st.status("读取批量…", ...): ...
-                # with st.status("读取传统…", ...): ...
-                # with st.status("读取代偿…", ...): ...
-                # ↑↑↑ 原样搬进来即可 ↑↑↑
-
-            # 跑完写入成功签名（你已有的函数）
-            
-
-            # 先取勾选状态对应的“有效文件”
-            filter_file   = effective_file("filter_file")   # 必选
-            trad_file     = effective_file("trad_file")
-            batch_file    = effective_file("batch_file")
-            baohan_file   = effective_file("baohan_file")
-            daichang_file = effective_file("daichang_file")
-
-            # if filter_file is None:
-            #     st.error("未上传【筛选条件】")
-            #     st.stop()
-
-            # if not (trad_file or batch_file or baohan_file or daichang_file):
-            #     st.error("请至少勾选一类业务参与统计")
-            #     st.stop()
-
-            as_of = st.session_state.get("as_of", datetime.today())   # 基准日来自 sidebar
-            as_of_dt = pd.to_datetime(as_of)
-
-            # ← 这里保持你原来“执行统计”的整段逻辑（读取、calc_xxx、写入 session_state）
-            #    例如：读取保函/批量/传统/代偿、calc_*、保存 *_res、*_overdue 等
-            #    你可以直接把原先 if st.button(...): 里的内容粘贴进来
-
-            with st.status("读取保函…", expanded=True, state="running", width=500) as status:     
-                if baohan_file is None:
-                    pass
-                    status.update(label="无保函文件，相关指标显示为0", state="error", expanded=False)
-                elif baohan_file:
-                    def _load_baohan_inline(file_obj) -> pd.DataFrame:
-                        xl = pd.ExcelFile(BytesIO(file_obj.getvalue()))
-                        sheet = extractsheet_baohan(xl)
-
-                        def _flatten_cols(multi_cols):
-                            new_cols = []
-                            for idx, col in enumerate(multi_cols):
-                                parts = []
-                                for piece in (col if isinstance(col, tuple) else (col,)):
-                                    s = str(piece).strip()
-                                    if (not s) or s.lower() == "nan" or s.startswith("Unnamed"):
-                                        continue
-                                    parts.append(s.replace("\u3000",""))  # 去全角空格
-                                new_cols.append("_".join(parts) if parts else f"col_{idx}")
-                            return new_cols
-
-                        df = xl.parse(sheet_name=sheet, header=[2, 3])
-                        df.columns = _flatten_cols(df.columns)
-                        df = _clean_columns(df)
-                        return df  # ← 关键：返回 DataFrame
-
-                    df_baohan = _load_baohan_inline(baohan_file)
-                    st.write(f"• 保函表已读取：{df_baohan.shape[0]} 行 × {df_baohan.shape[1]} 列")
-
-                    st.write("• 统计保函指标…")
-                    st.session_state["baohan_res"] = calc_baohan_metrics(df_baohan, as_of_dt)
-                    status.update(label="保函统计完成", state="complete", expanded=False)
-                def convert_new_batch_to_old_format(df: pd.DataFrame) -> pd.DataFrame:
-                    # 定义新旧列名的映射关系
-                    col_map = {
-                        "放款日期": "主债权起始日期",
-                        "放款到期日": "主债权到期日期",
-                        "放款金额": "主债权金额",
-                        "年化担保费率": "担保年费率",
-                        "客户名称": "债务人名称",
-                        "分险比例-放款机构": "分险比例(债权人)",    
-                        "项目阶段": "是否已解保",
-                        "业务状态": "备案状态",
-                        "放款机构": "债权人名称",
-                    }
-                    # 只重命名存在的列
-                    df = df.rename(columns={k: v for k, v in col_map.items() if k in df.columns})
-                    df = df.drop(columns=["责任余额"])
-                    df["分险比例(直担)"] = 100-df["分险比例(债权人)"]
-                    # 只保留新旧映射列和未修改的列，但只显示新旧映射列的前十行
-                    cols_to_show = list(col_map.values())
-                    df_show = df[cols_to_show].head(10)
-                    # st.dataframe(df_show, use_container_width=True)
-                    return df
-
-            with st.status("读取批量…", expanded=True, state="running", width=500) as status: 
-                if batch_file is None:
-                    pass
-                    status.update(label="无批量文件，相关指标显示为0", state="error", expanded=False)
-                elif batch_file:
-                    def load_batch_data(ledger_file, filter_file, *, header_row: int = 0) -> pd.DataFrame:
-                        xl = pd.ExcelFile(BytesIO(ledger_file.getvalue()))
-                        sheet = extractsheet(xl)
-
-                        df_batch = xl.parse(sheet_name=sheet, header=header_row)
-
-                        df_batch = _clean_columns(df_batch)
-
-                        df_map = pd.read_excel(BytesIO(filter_file.getvalue()), sheet_name="业务分类")
-                        df_map["业务品种"] = df_map["业务品种"].astype(str).str.strip()
-
-                        df_batch["担保产品"] = df_batch["担保产品"].astype(str).str.strip()
-                        # 合并所有 df_map 的列到 df_batch，避免丢失信息
-                        df_batch = df_batch.merge(
-                            df_map,
-                            how="left",
-                            left_on="担保产品",
-                            right_on="业务品种",
-                            suffixes=("", "_map"),
-                        )
-                        # 再次用“业务品种”合并，补充所有 df_map 列
-                        df_batch = df_batch.merge(df_map, how="left", on="业务品种", suffixes=("", "_map2"))
-                        if "业务品种2" in df_batch.columns:
-                            df_batch = df_batch[df_batch["业务品种2"] == "批量"]
-                        else:
-                            st.warning("未找到 '业务品种2' 列，已跳过批量筛选。")
-
-                        if "分险比例-放款机构" in df_batch.columns:
-                            st.write("转换未备案的批量台账")
-                            df_batch = convert_new_batch_to_old_format(df_batch)
-                        else:
-                            st.write("本次统计已备案的批量台账")
-                        df_batch = df_batch.rename(columns={"在保余额": "名义在保余额"})
-                        df_batch["责任余额"] = 0.01 * (
-                            df_batch["分险比例(直担)"]
-                            - df_batch["分险比例-国担"]
-                            - df_batch["分险比例-市再担保"]
-                            - df_batch["分险比例-省再担保"]
-                            - df_batch["分险比例-其他"]
-                        ) * df_batch["名义在保余额"]
-                        df_batch["在保余额"] = (1 - 0.01 * df_batch["分险比例(债权人)"]) * df_batch["名义在保余额"]
-                        df_batch["实际放款"] = (1 - 0.01 * df_batch["分险比例(债权人)"]) * df_batch["主债权金额"]
-
-                        df_batch["担保费"] = df_batch["主债权金额"] * 0.01 * df_batch["担保年费率"]
-                        df_batch["主债权起始日期"] = pd.to_datetime(df_batch["主债权起始日期"], errors="coerce")
-                        df_batch["主债权到期日期"] = pd.to_datetime(df_batch["主债权到期日期"], errors="coerce")
-
-
-                        return df_batch
-                    def load_batch2_data(ledger_file, filter_file, *, header_row: int = 0) -> pd.DataFrame:
-                        xl = pd.ExcelFile(BytesIO(ledger_file.getvalue()))
-                        sheet = extractsheet_taizhang(xl)
-
-                        df_batch2 = xl.parse(sheet_name=sheet, header=header_row)
-
-                        df_batch2 = _clean_columns(df_batch2)
-
-                        df_map = pd.read_excel(BytesIO(filter_file.getvalue()), sheet_name="业务分类")
-                        df_map["业务品种"] = df_map["业务品种"].astype(str).str.strip()
-
-                        df_batch2["担保产品"] = df_batch2["担保产品"].astype(str).str.strip()
-                        # 合并所有 df_map 的列到 df_batch，避免丢失信息
-                        df_batch2 = df_batch2.merge(
-                            df_map,
-                            how="left",
-                            left_on="担保产品",
-                            right_on="业务品种",
-                            suffixes=("", "_map"),
-                        )
-                        # 再次用“业务品种”合并，补充所有 df_map 列
-                        df_batch2 = df_batch2.merge(df_map, how="left", on="业务品种", suffixes=("", "_map2"))
-                        if "分险比例-放款机构" in df_batch2.columns:
-                            df_batch2 = convert_new_batch_to_old_format(df_batch2)
-                        df_batch2 = df_batch2.rename(columns={"在保余额": "名义在保余额"})
-                        df_batch2["责任余额"] = 0.01 * (
-                            df_batch2["分险比例(直担)"]
-                            - df_batch2["分险比例-国担"]
-                            - df_batch2["分险比例-市再担保"]
-                            - df_batch2["分险比例-省再担保"]
-                            - df_batch2["分险比例-其他"]
-                        ) * df_batch2["名义在保余额"]
-                        df_batch2["在保余额"] = (1 - 0.01 * df_batch2["分险比例(债权人)"]) * df_batch2["名义在保余额"]
-                        df_batch2["实际放款"] = (1 - 0.01 * df_batch2["分险比例(债权人)"]) * df_batch2["主债权金额"]
-
-                        df_batch2["担保费"] = df_batch2["主债权金额"] * 0.01 * df_batch2["担保年费率"]
-                        df_batch2["主债权起始日期"] = pd.to_datetime(df_batch2["主债权起始日期"], errors="coerce")
-                        df_batch2["主债权到期日期"] = pd.to_datetime(df_batch2["主债权到期日期"], errors="coerce")
-
-
-                        return df_batch2
-                    
-                    df_batch = load_batch_data(batch_file, filter_file)
-                    df_batch2 = load_batch2_data(batch_file, filter_file)
-                    
-                    df_batch_overdue = df_batch[
-                        (df_batch["主债权到期日期"].notna()) &
-                        (df_batch["主债权到期日期"] < as_of_dt.normalize()) &
-                        (df_batch["在保余额"] != 0)
-                    ]
-                    st.write("批量在保余额检查")
-                    st.session_state["batch_overdue"] = df_batch_overdue
-                    st.write("统计批量指标")
-                    as_of_dt = pd.to_datetime(as_of)
-                    st.session_state["batch_res"] = calc_batch_metrics(df_batch, as_of_dt)
-                    status.update(label="批量统计完成", state="complete", expanded=False)
-            with st.status("读取传统…", expanded=True, state="running", width=500) as status:
-                if trad_file is None:
-                    pass
-                    status.update(label="无传统文件，相关指标显示为0", state="error", expanded=False)
-                if trad_file:
-                    def load_trad_data(ledger_file, filter_file, *, header_row: int = 2) -> pd.DataFrame:
-                        xl = pd.ExcelFile(BytesIO(ledger_file.getvalue()))
-                        sheet = extractsheet_taizhang(xl)
-
-                        df_taizhang = xl.parse(sheet_name=sheet, header=header_row)
-                        df_taizhang = _clean_columns(df_taizhang)
-
-                        df_map = pd.read_excel(BytesIO(filter_file.getvalue()), sheet_name="业务分类")
-                        gov_list = (
-                            pd.read_excel(BytesIO(filter_file.getvalue()), sheet_name="国企名单", usecols=["客户名称"])
-                            .iloc[:, 0]
-                            .astype(str)
-                            .str.strip()
-                            .tolist()
-                        )
-
-                        df_taizhang["客户名称"] = df_taizhang["客户名称"].astype(str).str.strip()
-                        df_taizhang["业务品种"] = df_taizhang["业务品种"].astype(str).str.strip()
-                        df_taizhang["国企民企"] = np.where(
-                            df_taizhang["客户名称"].isin(gov_list) | (df_taizhang["业务品种"] == "委托贷款"),
-                            "国企",
-                            "民企",
-                        )
-                        df_taizhang = df_taizhang.merge(df_map, how="left", on="业务品种")
-                        df_taizhang = df_taizhang[df_taizhang["业务品种2"] == "传统"]
-                        df_taizhang = df_taizhang.rename(columns={"在保余额": "名义在保余额"})
-                        df_taizhang["在保余额"] = (1 - df_taizhang["银行"]) * df_taizhang["名义在保余额"]
-
-                        df_taizhang["实际放款"] = (1 - df_taizhang["银行"]) * df_taizhang["放款金额"]
-                        df_taizhang["放款时间"] = pd.to_datetime(df_taizhang["放款时间"], errors="coerce")
-                        df_taizhang["实际到期时间"] = pd.to_datetime(df_taizhang["实际到期时间"], errors="coerce")
-                        return df_taizhang                
-                    df_trad = load_trad_data(trad_file, filter_file)
-
-                    #st.write("df_baohan 列：", list(df_baohan.columns))
-                    #check
-                    #st.dataframe(df_baohan.head(10), use_container_width=True)
-                    #check
-                    # #st.dataframe(df_daichang.head(10), use_container_width=True)
-                    st.write(f"• 传统表已读取：{df_trad.shape[0]} 行 × {df_trad.shape[1]} 列")
-                    df_trad_overdue = df_trad[
-                        (df_trad["实际到期时间"].notna()) &
-                        (df_trad["实际到期时间"] < as_of_dt.normalize()) &
-                        (df_trad["在保余额"] != 0)
-                    ]
-                    st.session_state["trad_overdue"] = df_trad_overdue
-                    st.write("传统在保余额检查...")
-                    st.session_state["trad_res"] = calc_trad_metrics(df_trad, as_of_dt)
-                    status.update(label="传统统计完成", state="complete", expanded=False)
-            with st.status("读取代偿…", expanded=True, state="running", width=500) as status:
-                if daichang_file is None:
-                    pass
-                    status.update(label="无代偿文件，相关指标显示为0", state="error", expanded=False)
-                if daichang_file and batch_file:
-                    def load_daichang_data(daichang_file, df_batch2) -> pd.DataFrame:
-                        xl = pd.ExcelFile(BytesIO(daichang_file.getvalue()))
-                        sheet = extractsheet_daichang(xl)
-
-                        df_daichang = xl.parse(sheet_name=sheet, header=4)
-                        df_daichang = _clean_columns(df_daichang)
-                        df_daichang["代偿时间"] = pd.to_datetime(df_daichang["代偿时间"], errors="coerce")
-                        df_daichang["代偿金额"] = pd.to_numeric(df_daichang["代偿金额"], errors="coerce").fillna(0) / 10000
-                        df_daichang["担保金额"] = pd.to_numeric(df_daichang["担保金额"], errors="coerce").fillna(0) / 10000
-
-                        # Drop rows where 贷款银行 is null or empty
-                        df_daichang = df_daichang[df_daichang["贷款银行"].notna() & (df_daichang["贷款银行"].astype(str).str.strip() != "")]
-                        # 新增“政策扶持领域”列，默认空
-                        # 新增“政策扶持领域”列，默认空，并放在最左侧
-                        df_daichang.insert(0, "政策扶持领域", "")
-                        st.write("在批量台账中找到代偿债务人名称，识别政策扶持领域...")
-                        # 遍历 df_daichang，每行根据“企业名称”和“担保金额”在 df_batch 查找匹配
-                        for idx, row in df_daichang.iterrows():
-                            # 如果企业名称有顿号，新增一列“企业名称_首”，为顿号之前的名字
-                            if "企业名称_首" not in df_batch2.columns:
-                                df_batch2["企业名称_首"] = df_batch2["债务人名称"].astype(str).str.split("、").str[0]
-                            # 当前行企业名称也取顿号前部分
-                            row_name_first = str(row["企业名称"]).split("、")[0]
-                            mask = (
-                                (df_batch2["企业名称_首"] == row_name_first) &
-                                (np.isclose(df_batch2["主债权金额"], row["担保金额"], atol=0.01))
-                            )
-                            matched = df_batch2[mask]
-                            if not matched.empty:
-                                # 取第一条匹配的“政策扶持领域”
-                                # 如果有多条匹配，合并所有匹配的相关字段为一张表并展示
-                                if len(matched) > 1:
-                                    st.dataframe(matched[["业务编号","担保产品","政策扶持领域","债务人名称","债务人证件号码", "主债权金额", "主债权到期日期",  "债权人名称", "备案状态"]], use_container_width=True)
-                                df_daichang.at[idx, "政策扶持领域"] = matched.iloc[0]["政策扶持领域"]
-                        # 删除原处 st.success/st.dataframe 代码
-
-                        # 在 if page == "工作日志": 页面，统计完成后展示 df_daichang
-                        # 找到 if st.button("🚀 执行统计", use_container_width=True): 代码块
-                        # 在 st.success("✅ 统计完成！下方可直接查看统计结果") 之后添加：
-                        
-                        
-                        
-                        return df_daichang 
-                    df_daichang = load_daichang_data(daichang_file, df_batch2)      
-                    st.session_state["df_daichang"] = df_daichang
-                    st.write(f"• 代偿表已读取：{df_daichang.shape[0]} 行 × {df_daichang.shape[1]} 列")
-                    st.write("统计代偿指标…")
-                    st.session_state["daichang_res"] = calc_daichang_metrics(df_daichang, as_of_dt)
-                    status.update(label="代偿统计完成", state="complete", expanded=False)
-        st.session_state["_last_success_sig"] = _current_signature()
+    # === 侧边栏按钮发出的信号在页面外就开始后台统计（start_stat_run），这里只显示上次的日志 ===
+    if st.session_state.get("_stat_run") is None:
+        render_saved_logs()
     for key, title, fname in [
         ("trad_res", "📈 传统台账统计结果", "传统统计"),
         ("batch_res", "📈 批量业务统计结果", "批量统计"),
@@ -1145,29 +757,62 @@ if page == "工作日志":
             if key != "df_daichang":
                 st.subheader(title)
                 ser = st.session_state[key]
-                out = BytesIO()
-                ser.rename_axis("指标").reset_index().to_excel(out, index=False)
-                st.download_button(
+                lazy_download(
                     f"💾 下载{title.replace('📈 ', '').replace('统计结果', '')}结果",
-                    data=out.getvalue(),
-                    file_name=f"{fname}_{datetime.today():%Y%m%d}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    use_container_width=True,
+                    f"{fname}_{datetime.today():%Y%m%d}.xlsx",
+                    lambda ser=ser: write_workbook({"Sheet1": ser.rename_axis("指标").reset_index()}),
+                    frame_digest(ser), key=f"_dl:{key}",
                 )
                 st.dataframe(ser.to_frame("数值"))
             else:
                 st.subheader(title)
-                df = st.session_state[key]
-                out = BytesIO()
-                df.to_excel(out, index=False)
-                st.download_button(
+                df = detail_view(key)
+                lazy_download(
                     "💾 下载代偿&批量合并结果",
-                    data=out.getvalue(),
-                    file_name=f"代偿批量合并_{datetime.today():%Y%m%d}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    use_container_width=True,
+                    f"代偿批量合并_{datetime.today():%Y%m%d}.xlsx",
+                    lambda df=df: write_workbook({"Sheet1": df}),
+                    frame_digest(df), key=f"_dl:{key}",
                 )
                 st.dataframe(df, use_container_width=True)
+
+    export = all_results_export()
+    if export is not None:
+        st.subheader("📦 全部结果")
+        lazy_download(
+            "💾 下载全部结果（统计结果 + 报表 + 到期未清零，一个工作簿）",
+            f"台账统计全部结果_{datetime.today():%Y%m%d}.xlsx",
+            export[1], export[0], key="_dl:all",
+        )
+
+    # 多日期统计：用已读入的台账，一次算出多个基准日期（默认当年各月末）能按日期重建的指标
+    ledgers = st.session_state.get("_ledgers")
+    if ledgers is not None and ledgers.sig == _ingest_signature() and ledgers.frames:
+        with st.expander("📅 多日期统计（如当年各月末）"):
+            as_of_ts = pd.Timestamp(st.session_state.get("as_of", datetime.today()))
+            month_ends = [d.date() for d in pd.date_range(as_of_ts.replace(month=1, day=1), periods=12, freq="ME")]
+            picked = st.multiselect(
+                "统计基准日期", sorted(set(month_ends) | {as_of_ts.date()}),
+                default=[d for d in month_ends if d <= as_of_ts.date()],
+            )
+            st.caption(
+                "“在保”在每个日期都按起始日 ≤ 基准日 < 到期日判断（含统计基准日期），与执行统计的在保口径不同；"
+                f"台账里只有 {as_of_ts:%Y-%m-%d} 的余额，余额类（在保余额、责任余额…）和单户类指标不在此统计。"
+            )
+            if st.button("▶️ 计算多日期指标", disabled=not picked):
+                frames = []
+                for kind, df in ledgers.frames.items():
+                    df = df[0] if isinstance(df, tuple) else df    # 批量存的是 (df_batch, df_batch2)
+                    frames.append(calc_metrics_by_date(kind, df, picked))
+                st.session_state["multi_date_res"] = pd.concat(frames, axis=1).T.rename_axis("指标")
+            res = st.session_state.get("multi_date_res")
+            if res is not None:
+                lazy_download(
+                    "💾 下载多日期统计结果",
+                    f"多日期统计_{datetime.today():%Y%m%d}.xlsx",
+                    lambda: write_workbook({"Sheet1": res.rename(columns=str).reset_index()}),
+                    frame_digest(res), key="_dl:multi_date",
+                )
+                st.dataframe(res, use_container_width=True)
 # ===================== 报表 =====================
 elif page == "报表":
 
@@ -1184,17 +829,10 @@ elif page == "报表":
 
 
     # ① 把所有统计结果汇总进 all_res -------------------------
-    patterns = ["_名义放款", "_当年_名义放款"]
     all_res = {}
-    for key in ["trad_res", "batch_res", "baohan_res", "daichang_res"]:
+    for key in RESULT_SHEETS:
         if key in st.session_state:
             all_res.update(st.session_state[key])
-    # 用于判断是否“空”的最小 DataFrame
-    rows = []
-    for pat in patterns:
-        rows.extend([{"指标": k, "数值": v, "分组": pat}
-                     for k, v in all_res.items() if pat in k])
-    df = pd.DataFrame(rows)
     # ---------------------------------------------------------
     st.title("📊 分类汇总")
     st.text(
@@ -1212,350 +850,138 @@ elif page == "报表":
             ("上一年_在保_在保余额", "上一年在保余额（万元）"),
             ("上一年_在保_责任余额", "上一年在保责任余额（万元）"),
         ]
+        # 历史结果库里有上月末/上年末的结果就自动带出来，仍可手改
+        history = ResultHistory()
+        entity = st.session_state.get("entity", "").strip()
+        as_of_ts = pd.Timestamp(st.session_state.get("as_of", datetime.today()))
+        found = history_prefill(history, as_of_ts, entity)
         for key, label in input_fields:
-            val = st.number_input(label, min_value=0.0, value=0.0, step=0.01, format="%.2f")
+            day, hit = found.get(key, (None, None))
+            val = st.number_input(label, min_value=0.0, value=float(hit or 0.0), step=0.01, format="%.2f")
+            if hit is not None:
+                st.caption(f"已按 {day:%Y-%m-%d} 的历史结果自动填入")
             st.session_state[key] = val
             all_res[key] = val
 
 
 
-    # ② 两组公式规则 -----------------------------------------
-    rules_city = [
-        "本年累计发生金额（扣除银行分险）=批量_当年_实际放款+传统_当年_实际放款",
-        "本年累计发生金额（扣除银行分险）同比增减=批量_当年_实际放款-批量_上一年_实际放款+传统_当年_实际放款-传统_上一年_实际放款",
-        "在保余额=批量_在保_在保余额+传统_在保_在保余额",
-        "同比增减=在保余额-上月_在保_在保余额",
-        "比年初增减额=在保余额-上一年_在保_在保余额",
-        "累计代偿=代偿_代偿金额",
-        "本年累计代偿=代偿_当年_代偿金额",
-        "本年累计担保户数=批量_当年_户数+传统_当年_户数",
-        "本年累计担保户数同比增减=批量_当年_户数-批量_上一年_户数+传统_当年_户数-传统_上一年_户数",
-        "在保企业客户数量=批量_在保_企业_户数+传统_在保_户数",
-        "在保个人客户数量=批量_在保_个人_户数+传统_个体工商户及小微企业主_在保_户数",
-        "正常类担保余额=批量_正常_名义在保余额+传统_正常_在保余额",
-        "关注类担保余额=批量_关注_名义在保余额+传统_关注_在保余额",
-        "次级类担保余额=批量_次级_名义在保余额+传统_次级_在保余额",
-        "可疑类担保余额=批量_可疑_名义在保余额+传统_可疑_在保余额",
-        "损失类担保余额=批量_损失_名义在保余额+传统_损失_在保余额",
-    ]
-
-    rules_cd_fin = [
-        "实际在保余额=批量_在保_责任余额+传统_在保_责任余额",
-        "较年初增减=实际在保余额-上一年_在保_责任余额",
-        "客户数=批量_在保_户数+传统_在保_户数",
-        "1.非农小微企业在保余额=批量_在保_非农小微_在保余额+传统_在保_小微_在保余额",
-        "1.非农小微企业客户数=批量_在保_非农小微_户数+传统_在保_小微_户数",
-        "2.农业小微企业在保余额=批量_在保_农业小微_在保余额",
-        "2.农业小微企业客户数=批量_在保_农业小微_户数",
-        "3.城镇居民（含个体工商户）在保余额=批量_城镇居民_在保_在保余额",
-        "3.城镇居民（含个体工商户）客户数=批量_城镇居民_在保_户数",
-        "4.农村居民（含个体工商户）在保余额=批量_农户_在保_在保余额",
-        "4.农村居民（含个体工商户）客户数=批量_农户_在保_户数",
-        "批量_不良_名义在保余额=批量_次级_名义在保余额-批量_可疑_名义在保余额-批量_损失_名义在保余额",
-        "传统_不良_在保余额=传统_次级_在保余额-传统_可疑_在保余额-传统_损失_在保余额",
-        "不良融资担保余额=批量_不良_名义在保余额+传统_不良_在保余额"
-    ]
-
-    rules_city_yoy = [
-        "本年累计担保金额=批量_当年_实际放款+传统_当年_实际放款",
-        "本年累计担保金额同比增减=批量_当年_实际放款-批量_上一年_实际放款+传统_当年_实际放款-传统_上一年_实际放款",
-        "在保余额=批量_在保_在保余额+传统_在保_在保余额",
-        "同比增减额=在保余额-上月_在保_在保余额",
-        "比年初增减额=在保余额-上一年_在保_在保余额",
-        "累计代偿=代偿_代偿金额",
-        "本年累计代偿=代偿_当年_代偿金额",
-        "本年累计担保户数=批量_当年_户数+传统_当年_户数",
-        "本年累计担保户数同比增减=批量_当年_户数-批量_上一年_户数+传统_当年_户数-传统_上一年_户数",
-        "在保企业客户数量=批量_在保_企业_户数+传统_在保_户数",
-        "在保个人客户数量=批量_在保_个人_户数+传统_个体工商户及小微企业主_在保_户数",
-        "最大单一客户在保余额=传统_单户责任最大_责任余额",
-        "前十大客户在保余额=传统_单户责任前10_责任余额",
-        "正常类担保余额=批量_正常_名义在保余额+传统_正常_在保余额",
-        "关注类担保余额=批量_关注_名义在保余额+传统_关注_在保余额",
-        "次级类担保余额=批量_次级_名义在保余额+传统_次级_在保余额",
-        "可疑类担保余额=批量_可疑_名义在保余额+传统_可疑_在保余额",
-        "损失类担保余额=批量_损失_名义在保余额+传统_损失_在保余额",
-        "非融本年累计担保金额=保函_当年_放款金额",
-        "非融在保余额=保函_在保_在保余额",
-        "非融本年累计代偿=保函_当年_代偿金额",
-        "非融本年累计损失=保函_当年_损失",
-    ]
-
-    rules_prov = [
-        "中小企业借款类担保业务当年累计发生额（万元）=批量_中小_当年_实际放款+传统_中小_当年_实际放款",
-        "其中：小微企业当年累计发生额（万元）=批量_小微_当年_实际放款+传统_小微_当年_实际放款",
-        "中小企业借款类担保业务当年累计发生户数=批量_中小_当年_户数+传统_中小_当年_户数",
-        
-        "其中：小微企业当年累计发生户数=批量_小微_当年_户数+传统_小微_当年_户数",
-        "中小企业借款类担保业务当年累计发生笔数 =批量_中小_当年_笔数+传统_中小_当年_笔数",
-        "其中：小微企业当年累计发生笔数=批量_小微_当年_笔数+传统_小微_当年_笔数",
-        "中小企业借款类在保余额=批量_中小_在保_在保余额+传统_中小_在保_在保余额",
-        "其中：小微企业在保余额=批量_小微_在保_在保余额+传统_小微_在保_在保余额",
-        "中小企业借款类代偿当年累计发生额（万元）=代偿_当年_小微_代偿金额",
-        "其中：小微企业代偿当年累计发生额（万元）=代偿_当年_小微_代偿金额",
-        "个体工商户、小微企业主、新型农业经营主体担保业务当年累计发生额（不含创业小额贷款担保业务）=批量_个体工商户及小微企业主_实际放款+批量_农户及新型农业经营主体_实际放款+传统_个体工商户及小微企业主_实际放款+传统_农户及新型农业经营主体_实际放款",
-        "个体工商户、小微企业主、新型农业经营主体担保业务在保余额（不含创业小额贷款担保业务）=批量_个体工商户及小微企业主_在保_在保余额+批量_农户及新型农业经营主体_在保_在保余额+传统_个体工商户及小微企业主_在保_在保余额+传统_农户及新型农业经营主体_在保余额",
-    ]
-    rules_resp = [
-        "单户金额500万及以下“三农”类在保余额（实际余额）=批量_三农_单户在保<=500_责任余额+传统_三农_单户在保<=500_责任余额",
-        "其中：单户在保余额200万人民币及以下的农户借款类担保在保余额（实际余额）=批量_农户_单户在保<=200_责任余额",
-        "单户担保金额500万元人民币及以下的小微企业借款类担保余额（实际余额）=批量_小微_单户在保<=500_责任余额+传统_小微_单户在保<=500_责任余额",
-        "单户担保金额500万元人民币及以下的小微企业借款类_其中：费率=单户担保金额500万元人民币及以下的小微企业借款类_在保_担保费/单户担保金额500万元人民币及以下的小微企业借款类_在保_名义放款",
-        "其他借款类在保余额（实际余额）= 在保_责任余额-单户担保金额500万元人民币及以下的小微企业借款类担保余额（实际余额）",
-        "其他借款类_其中：费率=其他借款类_在保_担保费/其他借款类_在保_名义放款",
-        "本月解保额=上月_在保_在保余额+当月_实际放款-在保_在保余额",
-        "本年累计解保=上一年_在保_在保余额+当年_实际放款-当年_在保_在保余额"
-    ]
-
-
-    # 额外自定义指标，可以直接赋值，不通过公式计算
-    # 额外自定义指标，可以直接赋值，不通过公式计算
-    custom_values = {
-        "批量_科创_当年代偿_代偿金额": 0,
-        "批量_关注_名义在保余额": 280,
-        "批量_次级_名义在保余额": 30,
-        "批量_可疑_名义在保余额": 0,
-        "批量_损失_名义在保余额": 0,
-        "保函_当年_代偿金额": 0,
-        "保函_当年_损失": 0,
-    }
-
-    rules_supp = [
-        "批量_正常_名义在保余额=批量_在保_名义在保余额-批量_关注_名义在保余额-批量_次级_名义在保余额-批量_可疑_名义在保余额-批量_损失_名义在保余额",
-        "当月_实际放款=批量_当月_实际放款+传统_当月_实际放款",
-        "在保_在保余额=批量_在保_在保余额+传统_在保_在保余额",
-        "在保_责任余额=批量_在保_责任余额+传统_在保_责任余额",
-        "当年_实际放款=批量_当年_实际放款+传统_当年_实际放款",
-        "在保_担保费=传统_在保_担保费+批量_在保_担保费",
-        "在保_名义放款=传统_在保_名义放款+批量_在保_名义放款",
-        "单户担保金额500万元人民币及以下的小微企业借款类_在保_担保费=批量_小微_单户在保<=500_在保_担保费+传统_小微_单户在保<=500_在保_担保费",
-        "单户担保金额500万元人民币及以下的小微企业借款类_在保_名义放款=批量_小微_单户在保<=500_在保_名义放款+传统_小微_单户在保<=500_在保_名义放款",
-        "其他借款类_在保_担保费=在保_担保费-单户担保金额500万元人民币及以下的小微企业借款类_在保_担保费",
-        "其他借款类_在保_名义放款=在保_名义放款-单户担保金额500万元人民币及以下的小微企业借款类_在保_名义放款",
-    ]
-
-
-    rules_sur = [
-      #  "三、当年融资担保业务"
-        "当年累计增加发生额=批量_当年_实际放款+传统_当年_实际放款",
-        "当年累计增加发生额（名义）=批量_当年_名义放款+传统_当年_名义放款",
-        "当年累计发生客户数=批量_当年_户数+传统_当年_户数",
-
-      #  "四、科创企业专项统计",
-        "本年度科创企业累计担保发生额=批量_当年_科创_实际放款",
-        "本年度科创企业累计担保发生户数=批量_当年_科创_户数",
-        "本年度科创业务担保余额=批量_科创_在保_在保余额",
-        "本年度科创业务在保户数=批量_科创_在保_户数",
-        "本年度科创企业累计代偿金额=批量_科创_当年代偿_代偿金额",
-
-      #  "五、支农支小专项统计（二者满足其一即统计）"
-        "本年度新增支农支小业务累计发生额（名义）=批量_当年_支农支小_名义放款+传统_当年_支农支小_名义放款",
-        "本年度新增支农支小业务累计发生额（实际）=批量_当年_支农支小_实际放款+传统_当年_支农支小_实际放款",
-        "本年度新增支农支小户数=批量_当年_支农支小_户数+传统_当年_支农支小_户数",
-
-      #  "六、民营企业专项统计（涵盖所有非国有制经营主体个人+企业）"
-        "本年度新增民营企业累计发生额（名义）=批量_当年_民企_名义放款+传统_当年_民企_名义放款",
-        "本年度新增民营企业累计发生额（实际）=批量_当年_民企_实际放款+传统_当年_民企_实际放款",
-        "本年度新增民企户数=批量_当年_民企_户数+传统_当年_民企_户数",
-
-       # "七、融资性担保在保余额"
-        "名义在保余额=批量_在保_名义在保余额+传统_在保_名义在保余额",
-        "银行分险金额=批量_在保_名义在保余额-批量_在保_在保余额+传统_在保_名义在保余额-传统_在保_在保余额",
-        "再担保分险金额=批量_在保_在保余额-批量_在保_责任余额+传统_在保_在保余额-传统_在保_责任余额",
-        "客户数=批量_在保_户数+传统_在保_户数",
-        "担保费率低于1%(含)的担保余额=批量_担保费率低于1%(含)_在保_在保余额+传统_担保费率低于1%(含)_在保_在保余额",
-        "1.小微企业余额（含小型企业、微型企业、个体工商户以及小微企业主）=批量_广义小微_在保_在保余额+传统_广义小微_在保_在保余额",
-        "2.小微企业户数（含小型企业、微型企业、个体工商户以及小微企业主）=批量_广义小微_在保_户数+传统_广义小微_在保_户数",
-        "其中：个体工商户及小微企业主余额=批量_个体工商户及小微企业主_在保_在保余额+传统_个体工商户及小微企业主_在保_在保余额",
-        "其中：个体工商户及小微企业主户数=批量_个体工商户及小微企业主_在保_户数+传统_个体工商户及小微企业主_在保_户数",
-        "2.农户及新型农业经营主体余额=批量_农户_在保_在保余额",
-        "2.农户及新型农业经营主体户数=批量_农户_在保_户数",
-        "3.支农支小（剔重）余额=批量_支农支小_在保_在保余额+传统_支农支小_在保_在保余额",
-        "3.支农支小（剔重）户数=批量_支农支小_在保_户数+传统_支农支小_在保_户数",
-        "首贷余额=批量_首贷户_在保_在保余额",
-        "首贷户数=批量_首贷户_在保_户数",
-
-
-
-       # "八、非融资性担保余额"
-       "非融资性担保余额=保函_在保_在保余额",
-
-    ]
-
-
-
-    # ③ 通用函数：把公式列表转成可展示的 DataFrame -------------
-
-
-    def build_formula_df(rule_list, res_dict):
-        rows, max_len = [], 0
-        num_pat = re.compile(r'^[+-]?\d+(?:\.\d+)?$')
-
-        def as_value(token: str):
-            """把 token 解析成数值：先查 res_dict，再尝试数字常量，否则 0。"""
-            if token in res_dict:
-                return res_dict[token]
-            if num_pat.match(token):
-                return float(token)
-            return 0.0
-
-        for f in rule_list:
-            m = re.match(r'\s*(.+?)\s*=\s*(.+)', f)
-            if not m:
-                continue
-            target, expr = m.group(1).strip(), m.group(2).strip()
-
-            # 1) 令牌化：支持 + - * /
-            tokens = [t.strip() for t in re.split(r'([+\-*/])', expr) if t and t.strip()]
-            ops, operands = [], []
-
-            # 2) 处理前缀一元 +/-（* 和 / 不作为一元）
-            i = 0
-            pending_unary = '+'
-            if tokens and tokens[0] in ('+', '-'):
-                pending_unary = tokens[0]
-                i = 1
-
-            # 3) 解析为：operand (op operand)*
-            if i >= len(tokens):
-                continue
-            operands.append(tokens[i]); i += 1
-            while i < len(tokens):
-                op = tokens[i]
-                if op not in ('+', '-', '*', '/'):
-                    # 容错：两个操作数相邻，当作漏了 '+'
-                    ops.append('+')
-                    operands.append(op)
-                    i += 1
-                    continue
-                ops.append(op)
-                if i + 1 < len(tokens):
-                    operands.append(tokens[i + 1])
-                    i += 2
-                else:
-                    # 末尾缺少操作数则丢弃该操作符
-                    i += 1
-
-            # 4) 计算（支持运算优先级：先乘除后加减）
-            values = [as_value(k) for k in operands]
-            if not values:
-                continue
-
-            # current_term 累乘/除的“项”；current_add 保存该项应以 + 还是 - 加入 total
-            current_term = values[0]
-            current_add = '+' if pending_unary == '+' else '-'
-            total = None
-
-            for idx, op in enumerate(ops, start=1):
-                v = values[idx] if idx < len(values) else 0.0
-                if op == '*':
-                    current_term = current_term * v
-                elif op == '/':
-                    current_term = (current_term / v) if v != 0 else 0.0
-                elif op in ('+', '-'):
-                    # 先把上一项结算进 total
-                    if total is None:
-                        total = current_term if current_add == '+' else -current_term
-                    else:
-                        total = total + current_term if current_add == '+' else total - current_term
-                    # 开启新项
-                    current_term = v
-                    current_add = op
-
-            # 循环结束，收尾结算最后一项
-            if total is None:
-                total = current_term if current_add == '+' else -current_term
-            else:
-                total = total + current_term if current_add == '+' else total - current_term
-
-            # 5) 展示：首列放 target/total；每个操作数根据符号加 Emoji 前缀
-            items = [target]
-            vals = [total]
-
-            op_signs = [pending_unary] + ops  # 与 operands 对齐的“符号列表”
-            for k, sign in zip(operands, op_signs):
-                label = k
-                if sign == '-':
-                    label = f"（➖）{k}"
-                elif sign == '/':
-                    label = f"（➗）{k}"
-                # 乘号和加号按你的要求保持原样（不加标记）
-                items.append(label)
-                vals.append(as_value(k))
-
-            # 展平成一行："指标 值 指标 值 …"
-            out_row = []
-            for k, v in zip(items, vals):
-                out_row.extend([k, v])
-
-            max_len = max(max_len, len(out_row))
-            rows.append(out_row)
-
-            # 6) 写回计算结果，供后续规则引用
-            res_dict[target] = total
-
-        cols = [str(i + 1) for i in range(max_len)]
-        padded = [r + [None] * (max_len - len(r)) for r in rows]
-        return pd.DataFrame(padded, columns=cols)
-
-
     # ---------------------------------------------------------
 
-    if not df.empty:
+    if has_report(st.session_state):
         left_col, right_col = st.columns([1, 4])
         with left_col:
             st.text("直接赋值的数据:")
         with right_col:
-            st.text("、".join([f"{k}: {v}" for k, v in custom_values.items()]))
-        all_res.update(custom_values)
-
-        # 定义一个临时变量存放每一步的 DataFrame
-        calc_steps = [
-            ("辅助计算", rules_supp),
-            ("市州（辖内）融资性担保机构经营月报表（填写版）", rules_city),
-            ("市州（辖内）融资性担保机构经营月报表（同比数据）", rules_city_yoy),
-            ("月度担保责任余额统计表（填写版）", rules_resp),
-            ("成都市金融办融资性担保公司月度统计表（填写版）", rules_cd_fin),
-            ("四川省融资担保机构月报数据统计表", rules_prov),
-            ("省监管系统--月度经营情况表", rules_sur),
-        ]
-        def update_from_formula_df(all_res: dict, df_tmp: pd.DataFrame) -> None:
-            # 只取“1”为指标、“2”为数值这两列
-            col_key, col_val = "1", "2"
-            if col_key not in df_tmp.columns or col_val not in df_tmp.columns:
-                return
-            sub = df_tmp[[col_key, col_val]].dropna(subset=[col_key]).copy()
-            # 转成字典；把 None/NaN 转 0，确保是标量数字
-            to_add = {}
-            for k, v in zip(sub[col_key], sub[col_val]):
-                key = str(k).strip()
-                if key == "":
-                    continue
-                try:
-                    val = float(v) if pd.notna(v) else 0.0
-                except Exception:
-                    # 非数字一律置 0，避免 object 混入
-                    val = 0.0
-                to_add[key] = val
-            all_res.update(to_add)
-
-        for title, rules in calc_steps:
+            st.text("、".join([f"{k}: {v}" for k, v in CUSTOM_VALUES.items()]))
+        all_res.update(CUSTOM_VALUES)
+
+        # 公式只编译一次；和上次相比输入没变的公式不重算
+        program = report_program()
+        run = program.evaluate(all_res, st.session_state.get("_report_run"))
+        st.session_state["_report_run"] = run
+        for k, title in enumerate(program.steps):
             st.subheader(title)
-            df_tmp = build_formula_df(rules, all_res)
-            st.dataframe(df_tmp, use_container_width=True)
-            update_from_formula_df(all_res, df_tmp)   # ← 只合并 target/total
-
-
+            st.dataframe(program.step_frame(run, k), use_container_width=True)
+        all_res = run.results
+
+        problems = program.diagnostics(set().union(*LEDGER_METRICS.values(), CUSTOM_VALUES, HISTORY_PREFILL))
+        if not problems.empty:
+            with st.expander(f"⚠️ 公式检查：{len(problems)} 处（未定义的指标按 0 计算）"):
+                st.dataframe(problems, use_container_width=True)
+
+        with st.expander("🧪 情景测算（多组直接赋值，一次算完）"):
+            st.caption("每行一个情景；空着的格子沿用本页当前的值。也可以上传情景表：第一列是情景名，其余列是指标名。")
+            uploaded = st.file_uploader("上传情景表", type=["xlsx"], key="_scenario_file")
+            if uploaded is not None:
+                table = pd.read_excel(uploaded)
+                table = table.rename(columns={table.columns[0]: "情景"})
+                table.columns = table.columns.astype(str).str.strip()
+            else:
+                names = sorted(program.inputs)
+                over = st.multiselect("要改的指标", names, default=[k for k in CUSTOM_VALUES if k in names])
+                table = st.data_editor(
+                    pd.DataFrame([{"情景": "当前", **{k: run.inputs.get(k) for k in over}}]),
+                    num_rows="dynamic", use_container_width=True,
+                )
+            labels = [str(v) if pd.notna(v) and str(v).strip() else f"情景{i + 1}" for i, v in enumerate(table["情景"])]
+            scenarios = table.drop(columns="情景").set_axis(labels, axis=0)
+            matrix = None
+            if len(scenarios) and len(scenarios.columns):
+                try:
+                    matrix = program.evaluate_many(run.inputs, scenarios).rename_axis("情景")
+                except ValueError as e:
+                    st.error(str(e))            # 情景表覆盖了公式目标
+            if matrix is not None:
+                lazy_download(
+                    "💾 下载情景测算结果",
+                    f"情景测算_{datetime.today():%Y%m%d}.xlsx",
+                    lambda: write_workbook({"Sheet1": matrix.reset_index()}),
+                    frame_digest(matrix), key="_dl:scenarios",
+                )
+                st.dataframe(matrix, use_container_width=True)
 
         st.subheader("全部结果")
-        final_df = (
-            pd.Series(all_res, name="数值")
-            .reset_index().rename(columns={"index": "指标"})
-        )
-        final_df["数值"] = pd.to_numeric(final_df["数值"], errors="coerce").fillna(0.0)
+        final_df = results_frame(all_res)
         st.dataframe(final_df, use_container_width=True)
         st.session_state["final_all_res"] = dict(zip(final_df["指标"], final_df["数值"]))
 
+        # 本次结果存进历史结果库（只存与当前输入、基准日期一致的结果；内容没变不重复写）
+        if st.session_state.get("_last_success_sig") == _current_signature():
+            res = st.session_state["final_all_res"]
+            digest = hashlib.sha256(repr((entity, str(as_of_ts.date()), sorted(res.items()))).encode()).hexdigest()
+            if st.session_state.get("_history_saved") != digest:
+                input_sig = hashlib.sha256(_ingest_signature().encode()).hexdigest()[:32]
+                if history.save(as_of_ts, input_sig, res, entity):
+                    st.session_state["_history_saved"] = digest
+
+        with st.expander("📑 填报监管报表模板"):
+            st.caption(
+                f"模板（.xlsx）放在 {TEMPLATE_DIR} 目录，或在这里上传。模板里加一张“{TEMPLATE_MAP_SHEET}”表，"
+                f"三列：{'、'.join(TEMPLATE_MAP_COLUMNS)}，指标填本页的指标名；下载的文件里不含这张表。"
+            )
+            uploaded = st.file_uploader("上传模板", type=["xlsx"], accept_multiple_files=True, key="_template_files")
+            lazy_download(
+                f"💾 下载“{TEMPLATE_MAP_SHEET}”表样例（列出全部报表指标）", "映射表样例.xlsx",
+                lambda: template_mapping_sample(program),
+                hashlib.sha256(repr(program.nodes).encode()).hexdigest(), key="_dl:template_sample",
+            )
+            values = st.session_state["final_all_res"]
+            values_digest = hashlib.sha256(repr(sorted(values.items())).encode()).hexdigest()
+            templates = report_templates(uploaded or ())
+            if not templates:
+                st.info("还没有模板。")
+            for tpl in templates:
+                st.markdown(f"**{tpl.name}**")
+                if tpl.problems:
+                    st.warning("；".join(tpl.problems))
+                if not tpl.mapping:
+                    continue
+                missing = list(dict.fromkeys(m for _, _, m in tpl.mapping if m not in values))
+                if missing:
+                    st.caption(f"这些指标本页没有，对应单元格保留模板原样：{'、'.join(missing)}")
+                lazy_download(
+                    f"💾 下载填好的 {tpl.name}（{len(tpl.mapping)} 个单元格）",
+                    f"{Path(tpl.name).stem}_{as_of_ts:%Y%m%d}.xlsx",
+                    lambda tpl=tpl: tpl.fill(values),
+                    tpl.sha + values_digest, key=f"_dl:template:{tpl.sha[:16]}",
+                )
+
+    with st.expander(f"📜 历史结果（{entity or '默认主体'}，按基准日期，环比）"):
+        saved = history.dates(entity)
+        if not saved:
+            st.info("还没有保存过结果；每次在本页出结果后会自动保存。")
+        else:
+            options = sorted(st.session_state.get("final_all_res") or {}) or list(HISTORY_PREFILL.values())
+            picked = st.multiselect(
+                "指标", options, default=[m for m in dict.fromkeys(HISTORY_PREFILL.values()) if m in options],
+            )
+            hist = history.series(picked, entity)
+            if not hist.empty:
+                st.caption(f"共 {len(saved)} 个基准日期：{saved[0]} ~ {saved[-1]}")
+                st.dataframe(hist, use_container_width=True)
+                st.subheader("环比增减")
+                st.dataframe(hist.diff().iloc[1:], use_container_width=True)
+
 
 # ===================== 在保余额检查 =====================
 elif page == "在保余额检查":
@@ -1565,18 +991,10 @@ elif page == "在保余额检查":
         st.warning("未上传批量或传统台账文件")
         st.stop()
 
-    df_trad_overdue = st.session_state["trad_overdue"].copy()
-    trad_cols = df_trad_overdue.columns.tolist()
-    trad_first = ["在保余额", "实际到期时间"]
-    trad_cols = trad_first + [c for c in trad_cols if c not in trad_first]
-    df_trad_overdue = df_trad_overdue[trad_cols]
-
-    df_batch_overdue = st.session_state.get("batch_overdue", pd.DataFrame()).copy()
-    if not df_batch_overdue.empty:
-        batch_cols = df_batch_overdue.columns.tolist()
-        batch_first = ["在保余额", "主债权到期日期"]
-        batch_cols = batch_first + [c for c in batch_cols if c not in batch_first]
-        df_batch_overdue = df_batch_overdue[batch_cols]
+    trad_overdue = st.session_state["trad_overdue"]
+    batch_overdue = st.session_state.get("batch_overdue", pd.DataFrame())
+    df_trad_overdue = overdue_view(detail_view("trad_overdue"), OVERDUE_FIRST["trad_overdue"])
+    df_batch_overdue = batch_overdue if batch_overdue.empty else overdue_view(detail_view("batch_overdue"), OVERDUE_FIRST["batch_overdue"])
 
     st.subheader("传统台账到期未清零明细")
     if df_trad_overdue.empty:
@@ -1584,14 +1002,11 @@ elif page == "在保余额检查":
     else:
         st.info(f"共有 **{len(df_trad_overdue)}** 行传统台账到期在保余额未清零：")
         st.dataframe(df_trad_overdue, use_container_width=True)
-        out_trad = BytesIO()
-        df_trad_overdue.to_excel(out_trad, index=False)
-        st.download_button(
+        lazy_download(
             "💾 下载传统台账在保余额明细 Excel",
-            data=out_trad.getvalue(),
-            file_name=f"传统台账在保余额未清零_{datetime.today():%Y%m%d}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            use_container_width=True,
+            f"传统台账在保余额未清零_{datetime.today():%Y%m%d}.xlsx",
+            lambda: write_workbook({"Sheet1": df_trad_overdue}),
+            frame_digest(trad_overdue), key="_dl:trad_overdue",
         )
 
     st.subheader("批量台账到期未清零明细")
@@ -1600,12 +1015,9 @@ elif page == "在保余额检查":
     else:
         st.info(f"共有 **{len(df_batch_overdue)}** 行批量台账到期在保余额未清零：")
         st.dataframe(df_batch_overdue, use_container_width=True)
-        out_batch = BytesIO()
-        df_batch_overdue.to_excel(out_batch, index=False)
-        st.download_button(
+        lazy_download(
             "💾 下载批量台账在保余额明细 Excel",
-            data=out_batch.getvalue(),
-            file_name=f"批量台账在保余额未清零_{datetime.today():%Y%m%d}.xlsx",
-            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            use_container_width=True,
+            f"批量台账在保余额未清零_{datetime.today():%Y%m%d}.xlsx",
+            lambda: write_workbook({"Sheet1": df_batch_overdue}),
+            frame_digest(batch_overdue), key="_dl:batch_overdue",
         )